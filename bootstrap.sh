@@ -4,8 +4,9 @@
 #
 #  1. Creates an IAM policy with the right permissions for the Lambda function.
 #  2. Creates an IAM role for the Lambda function and attaches the policy.
-#  3. Build a deployment package.
-#  4. Create a Lambda function on AWS with the role attached and upload the
+#  3. Creates the DynamoDB table that holds per-cluster leases.
+#  4. Build a deployment package.
+#  5. Create a Lambda function on AWS with the role attached and upload the
 #     deployment package.
 #
 # ==============================================================================
@@ -40,9 +41,23 @@ echo "Waiting for role to be registered"
 
 sleep 5
 
+echo "Creating DynamoDB table called ecs-autoscale-leases"
+
+aws dynamodb create-table \
+    --table-name ecs-autoscale-leases \
+    --attribute-definitions AttributeName=lease,AttributeType=S \
+    --key-schema AttributeName=lease,KeyType=HASH \
+    --billing-mode PAY_PER_REQUEST
+
+aws dynamodb wait table-exists --table-name ecs-autoscale-leases
+
+aws dynamodb update-time-to-live \
+    --table-name ecs-autoscale-leases \
+    --time-to-live-specification Enabled=true,AttributeName=expires
+
 echo "Creating deployment package"
 
-cd lambda && zip -r ../deployment.zip * && cd -
+python scripts/build.py
 
 echo "Creating Lambda function ecs-autoscale"
 
@@ -1,7 +1,7 @@
 import logging
 import os
 
-import boto3
+from .clients import ClientProxy
 
 
 LOG_LEVEL_STR = os.environ.get("LOG_LEVEL", "info")
@@ -9,7 +9,11 @@ LOG_LEVEL = getattr(logging, LOG_LEVEL_STR.upper())
 
 logging.basicConfig(level=LOG_LEVEL)
 
-# Initialize boto3 clients.
-ecs_client = boto3.client('ecs')
-asg_client = boto3.client('autoscaling')
-cdw_client = boto3.client('cloudwatch')
+# Initialize boto3 clients. These resolve lazily to a pooled client for the
+# region and role of the cluster currently being processed.
+ecs_client = ClientProxy('ecs')
+asg_client = ClientProxy('autoscaling')
+cdw_client = ClientProxy('cloudwatch')
+sqs_client = ClientProxy('sqs')
+s3_client = ClientProxy('s3')
+ssm_client = ClientProxy('ssm')
@@ -0,0 +1,410 @@
+"""
+Compact audit log of scaling decisions.
+
+With `AUDIT_LOG` set to a directory or to ``s3://bucket/prefix/``, every tick
+appends one segment with a row per cluster, per service and per metric value:
+what the autoscaler saw, what it decided and how long it took. Test runs are
+not logged.
+
+Segments are columnar. Numbers are packed little-endian arrays, strings are
+codes into a dictionary of the segment, and the whole segment is compressed
+with zlib, so a service costs a few bytes per tick. Local directories get one
+file per day (``audit-20240101.bin``) that segments are appended to. S3
+objects cannot be appended to, so every tick is its own object under a prefix
+per day (``2024/01/01/tick-....bin``).
+
+`load` reads the segments of a time range back into one array per column,
+e.g. to analyze weeks of decisions offline:
+
+    columns = load("s3://my-bucket/audit/", start=datetime(2024, 1, 1))
+    services = columns["services"]
+    services["task_diff"]   # array("q", [...]), one value per row.
+    services["service"]     # ["worker", ...]
+
+Numeric columns are `array.array` objects, which numpy wraps without copying
+(``numpy.frombuffer(services["task_diff"], dtype="int64")``).
+"""
+
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+import zlib
+
+from . import s3_client
+from .instances import (
+    count_launching_instances, get_cpu_avail, get_cpu_used, get_mem_avail,
+    get_mem_used,
+)
+from .services import Service
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# Where the audit log is written, a directory or ``s3://bucket/prefix/``.
+# Empty to disable it.
+AUDIT_LOG = os.environ.get("AUDIT_LOG", "")
+
+FORMAT_VERSION = 1
+
+# Integers missing from a row, e.g. instance counts of Fargate clusters.
+MISSING = -1
+
+# Column names and types: "d" for floats, "q" for integers and "s" for
+# strings.
+TABLES: Dict[str, List[Tuple[str, str]]] = {
+    "ticks": [
+        ("time", "d"), ("seconds", "d"), ("clusters", "q"),
+        ("targeted", "q"),
+    ],
+    "clusters": [
+        ("time", "d"), ("cluster", "s"), ("action", "s"),
+        ("desired_capacity", "q"), ("active_instances", "q"),
+        ("draining_instances", "q"), ("launching_instances", "q"),
+        ("cpu_reserved", "q"), ("cpu_available", "q"),
+        ("mem_reserved", "q"), ("mem_available", "q"),
+        ("services", "q"), ("metrics_seconds", "d"), ("seconds", "d"),
+    ],
+    "services": [
+        ("time", "d"), ("cluster", "s"), ("service", "s"),
+        ("running_count", "q"), ("pending_count", "q"),
+        ("desired_count", "q"), ("min_tasks", "q"), ("max_tasks", "q"),
+        ("desired_tasks", "q"), ("task_diff", "q"), ("decision", "s"),
+        ("metrics_error", "q"),
+    ],
+    "metrics": [
+        ("time", "d"), ("cluster", "s"), ("service", "s"), ("metric", "s"),
+        ("value", "d"),
+    ],
+}
+
+Column = Union[array, List[str]]
+
+_LENGTH = struct.Struct("<I")
+
+
+def _little_endian(values: array) -> array:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def encode_segment(tick_time: float,
+                   rows: Dict[str, List[tuple]]) -> bytes:
+    """
+    Encode the rows of a tick, by table and in the column order of `TABLES`,
+    as one compressed, length prefixed segment.
+    """
+    strings: Dict[str, int] = {}
+    header: dict = {"version": FORMAT_VERSION, "time": tick_time,
+                    "tables": {}}
+    blobs = []
+    for table, columns in TABLES.items():
+        table_rows = rows.get(table, [])
+        header["tables"][table] = {"rows": len(table_rows), "columns": []}
+        for i, (name, kind) in enumerate(columns):
+            values: array
+            if kind == "s":
+                values = array("I", (strings.setdefault(x[i] or "",
+                                                        len(strings))
+                                     for x in table_rows))
+            elif kind == "q":
+                values = array("q", (MISSING if x[i] is None else int(x[i])
+                                     for x in table_rows))
+            else:
+                values = array("d", (float("nan") if x[i] is None
+                                     else float(x[i]) for x in table_rows))
+            blob = _little_endian(values).tobytes()
+            header["tables"][table]["columns"].append(
+                [name, values.typecode, len(blob)])
+            blobs.append(blob)
+    header["strings"] = list(strings)
+    raw_header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    payload = zlib.compress(
+        _LENGTH.pack(len(raw_header)) + raw_header + b"".join(blobs))
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def decode_segment(payload: bytes) -> Tuple[dict, Dict[str, Dict[str, array]]]:
+    """The header and the columns of a compressed segment."""
+    raw = zlib.decompress(payload)
+    header_length, = _LENGTH.unpack_from(raw)
+    offset = _LENGTH.size + header_length
+    header = json.loads(raw[_LENGTH.size:offset].decode("utf-8"))
+    tables: Dict[str, Dict[str, array]] = {}
+    for table, spec in header["tables"].items():
+        tables[table] = {}
+        for name, typecode, length in spec["columns"]:
+            values = array(typecode)
+            values.frombytes(raw[offset:offset + length])
+            tables[table][name] = _little_endian(values)
+            offset += length
+    return header, tables
+
+
+def iter_segments(data: bytes) -> Iterator[bytes]:
+    """Split the contents of a file into compressed segments."""
+    offset = 0
+    while offset + _LENGTH.size <= len(data):
+        length, = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        if offset + length > len(data):
+            # A write that was cut short.
+            logger.warning("Ignoring truncated audit log segment")
+            return
+        yield data[offset:offset + length]
+        offset += length
+
+
+class AuditLog:
+    """
+    Collects the rows of a tick and appends them to the audit log with
+    `flush`.
+
+    Parameters
+    ----------
+    destination : str
+        A directory or ``s3://bucket/prefix/``, empty to disable the log.
+
+    clock : Callable
+        Returns the current Unix time.
+
+    """
+
+    def __init__(self,
+                 destination: str = AUDIT_LOG,
+                 clock: Callable = time.time) -> None:
+        self.destination = destination
+        self.clock = clock
+        self._tick: Optional[dict] = None
+        self._rows: Dict[str, List[tuple]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.destination)
+
+    def start_tick(self, targeted: bool = False) -> None:
+        """Start collecting the rows of a tick."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._tick = {"time": self.clock(), "started": time.perf_counter(),
+                          "targeted": targeted}
+            self._rows = {table: [] for table in TABLES}
+
+    def record_cluster(self,
+                       cluster_name: str,
+                       report: dict,
+                       services: List[Service],
+                       seconds: float = None,
+                       metrics_seconds: float = None) -> None:
+        """
+        Add a cluster and its services, given the `report` of
+        `scale_ec2_instances`, which is empty for Fargate only clusters.
+        """
+        with self._lock:
+            if self._tick is None:
+                return
+            now = self._tick["time"]
+            cluster_data = report.get("cluster_data")
+            asg_group_data = report.get("asg_group_data") or {}
+            active: List[dict] = []
+            draining: List[dict] = []
+            launching = None
+            if cluster_data is not None:
+                active = \
+                    cluster_data["active_container_described"][
+                        "containerInstances"]
+                draining = \
+                    cluster_data["draining_container_described"][
+                        "containerInstances"]
+                launching = count_launching_instances(cluster_data,
+                                                      asg_group_data)
+            known = cluster_data is not None
+            self._rows["clusters"].append((
+                now, cluster_name, report.get("action"),
+                asg_group_data.get("DesiredCapacity"),
+                len(active) if known else None,
+                len(draining) if known else None,
+                launching,
+                sum(get_cpu_used(x) for x in active) if known else None,
+                sum(get_cpu_avail(x) for x in active) if known else None,
+                sum(get_mem_used(x) for x in active) if known else None,
+                sum(get_mem_avail(x) for x in active) if known else None,
+                len(services), metrics_seconds, seconds,
+            ))
+            for service in services:
+                if service.service_name is None:
+                    continue
+                self._rows["services"].append((
+                    now, cluster_name, service.service_name,
+                    service.task_count, service.pending_count,
+                    service.desired_count, service.min_tasks,
+                    service.max_tasks,
+                    service.desired_tasks if service.task_diff
+                    else service.desired_count,
+                    service.task_diff, service.decision,
+                    int(service.metrics_error is not None),
+                ))
+                for metric, value in sorted(service.state.items()):
+                    if isinstance(value, bool) or \
+                            not isinstance(value, (int, float)):
+                        continue
+                    self._rows["metrics"].append((
+                        now, cluster_name, service.service_name, metric,
+                        value,
+                    ))
+
+    def flush(self) -> Optional[str]:
+        """Append the rows of the tick to the log, returning where they are."""
+        # pylint: disable=broad-except
+        with self._lock:
+            tick, self._tick = self._tick, None
+            rows, self._rows = self._rows, {}
+        if tick is None:
+            return None
+        rows["ticks"] = [(tick["time"],
+                          time.perf_counter() - tick["started"],
+                          len(rows["clusters"]), int(tick["targeted"]))]
+        data = encode_segment(tick["time"], rows)
+        moment = datetime.fromtimestamp(tick["time"], tz=timezone.utc)
+        try:
+            if self.destination.startswith("s3://"):
+                bucket, _, prefix = \
+                    self.destination[len("s3://"):].partition("/")
+                key = prefix + moment.strftime(
+                    "%Y/%m/%d/tick-%Y%m%dT%H%M%S.%fZ.bin")
+                s3_client.put_object(Bucket=bucket, Key=key, Body=data)
+                path = "s3://{:s}/{:s}".format(bucket, key)
+            else:
+                os.makedirs(self.destination, exist_ok=True)
+                path = os.path.join(self.destination,
+                                    moment.strftime("audit-%Y%m%d.bin"))
+                with open(path, "ab") as outfile:
+                    outfile.write(data)
+        except Exception as ex:
+            # The audit log is for analysis, never fail the tick over it.
+            logger.warning("Could not write audit log to %s: %s",
+                           self.destination, ex)
+            return None
+        logger.debug("Appended %d bytes to audit log %s", len(data), path)
+        return path
+
+
+audit_log = AuditLog()
+
+
+def _utc(moment: datetime) -> datetime:
+    """Naive datetimes are taken to be UTC."""
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+
+def _days(start: Optional[datetime],
+          end: Optional[datetime]) -> Optional[List[datetime]]:
+    if start is None:
+        return None
+    end = _utc(end) if end is not None else datetime.now(timezone.utc)
+    day = _utc(start).replace(hour=0, minute=0, second=0, microsecond=0)
+    out = []
+    while day <= end:
+        out.append(day)
+        day += timedelta(days=1)
+    return out
+
+
+def _local_files(directory: str,
+                 days: Optional[List[datetime]]) -> List[str]:
+    names = sorted(x for x in os.listdir(directory)
+                   if x.startswith("audit-") and x.endswith(".bin"))
+    if days is not None:
+        wanted = {x.strftime("audit-%Y%m%d.bin") for x in days}
+        names = [x for x in names if x in wanted]
+    return [os.path.join(directory, x) for x in names]
+
+
+def _s3_keys(bucket: str,
+             prefix: str,
+             days: Optional[List[datetime]]) -> List[str]:
+    prefixes = [prefix] if days is None else \
+        [prefix + x.strftime("%Y/%m/%d/") for x in days]
+    keys = []
+    for key_prefix in prefixes:
+        kwargs = {"Bucket": bucket, "Prefix": key_prefix}
+        while True:
+            res = s3_client.list_objects_v2(**kwargs)
+            keys += [x["Key"] for x in res.get("Contents", [])
+                     if x["Key"].endswith(".bin")]
+            if not res.get("IsTruncated"):
+                break
+            kwargs["ContinuationToken"] = res["NextContinuationToken"]
+    return sorted(keys)
+
+
+def _read_all(location: str, days: Optional[List[datetime]]) -> List[bytes]:
+    if not location.startswith("s3://"):
+        out = []
+        for path in _local_files(location, days):
+            with open(path, "rb") as infile:
+                out.append(infile.read())
+        return out
+    bucket, _, prefix = location[len("s3://"):].partition("/")
+
+    def get(key: str) -> bytes:
+        return s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return list(executor.map(get, _s3_keys(bucket, prefix, days)))
+
+
+def load(location: str,
+         start: datetime = None,
+         end: datetime = None) -> Dict[str, Dict[str, Column]]:
+    """
+    Load the audit log at `location` between `start` and `end` (UTC) into
+    one array per column, by table. String columns are lists.
+    """
+    days = _days(start, end)
+    start_time = _utc(start).timestamp() if start is not None else None
+    end_time = _utc(end).timestamp() if end is not None else None
+
+    out: Dict[str, Dict[str, Column]] = {
+        table: {name: [] if kind == "s" else array(kind)
+                for name, kind in columns}
+        for table, columns in TABLES.items()
+    }
+    for data in _read_all(location, days):
+        for payload in iter_segments(data):
+            header, tables = decode_segment(payload)
+            if start_time is not None and header["time"] < start_time or \
+                    end_time is not None and header["time"] >= end_time:
+                continue
+            strings = header["strings"]
+            for table, columns in TABLES.items():
+                n_rows = header["tables"].get(table, {}).get("rows", 0)
+                for name, kind in columns:
+                    column = out[table][name]
+                    values = tables.get(table, {}).get(name)
+                    if isinstance(column, list):
+                        column.extend([""] * n_rows if values is None else
+                                      [strings[i] for i in values])
+                    elif values is None:
+                        # Columns added since the segment was written.
+                        column.extend(array(kind, [
+                            MISSING if kind == "q" else float("nan")
+                        ] * n_rows))
+                    else:
+                        column.extend(values)
+    return out
@@ -0,0 +1,211 @@
+"""
+Pooled boto3 clients for sweeping clusters across regions and accounts.
+
+Clients are cached per (account, region, service). Clusters that declare a
+`role_arn` get clients built from assumed-role credentials, which are
+refreshed shortly before they expire. Clients are wrapped with
+`ecsautoscale.throttling.ThrottledClient`.
+
+The rest of the package talks to AWS through `ClientProxy` objects, which
+resolve to the pooled client for the region and role of the current thread's
+scope (see `scope`). Outside of any scope they resolve to the default region
+and credentials, just like a plain module-level boto3 client would.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import boto3
+
+from .throttling import ThrottledClient, summarize
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+DEFAULT_ACCOUNT = "default"
+
+# Refresh assumed-role credentials this long before they expire.
+REFRESH_MARGIN = timedelta(minutes=5)
+
+
+def account_from_role(role_arn: Optional[str]) -> str:
+    """Extract the account ID from a role ARN."""
+    if not role_arn:
+        return DEFAULT_ACCOUNT
+    return role_arn.split(":")[4]
+
+
+class ClientPool:
+    """
+    A thread-safe cache of boto3 clients, by role, region and service. Two
+    roles in the same account have permissions of their own, so they never
+    share a session.
+
+    Parameters
+    ----------
+    session_factory : Callable
+        Creates a `boto3.session.Session`. Accepts the same keyword arguments.
+
+    refresh_margin : timedelta
+        How long before expiration assumed-role credentials are refreshed.
+
+    role_session_name : str
+        The session name used when assuming roles.
+
+    throttle : bool
+        Wrap clients with `ThrottledClient` for rate limiting, retries on
+        throttling and memoization of reads within a tick.
+
+    """
+
+    def __init__(self,
+                 session_factory: Callable = boto3.session.Session,
+                 refresh_margin: timedelta = REFRESH_MARGIN,
+                 role_session_name: str = "ecs-autoscale",
+                 throttle: bool = True) -> None:
+        self.session_factory = session_factory
+        self.refresh_margin = refresh_margin
+        self.role_session_name = role_session_name
+        self.throttle = throttle
+        self._lock = threading.RLock()
+        self._sessions: Dict[Tuple[Optional[str], Optional[str]], tuple] = {}
+        self._clients: Dict[
+            Tuple[Optional[str], Optional[str], str], tuple] = {}
+
+    def _expired(self, expiration: Optional[datetime]) -> bool:
+        if expiration is None:
+            return False
+        return datetime.now(timezone.utc) >= expiration - self.refresh_margin
+
+    def _session(self, region: Optional[str], role_arn: Optional[str]):
+        key = (role_arn or None, region)
+        entry = self._sessions.get(key)
+        if entry is not None and not self._expired(entry[1]):
+            return entry
+
+        if not role_arn:
+            entry = (self.session_factory(region_name=region), None)
+        else:
+            logger.info("Assuming role %s in region %s", role_arn, region)
+            sts = self.get("sts", region=region)
+            creds = sts.assume_role(
+                RoleArn=role_arn,
+                RoleSessionName=self.role_session_name,
+            )["Credentials"]
+            session = self.session_factory(
+                aws_access_key_id=creds["AccessKeyId"],
+                aws_secret_access_key=creds["SecretAccessKey"],
+                aws_session_token=creds["SessionToken"],
+                region_name=region,
+            )
+            entry = (session, creds["Expiration"])
+        self._sessions[key] = entry
+        return entry
+
+    def get(self,
+            service: str,
+            region: Optional[str] = None,
+            role_arn: Optional[str] = None):
+        """Get a cached client, creating or refreshing it if needed."""
+        key = (role_arn or None, region, service)
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None and not self._expired(entry[1]):
+                return entry[0]
+            session, expiration = self._session(region, role_arn)
+            client = session.client(service)
+            if self.throttle:
+                client = ThrottledClient(client, service)
+            self._clients[key] = (client, expiration)
+            return client
+
+    def _throttled_clients(self) -> List[ThrottledClient]:
+        with self._lock:
+            return [client for client, _ in self._clients.values()
+                    if isinstance(client, ThrottledClient)]
+
+    def new_tick(self) -> None:
+        """Forget memoized responses and reset call counters."""
+        for client in self._throttled_clients():
+            client.reset()
+            client.stats.clear()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Call, throttle, retry and memo hit counts by API for the tick."""
+        return summarize(self._throttled_clients())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+            self._clients.clear()
+
+
+pool = ClientPool()
+
+_local = threading.local()
+
+
+@contextmanager
+def use_pool(client_pool: ClientPool):
+    """Temporarily route all client proxies to another pool."""
+    global pool  # pylint: disable=global-statement
+    previous = pool
+    pool = client_pool
+    try:
+        yield client_pool
+    finally:
+        pool = previous
+
+
+def current_scope() -> Tuple[Optional[str], Optional[str]]:
+    """The (region, role ARN) the current thread is operating in."""
+    return getattr(_local, "scope", (None, None))
+
+
+@contextmanager
+def scope(region: Optional[str] = None, role_arn: Optional[str] = None):
+    """Route all client proxies in this thread to a region and role."""
+    previous = current_scope()
+    _local.scope = (region, role_arn)
+    try:
+        yield
+    finally:
+        _local.scope = previous
+
+
+def bind_scope(func: Callable) -> Callable:
+    """
+    Bind a function to the current scope, so that it uses the same region and
+    role when it is run in another thread.
+    """
+    region, role_arn = current_scope()
+
+    def wrapped(*args, **kwargs):
+        with scope(region, role_arn):
+            return func(*args, **kwargs)
+    return wrapped
+
+
+class ClientProxy:
+    """
+    Stands in for a boto3 client and forwards to the pooled client of the
+    current scope.
+    """
+
+    def __init__(self, service: str, client_pool: ClientPool = None) -> None:
+        self._service = service
+        self._pool = client_pool
+
+    @property
+    def client(self):
+        client_pool = self._pool or pool
+        region, role_arn = current_scope()
+        return client_pool.get(self._service, region=region, role_arn=role_arn)
+
+    def __getattr__(self, name: str):
+        return getattr(self.client, name)
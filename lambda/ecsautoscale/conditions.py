@@ -0,0 +1,374 @@
+"""
+Windowed and composite conditions of scaling events.
+
+Besides comparing the current value of a metric to `min` / `max`, an event
+can aggregate the values of recent ticks, require its condition to hold for a
+number of ticks in a row, and combine conditions on several metrics:
+
+    events:
+      - metric: cpu_usage
+        aggregate: avg    # last (the default), avg, min, max, sum or rate.
+        window: 5         # The last 5 samples, or a duration like 10m.
+        min: 70
+        max: null
+        for: 3            # Ticks in a row the condition has to hold.
+        action: 1
+      - all:              # Or `any`. Conditions can be nested.
+          - {metric: queue_length, aggregate: rate, window: 10m, min: 5}
+          - {metric: cpu_usage, min: 50}
+        action: 2
+
+`rate` is the change per minute between the oldest and the newest sample in
+the window. Every full tick adds a sample of each windowed metric, and only as
+many samples as the longest window needs are kept in the state store, so
+windows are evaluated from memory instead of querying the metric sources for
+the whole window again. Plain events keep nothing.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from . import state
+from .exceptions import ConditionError
+from .schedules import parse_duration
+from .state import StateStore
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+AGGREGATES = ("last", "avg", "min", "max", "sum", "rate")
+
+# Most samples kept per metric, whatever the windows ask for.
+MAX_SAMPLES = int(os.environ.get("MAX_SAMPLES", "1440"))
+
+NAMESPACE = "conditions"
+
+# [Unix time, value], the value is `None` when the metric had no data.
+Sample = List[float]
+
+
+def aggregate(name: str, samples: List[Sample]) -> Optional[float]:
+    """
+    Aggregate samples, `None` when there are too few of them. Samples without
+    data are left out.
+    """
+    samples = [x for x in samples if x[1] is not None]
+    if not samples:
+        return None
+    values = [x[1] for x in samples]
+    if name == "last":
+        return values[-1]
+    if name == "avg":
+        return sum(values) / len(values)
+    if name == "min":
+        return min(values)
+    if name == "max":
+        return max(values)
+    if name == "sum":
+        return sum(values)
+    # rate
+    elapsed = samples[-1][0] - samples[0][0]
+    if len(samples) < 2 or elapsed <= 0:
+        return None
+    return (values[-1] - values[0]) / elapsed * 60
+
+
+class MetricHistory:
+    """
+    The current values and the recent samples of the metrics of a service.
+
+    Parameters
+    ----------
+    get_metric : Callable
+        Evaluates a metric expression against the current values.
+
+    samples : Dict[str, List[Sample]]
+        Samples by metric expression, oldest first.
+
+    now : float
+        The current Unix time.
+
+    """
+
+    def __init__(self,
+                 get_metric: Callable[[str], float],
+                 samples: Dict[str, List[Sample]],
+                 now: float) -> None:
+        self._get_metric = get_metric
+        self._current: Dict[str, float] = {}
+        self.samples = samples
+        self.now = now
+
+    def current(self, metric: str) -> float:
+        if metric not in self._current:
+            self._current[metric] = self._get_metric(metric)
+        return self._current[metric]
+
+    def window(self,
+               metric: str,
+               count: int = None,
+               seconds: float = None) -> List[Sample]:
+        """The last `count` samples, or those of the last `seconds`."""
+        samples = self.samples.get(metric, [])
+        if count is not None:
+            return samples[-count:]
+        start = len(samples)
+        while start > 0 and samples[start - 1][0] >= self.now - (seconds or 0):
+            start -= 1
+        return samples[start:]
+
+
+def _parse_window(value) -> Tuple[Optional[int], Optional[float]]:
+    """A number of samples or a duration, as (count, seconds)."""
+    if value is None:
+        return None, None
+    if isinstance(value, int) and not isinstance(value, bool):
+        if value < 1:
+            raise ValueError("Window {!r} is not positive".format(value))
+        return value, None
+    return None, parse_duration(value).total_seconds()
+
+
+class Condition:
+    """
+    A metric compared to `min` / `max`, or `all` / `any` of other conditions.
+
+    Parameters
+    ----------
+    item : dict
+        The event, or one of the conditions it combines.
+
+    """
+
+    def __init__(self, item: dict) -> None:
+        self.mode: Optional[str] = None
+        self.children: List[Condition] = []
+        for mode in ("all", "any"):
+            if mode in item:
+                self.mode = mode
+                self.children = [Condition(x) for x in item[mode]]
+                if not self.children:
+                    raise ValueError("No conditions in {!r}".format(mode))
+                return
+
+        self.metric = str(item["metric"])
+        self.min = item.get("min")
+        self.max = item.get("max")
+        self.count, self.seconds = _parse_window(item.get("window"))
+        self.aggregate = item.get("aggregate") or \
+            ("avg" if item.get("window") is not None else "last")
+        if self.aggregate not in AGGREGATES:
+            raise ValueError("Unknown aggregate {!r}".format(self.aggregate))
+        if self.count is None and self.seconds is None:
+            # A rate without a window is against the previous tick.
+            self.count = 2 if self.aggregate == "rate" else 1
+
+    @property
+    def windowed(self) -> bool:
+        return self.mode is None and self.aggregate != "last"
+
+    def leaves(self) -> Iterator["Condition"]:
+        if self.mode is None:
+            yield self
+        for child in self.children:
+            yield from child.leaves()
+
+    def value(self, history: MetricHistory) -> Optional[float]:
+        if not self.windowed:
+            return history.current(self.metric)
+        return aggregate(self.aggregate, history.window(
+            self.metric, self.count, self.seconds))
+
+    def holds(self, history: MetricHistory) -> bool:
+        if self.mode == "all":
+            return all(x.holds(history) for x in self.children)
+        if self.mode == "any":
+            return any(x.holds(history) for x in self.children)
+        value = self.value(history)
+        if value is None:
+            return False
+        if self.max is not None and value > self.max:
+            return False
+        if self.min is not None and value < self.min:
+            return False
+        return True
+
+    def describe(self, history: MetricHistory) -> str:
+        if self.mode is not None:
+            return "{:s}({:s})".format(self.mode, ", ".join(
+                x.describe(history) for x in self.children))
+        name = self.metric
+        if self.windowed:
+            if self.count is not None:
+                window = "{:d} samples".format(self.count)
+            else:
+                window = "{:g}s".format(self.seconds or 0)
+            name = "{:s}({:s}, {:s})".format(self.aggregate, name, window)
+        return "{:s} = {} [min {}, max {}]".format(
+            name, self.value(history), self.min, self.max)
+
+
+class Event:
+    """
+    A scaling event: a condition, how many ticks in a row it has to hold and
+    the action to take.
+
+    Parameters
+    ----------
+    item : dict
+        The event from the service definition.
+
+    """
+
+    def __init__(self, item: dict) -> None:
+        try:
+            self.condition = Condition(item)
+            self.action = int(item["action"])
+            self.ticks = int(item.get("for") or 1)
+        except (KeyError, TypeError, ValueError) as ex:
+            raise ConditionError(item, repr(ex)) from ex
+        raw = json.dumps(item, sort_keys=True, default=str)
+        self.key = hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+        self.windowed = [x for x in self.condition.leaves() if x.windowed]
+        # Position among the events of the service.
+        self.index = 0
+
+    @property
+    def plain(self) -> bool:
+        """Plain events only look at the current values."""
+        return self.ticks == 1 and not self.windowed
+
+    def describe(self, history: MetricHistory) -> str:
+        condition = self.condition
+        if self.plain and condition.mode is None:
+            return (" => Metric name:   {:s}\n"
+                    " => Current: {}\n"
+                    " => Min:     {}\n"
+                    " => Max:     {}"
+                    .format(condition.metric,
+                            history.current(condition.metric),
+                            condition.min, condition.max))
+        out = " => Condition: {:s}".format(condition.describe(history))
+        if self.ticks > 1:
+            out += "\n => For:       {:d} ticks".format(self.ticks)
+        return out
+
+
+# Parsed events by the JSON of their definition.
+_parsed: Dict[str, List[Event]] = {}
+
+
+def parse_events(events: List[dict], name: str = "") -> List[Event]:
+    """Parse the events of a service, skipping invalid ones."""
+    key = json.dumps(events, sort_keys=True, default=str)
+    if key in _parsed:
+        return _parsed[key]
+    out = []
+    for i, item in enumerate(events):
+        try:
+            event = Event(item)
+        except ConditionError as ex:
+            logger.error("%s Ignoring event:\n%s", name, ex)
+            continue
+        event.index = i
+        out.append(event)
+    _parsed[key] = out
+    return out
+
+
+class ServiceConditions:
+    """
+    Evaluates the events of a service, keeping the samples and the streaks
+    they need between ticks.
+
+    Parameters
+    ----------
+    cluster_name : str
+        The name of the cluster.
+
+    service_name : str
+        The name of the service.
+
+    events : List[dict]
+        The events of the service.
+
+    state_store : StateStore
+        Where samples and streaks are kept between ticks.
+
+    clock : Callable
+        Returns the current Unix time.
+
+    """
+
+    def __init__(self,
+                 cluster_name: str,
+                 service_name: str,
+                 events: List[dict],
+                 state_store: StateStore = None,
+                 clock: Callable = time.time) -> None:
+        self.key = "{:s}/{:s}".format(cluster_name, service_name or "")
+        self.events = parse_events(
+            events, "[Cluster: {:s}, Service: {:s}]"
+            .format(cluster_name, service_name or ""))
+        self.store = state_store or state.store
+        self.clock = clock
+        self.history: Optional[MetricHistory] = None
+
+    def _retention(self) -> Dict[str, Tuple[int, float]]:
+        """The samples and seconds to keep by metric."""
+        out: Dict[str, Tuple[int, float]] = {}
+        for event in self.events:
+            for leaf in event.windowed:
+                count, seconds = out.get(leaf.metric, (1, 0.0))
+                out[leaf.metric] = (max(count, leaf.count or 1),
+                                    max(seconds, leaf.seconds or 0.0))
+        return out
+
+    def evaluate(self,
+                 get_metric: Callable[[str], float],
+                 save: bool = True) -> List[Tuple[Event, bool]]:
+        """
+        Check the events against the current values and the samples of
+        earlier ticks. Returns every event along with whether it fires. With
+        `save`, the current values are kept as samples for the next ticks.
+        """
+        now = self.clock()
+        entry = self.store.get(NAMESPACE, self.key) or {}
+        if all(x.plain for x in self.events):
+            if entry and save:
+                # The events that needed samples are gone.
+                self.store.delete(NAMESPACE, self.key)
+            self.history = MetricHistory(get_metric, {}, now)
+            return [(x, x.condition.holds(self.history)) for x in self.events]
+
+        samples: Dict[str, List[Sample]] = {}
+        self.history = MetricHistory(get_metric, samples, now)
+        for metric, (count, seconds) in self._retention().items():
+            kept = list(entry.get("samples", {}).get(metric, []))
+            kept.append([now, self.history.current(metric)])
+            start = len(kept) - count
+            while start > 0 and kept[start - 1][0] >= now - seconds:
+                start -= 1
+            samples[metric] = kept[max(start, len(kept) - MAX_SAMPLES, 0):]
+
+        previous = entry.get("streaks", {})
+        streaks: Dict[str, int] = {}
+        out = []
+        for event in self.events:
+            held = event.condition.holds(self.history)
+            if event.ticks > 1:
+                streaks[event.key] = previous.get(event.key, 0) + 1 \
+                    if held else 0
+                held = streaks[event.key] >= event.ticks
+            out.append((event, held))
+
+        if save:
+            self.store.set(NAMESPACE, self.key,
+                           {"samples": samples, "streaks": streaks})
+        return out
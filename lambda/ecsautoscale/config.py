@@ -0,0 +1,272 @@
+"""
+Sources of cluster definitions.
+
+Cluster definitions are YAML documents, one per cluster, named after the
+cluster. They can be read from a local directory, an S3 prefix or an SSM
+Parameter Store path, chosen with `CLUSTER_DEFS_SOURCE`:
+
+- ``/path/to/clusters`` for a local directory,
+- ``s3://bucket/prefix/`` for S3 objects ending in ``.yml``,
+- ``ssm:/path/`` for parameters under a path.
+
+Every source first asks for cheap metadata (modification times, ETags or
+parameter versions) and only downloads and parses the definitions that
+changed. Parsed definitions are kept in memory, which survives between
+invocations of a warm Lambda container.
+"""
+
+import copy
+import logging
+import os
+import re
+import threading
+from typing import Dict, Optional, Tuple
+
+import yaml
+
+from . import s3_client, ssm_client
+from .exceptions import ConfigSourceError
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# Maximum number of parameters `get_parameters` accepts in one call.
+SSM_BATCH_SIZE = 10
+
+
+def parse_yaml(raw: str) -> dict:
+    """Parse a YAML cluster definition, replacing `%(ENV_VAR)` references."""
+    for match, env_var in re.findall(r"(%\(([A-Za-z_]+)\))", raw):
+        raw = raw.replace(match, os.environ[env_var])
+    return yaml.safe_load(raw)
+
+
+def load_yaml(path: str) -> dict:
+    """Load a YAML file into a dict object."""
+    with open(path, "r", encoding="utf-8") as yamlfile:
+        return parse_yaml(yamlfile.read())
+
+
+class ConfigSource:
+    """
+    Base class of cluster definition sources.
+
+    Subclasses implement `versions`, which lists the available definitions
+    with a token that changes whenever a definition changes, and `read`,
+    which downloads the definitions that changed.
+    """
+
+    name = "config"
+
+    def __init__(self) -> None:
+        # Cluster name -> (version, parsed definition)
+        self._cache: Dict[str, Tuple[str, dict]] = {}
+        self._lock = threading.Lock()
+
+    def versions(self) -> Dict[str, str]:
+        raise NotImplementedError
+
+    def read(self, versions: Dict[str, str]) -> Dict[str, str]:
+        """Return the raw definitions of the given clusters."""
+        raise NotImplementedError
+
+    def load(self) -> Dict[str, dict]:
+        """
+        Load all cluster definitions, only fetching the ones that changed.
+        If the source cannot be reached, the last definitions loaded are used.
+        """
+        with self._lock:
+            try:
+                self._refresh()
+            except Exception as ex:  # pylint: disable=broad-except
+                if not self._cache:
+                    raise ConfigSourceError(self.name, ex) from ex
+                logger.warning(
+                    "Could not refresh cluster definitions from %s, using "
+                    "the last ones loaded: %s", self.name, ex,
+                )
+
+            # Callers are free to modify what they get.
+            return {
+                cluster_name: copy.deepcopy(data)
+                for cluster_name, (_, data) in self._cache.items()
+            }
+
+    def _refresh(self) -> None:
+        versions = self.versions()
+        changed = {
+            cluster_name: version
+            for cluster_name, version in versions.items()
+            if self._cache.get(cluster_name, (None,))[0] != version
+        }
+        if changed:
+            logger.info(
+                "Fetching cluster definitions from %s: %s",
+                self.name, ", ".join(sorted(changed)),
+            )
+            raw = self.read(changed)
+            for cluster_name, version in changed.items():
+                self._cache[cluster_name] = \
+                    (version, parse_yaml(raw[cluster_name]))
+
+        for cluster_name in list(self._cache):
+            if cluster_name not in versions:
+                del self._cache[cluster_name]
+
+
+class LocalSource(ConfigSource):
+    """
+    Cluster definitions in a local directory.
+
+    Parameters
+    ----------
+    path : str
+        The directory holding the ``.yml`` files.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        self.name = path
+
+    def versions(self) -> Dict[str, str]:
+        out = {}
+        for fname in os.listdir(self.path):
+            if not fname.endswith(".yml"):
+                continue
+            stat = os.stat(os.path.join(self.path, fname))
+            cluster_name = os.path.splitext(fname)[0]
+            out[cluster_name] = "{:d}:{:d}".format(stat.st_mtime_ns,
+                                                   stat.st_size)
+        return out
+
+    def read(self, versions: Dict[str, str]) -> Dict[str, str]:
+        out = {}
+        for cluster_name in versions:
+            path = os.path.join(self.path, cluster_name + ".yml")
+            with open(path, "r", encoding="utf-8") as yamlfile:
+                out[cluster_name] = yamlfile.read()
+        return out
+
+
+class S3Source(ConfigSource):
+    """
+    Cluster definitions stored as ``.yml`` objects under an S3 prefix. A
+    single listing gives the ETag of every object.
+
+    Parameters
+    ----------
+    bucket : str
+        The name of the bucket.
+
+    prefix : str
+        The key prefix, e.g. ``ecs-autoscale/clusters/``.
+
+    """
+
+    def __init__(self, bucket: str, prefix: str = "") -> None:
+        super().__init__()
+        self.bucket = bucket
+        self.prefix = prefix
+        self.name = "s3://{:s}/{:s}".format(bucket, prefix)
+        self._keys: Dict[str, str] = {}
+
+    def versions(self) -> Dict[str, str]:
+        out = {}
+        kwargs = {"Bucket": self.bucket, "Prefix": self.prefix}
+        while True:
+            res = s3_client.list_objects_v2(**kwargs)
+            for item in res.get("Contents", []):
+                key = item["Key"]
+                fname = key[len(self.prefix):]
+                if "/" in fname or not fname.endswith(".yml"):
+                    continue
+                cluster_name = os.path.splitext(fname)[0]
+                self._keys[cluster_name] = key
+                out[cluster_name] = item["ETag"]
+            if not res.get("IsTruncated"):
+                break
+            kwargs["ContinuationToken"] = res["NextContinuationToken"]
+        return out
+
+    def read(self, versions: Dict[str, str]) -> Dict[str, str]:
+        out = {}
+        for cluster_name in versions:
+            res = s3_client.get_object(Bucket=self.bucket,
+                                       Key=self._keys[cluster_name])
+            out[cluster_name] = res["Body"].read().decode("utf-8")
+        return out
+
+
+class SSMSource(ConfigSource):
+    """
+    Cluster definitions stored as SSM parameters directly under a path, e.g.
+    ``/ecs-autoscale/clusters/my-cluster``. Describing the parameters gives
+    their versions without their values.
+
+    Parameters
+    ----------
+    path : str
+        The parameter path.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path.rstrip("/") + "/"
+        self.name = "ssm:" + self.path
+
+    def versions(self) -> Dict[str, str]:
+        out = {}
+        kwargs = {"ParameterFilters": [
+            {"Key": "Path", "Option": "OneLevel", "Values": [self.path[:-1]]},
+        ]}
+        while True:
+            res = ssm_client.describe_parameters(**kwargs)
+            for item in res["Parameters"]:
+                cluster_name = item["Name"][len(self.path):]
+                out[cluster_name] = str(item["Version"])
+            if not res.get("NextToken"):
+                break
+            kwargs["NextToken"] = res["NextToken"]
+        return out
+
+    def read(self, versions: Dict[str, str]) -> Dict[str, str]:
+        out = {}
+        names = [self.path + cluster_name for cluster_name in versions]
+        for i in range(0, len(names), SSM_BATCH_SIZE):
+            res = ssm_client.get_parameters(Names=names[i:i + SSM_BATCH_SIZE],
+                                            WithDecryption=True)
+            for item in res["Parameters"]:
+                out[item["Name"][len(self.path):]] = item["Value"]
+        missing = set(versions) - set(out)
+        if missing:
+            raise KeyError(", ".join(sorted(missing)))
+        return out
+
+
+def source_from_uri(uri: str) -> ConfigSource:
+    """Create the source for a ``s3://``, ``ssm:`` or local path."""
+    if uri.startswith("s3://"):
+        bucket, _, prefix = uri[len("s3://"):].partition("/")
+        return S3Source(bucket, prefix)
+    if uri.startswith("ssm:"):
+        return SSMSource(uri[len("ssm:"):])
+    return LocalSource(uri)
+
+
+_sources: Dict[str, ConfigSource] = {}
+
+
+def get_config_source(uri: Optional[str], default_path: str) -> ConfigSource:
+    """
+    Get the source for `uri`, falling back to `default_path`. Sources are
+    reused so that their cache carries over between invocations.
+    """
+    uri = uri or default_path
+    if uri not in _sources:
+        _sources[uri] = source_from_uri(uri)
+    return _sources[uri]
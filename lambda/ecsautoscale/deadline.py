@@ -0,0 +1,74 @@
+"""
+Time budget for a single invocation.
+
+The budget is taken from the remaining time of the Lambda invocation, minus
+a safety margin, or from `TICK_BUDGET_SECONDS` when not running on Lambda.
+Phases of a tick take slices of whatever is left, so that one slow metric
+endpoint cannot starve the rest of the tick.
+"""
+
+import logging
+import os
+import time
+from typing import Callable
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# Budget used when there is no Lambda context.
+TICK_BUDGET_SECONDS = float(os.environ.get("TICK_BUDGET_SECONDS", "60"))
+
+# Time kept in reserve to wrap up, e.g. persist state, before Lambda kills us.
+SAFETY_MARGIN_SECONDS = float(os.environ.get("DEADLINE_SAFETY_MARGIN", "2"))
+
+# Share of the remaining time given to collecting metrics.
+METRICS_FRACTION = float(os.environ.get("METRICS_TIME_FRACTION", "0.5"))
+
+# Don't start scaling a cluster with less time than this left.
+MIN_CLUSTER_SECONDS = float(os.environ.get("MIN_CLUSTER_SECONDS", "1"))
+
+
+class Deadline:
+    """
+    A point in time by which the tick has to be done.
+
+    Parameters
+    ----------
+    seconds : float
+        Seconds from now.
+
+    clock : Callable
+        Returns the current time in seconds.
+
+    """
+
+    def __init__(self,
+                 seconds: float,
+                 clock: Callable = time.monotonic) -> None:
+        self.clock = clock
+        self.expires = clock() + seconds
+
+    @classmethod
+    def from_context(cls, context, budget: float = None) -> "Deadline":
+        """Create a deadline from a Lambda context, or a fixed budget."""
+        get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+        if budget is None and callable(get_remaining):
+            seconds = get_remaining() / 1000.0 - SAFETY_MARGIN_SECONDS
+        else:
+            seconds = budget if budget is not None else TICK_BUDGET_SECONDS
+        return cls(max(seconds, 0.0))
+
+    def remaining(self) -> float:
+        return max(self.expires - self.clock(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def slice(self, fraction: float, maximum: float = None) -> float:
+        """A share of the remaining time, capped at `maximum` seconds."""
+        seconds = self.remaining() * fraction
+        if maximum is not None:
+            seconds = min(seconds, maximum)
+        return seconds
@@ -0,0 +1,182 @@
+"""
+Parses the events the Lambda function is invoked with into the clusters and
+services that need to be evaluated.
+
+Supported events:
+
+- Scheduled events (or anything unrecognized): evaluate everything.
+- The string ``"TEST_RUN"``: evaluate everything without scaling.
+- Explicit payloads: ``{"cluster": ..., "service": ...}`` or
+  ``{"cluster": ..., "services": [...]}``, optionally with
+  ``"test_run": true``.
+- EventBridge "CloudWatch Alarm State Change" events. The alarm is matched to
+  a service through the ``ClusterName`` / ``ServiceName`` dimensions of its
+  metrics or through the ``alarms`` list of a service in the cluster
+  definition.
+- EventBridge "ECS Task State Change" events.
+- EventBridge "ECS Container Instance State Change" events: no services are
+  evaluated, but the staged service updates of the cluster are released if
+  new capacity has registered (see `ecsautoscale.staging`).
+- SQS events whose message bodies are explicit payloads.
+
+Any event that is a dict can also carry ``"profile": true`` to profile the
+invocation (see `ecsautoscale.profiling`).
+"""
+
+import json
+import logging
+from typing import Dict, List, Optional, Set
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class Target:
+    """
+    A cluster to evaluate.
+
+    Parameters
+    ----------
+    cluster_name : str
+        The name of the cluster.
+
+    service_names : Set[str]
+        The services to evaluate, or `None` for all of them.
+
+    """
+
+    def __init__(self, cluster_name: str,
+                 service_names: Set[str] = None) -> None:
+        self.cluster_name = cluster_name
+        self.service_names = service_names
+
+    def merge(self, other: "Target") -> None:
+        if self.service_names is None or other.service_names is None:
+            self.service_names = None
+        else:
+            self.service_names |= other.service_names
+
+    def __repr__(self) -> str:
+        return "Target({!r}, {!r})".format(self.cluster_name,
+                                           self.service_names)
+
+
+def is_test_run(event) -> bool:
+    if event == "TEST_RUN":
+        return True
+    return isinstance(event, dict) and bool(event.get("test_run"))
+
+
+def is_profile_run(event) -> bool:
+    return isinstance(event, dict) and bool(event.get("profile"))
+
+
+def _name_from_arn(arn: str) -> str:
+    return arn.split("/")[-1]
+
+
+def _dimensions(metric: dict) -> Dict[str, str]:
+    dimensions = metric.get("metricStat", {}).get("metric", {}) \
+        .get("dimensions", {})
+    if isinstance(dimensions, list):
+        return {x["name"]: x["value"] for x in dimensions}
+    return dimensions
+
+
+def _alarm_targets(detail: dict, cluster_defs: dict) -> List[Target]:
+    alarm_name = detail.get("alarmName")
+    targets = []
+
+    # Services that list the alarm explicitly.
+    for cluster_name, cluster_def in cluster_defs.items():
+        services = cluster_def.get("services", {})
+        for service_name, service_def in services.items():
+            if alarm_name in service_def.get("alarms", []):
+                targets.append(Target(cluster_name, {service_name}))
+
+    # Alarms on ECS metrics carry the cluster and service as dimensions.
+    for metric in detail.get("configuration", {}).get("metrics", []):
+        dimensions = _dimensions(metric)
+        cluster_name = dimensions.get("ClusterName")
+        if cluster_name is None or cluster_name not in cluster_defs:
+            continue
+        service_name = dimensions.get("ServiceName")
+        targets.append(Target(cluster_name,
+                              {service_name} if service_name else None))
+
+    return targets
+
+
+def _explicit_targets(payload: dict) -> List[Target]:
+    services = payload.get("services")
+    if services is None and payload.get("service"):
+        services = [payload["service"]]
+    return [Target(payload["cluster"],
+                   set(services) if services is not None else None)]
+
+
+def _parse(event, cluster_defs: dict) -> Optional[List[Target]]:
+    if not isinstance(event, dict):
+        return None
+
+    if "cluster" in event:
+        return _explicit_targets(event)
+
+    if "Records" in event:
+        targets: List[Target] = []
+        for record in event["Records"]:
+            if record.get("eventSource") != "aws:sqs":
+                continue
+            try:
+                payload = json.loads(record["body"])
+            except (KeyError, TypeError, ValueError) as ex:
+                logger.warning("Ignoring SQS record %s: %s",
+                               record.get("messageId"), ex)
+                continue
+            if isinstance(payload, dict) and "cluster" in payload:
+                targets += _explicit_targets(payload)
+        return targets
+
+    detail_type = event.get("detail-type")
+    detail = event.get("detail", {})
+    if detail_type == "CloudWatch Alarm State Change":
+        return _alarm_targets(detail, cluster_defs)
+
+    if detail_type == "ECS Task State Change":
+        group = detail.get("group", "")
+        if not group.startswith("service:"):
+            return []
+        return [Target(_name_from_arn(detail["clusterArn"]),
+                       {group[len("service:"):]})]
+
+    if detail_type == "ECS Container Instance State Change":
+        if detail.get("status") != "ACTIVE":
+            return []
+        return [Target(_name_from_arn(detail["clusterArn"]), set())]
+
+    return None
+
+
+def parse_event(event, cluster_defs: dict) -> Optional[List[Target]]:
+    """
+    Resolve an event into the targets to evaluate. Returns `None` when every
+    cluster should be evaluated.
+    """
+    targets = _parse(event, cluster_defs)
+    if targets is None:
+        return None
+
+    merged: Dict[str, Target] = {}
+    for target in targets:
+        if target.cluster_name not in cluster_defs:
+            logger.warning(
+                "[Cluster: %s] No cluster definition, ignoring event",
+                target.cluster_name,
+            )
+            continue
+        if target.cluster_name in merged:
+            merged[target.cluster_name].merge(target)
+        else:
+            merged[target.cluster_name] = target
+    return list(merged.values())
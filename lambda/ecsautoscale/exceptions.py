@@ -64,3 +64,89 @@ class ThirdPartyError(Error):
             " => URL: {:s}\n"\
             .format(status_code, url)
         super(ThirdPartyError, self).__init__(message)
+
+
+class PrometheusError(Error):
+    """Error raised when a Prometheus query fails or returns no data."""
+
+    def __init__(self, url, query, reason):
+        self.url = url
+        self.query = query
+        self.reason = reason
+        message = \
+            "Error evaluating Prometheus query:\n"\
+            " => URL:    {:s}\n"\
+            " => Query:  {:s}\n"\
+            " => Reason: {}"\
+            .format(url, query, reason)
+        super(PrometheusError, self).__init__(message)
+
+
+class QueueDepthError(Error):
+    """Error raised when the depth of a queue cannot be read."""
+
+    def __init__(self, queue, reason):
+        self.queue = queue
+        self.reason = reason
+        message = \
+            "Error reading queue depth:\n"\
+            " => Queue:  {:s}\n"\
+            " => Reason: {}"\
+            .format(queue, reason)
+        super(QueueDepthError, self).__init__(message)
+
+
+class ConfigSourceError(Error):
+    """Error raised when cluster definitions cannot be loaded."""
+
+    def __init__(self, source, reason):
+        self.source = source
+        self.reason = reason
+        message = \
+            "Error loading cluster definitions:\n"\
+            " => Source: {:s}\n"\
+            " => Reason: {}"\
+            .format(source, reason)
+        super(ConfigSourceError, self).__init__(message)
+
+
+class ReplayMissError(Error):
+    """Error raised when a replayed call is not in the recording."""
+
+    def __init__(self, call, recording):
+        self.call = call
+        self.recording = recording
+        message = \
+            "Error replaying call:\n"\
+            " => Call:      {:s}\n"\
+            " => Recording: {:s}"\
+            .format(call, recording)
+        super(ReplayMissError, self).__init__(message)
+
+
+class ScheduleError(Error):
+    """Error raised when a scheduled capacity profile is invalid."""
+
+    def __init__(self, schedule, reason):
+        self.schedule = schedule
+        self.reason = reason
+        message = \
+            "Error parsing schedule:\n"\
+            " => Schedule: {:s}\n"\
+            " => Reason:   {}"\
+            .format(schedule, reason)
+        super(ScheduleError, self).__init__(message)
+
+
+class ConditionError(Error):
+    """Error raised when the condition of a scaling event is invalid."""
+
+    def __init__(self, event, reason):
+        self.event = event
+        self.reason = reason
+        message = \
+            "Error parsing event condition:\n"\
+            " => Event:  {}\n"\
+            " => Reason: {}"\
+            .format(event, reason)
+        super(ConditionError, self).__init__(message)
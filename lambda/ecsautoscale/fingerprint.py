@@ -0,0 +1,172 @@
+"""
+Fingerprints the inputs of a cluster so that clusters whose inputs have not
+changed since the last tick can be skipped.
+
+A fingerprint covers everything a scaling decision depends on: the cluster
+definition, the running count and task definition of every service, which
+side of each event's thresholds the event metric falls on, the remaining
+resources of every instance and the autoscaling group's capacity settings.
+When the fingerprint matches the previous tick and that tick did nothing,
+the decision would be "do nothing" again, so the cluster is skipped. Every
+`FULL_EVALUATION_EVERY` ticks a full evaluation is forced regardless.
+
+The fingerprint is built from the same describe calls and metrics as the
+decision itself, so those still run on every tick. What a skipped cluster
+saves is the placement simulation of its instances and the scale-out and
+drain decisions.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import List, Union
+
+from . import state
+from .state import StateStore
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+FULL_EVALUATION_EVERY = int(os.environ.get("FULL_EVALUATION_EVERY", "6"))
+
+NAMESPACE = "fingerprints"
+
+
+def _metric_bucket(service, event: dict) -> Union[int, list, None]:
+    """
+    Which side of the event thresholds the metric is on: -1 below `min`, 1
+    above `max` and 0 within. Exact values within a bucket do not change the
+    decision. Composite `all` / `any` events have a bucket per condition.
+    """
+    # pylint: disable=broad-except
+    for mode in ("all", "any"):
+        if mode in event:
+            return [_metric_bucket(service, x) for x in event[mode]]
+    try:
+        metric = service.get_metric(event["metric"])
+    except Exception:
+        return None
+    if metric is None:
+        return None
+    if event.get("min") is not None and metric < event["min"]:
+        return -1
+    if event.get("max") is not None and metric > event["max"]:
+        return 1
+    return 0
+
+
+class ClusterFingerprint:
+    """
+    Collects the inputs of a single cluster for one tick.
+
+    Parameters
+    ----------
+    cluster_name : str
+        The name of the cluster.
+
+    cluster_def : dict
+        The cluster definition.
+
+    state_store : StateStore
+        Where fingerprints of previous ticks are kept.
+
+    full_evaluation_every : int
+        Force a full evaluation after this many consecutive skipped ticks.
+
+    """
+
+    def __init__(self,
+                 cluster_name: str,
+                 cluster_def: dict,
+                 state_store: StateStore = None,
+                 full_evaluation_every: int = None) -> None:
+        self.cluster_name = cluster_name
+        self.store = state_store or state.store
+        self.full_evaluation_every = full_evaluation_every or \
+            cluster_def.get("full_evaluation_every", FULL_EVALUATION_EVERY)
+        self._parts: List = [
+            json.dumps(cluster_def, sort_keys=True, default=str),
+        ]
+        self._has_pending_work = False
+
+    def add_service(self, service) -> None:
+        """Add a service, after its scaling decision has been computed."""
+        if service.task_diff:
+            self._has_pending_work = True
+        self._parts.append([
+            "service",
+            service.service_name,
+            service.task_name,
+            service.task_count,
+            service.desired_count,
+            service.pending_count,
+            [_metric_bucket(service, event) for event in service.events],
+        ])
+
+    def add_cluster(self, cluster_data: dict, asg_group_data: dict) -> None:
+        active = \
+            cluster_data["active_container_described"]["containerInstances"]
+        draining = \
+            cluster_data["draining_container_described"]["containerInstances"]
+        self._parts.append([
+            "asg",
+            asg_group_data["DesiredCapacity"],
+            asg_group_data["MinSize"],
+            asg_group_data["MaxSize"],
+        ])
+        for instance in active:
+            self._parts.append([
+                "active",
+                instance["ec2InstanceId"],
+                sorted((x["name"], x.get("integerValue"))
+                       for x in instance["remainingResources"]),
+                instance["runningTasksCount"],
+                instance["pendingTasksCount"],
+            ])
+        for instance in draining:
+            self._parts.append([
+                "draining",
+                instance["ec2InstanceId"],
+                instance["runningTasksCount"],
+            ])
+            # Empty draining instances get terminated, which is an action.
+            if not instance["runningTasksCount"]:
+                self._has_pending_work = True
+
+    def digest(self) -> str:
+        raw = json.dumps(self._parts, sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def unchanged(self) -> bool:
+        """
+        Check if the previous decision can be reused, i.e. no service needs
+        to scale, the inputs are the same as last tick, last tick did nothing,
+        and a full evaluation isn't due.
+        """
+        if self._has_pending_work:
+            return False
+        previous = self.store.get(NAMESPACE, self.cluster_name)
+        if not previous or previous["digest"] != self.digest():
+            return False
+        if previous["acted"]:
+            return False
+        if previous["skipped"] >= self.full_evaluation_every:
+            logger.info(
+                "[Cluster: %s] Forcing full evaluation after %d skipped ticks",
+                self.cluster_name, previous["skipped"],
+            )
+            return False
+        return True
+
+    def record(self, acted: bool, skipped: bool = False) -> None:
+        """Remember the fingerprint of this tick and whether we acted."""
+        acted = acted or self._has_pending_work
+        previous = self.store.get(NAMESPACE, self.cluster_name) or {}
+        self.store.set(NAMESPACE, self.cluster_name, {
+            "digest": self.digest(),
+            "acted": acted,
+            "skipped": previous.get("skipped", 0) + 1 if skipped else 0,
+        })
@@ -0,0 +1,160 @@
+"""
+Headroom: capacity kept free on the instances of a cluster, so that new tasks
+start right away instead of waiting for an instance to launch.
+
+    cpu_buffer: 512       # Room for one more task of this size.
+    mem_buffer: 1024
+    headroom:
+      cpu_percent: 20     # Keep 20% of the registered CPU unreserved.
+      mem_percent: 10     # Same for memory.
+    services:
+      backend:
+        warm_spares: 3    # Room for 3 more `backend` tasks.
+      worker:
+        idle: {metric: queue_length, wake: 2, warm: true}
+                          # Room for 1 `worker` task while it is idle.
+
+Warm spares are placed like real tasks of their service, so they honor its
+placement constraints, and never exceed what the service could still scale
+out to. Percentages are of all the registered resources of the cluster, and
+count the free resources left after the tasks that services need, the warm
+spares and the buffer have been placed.
+
+Headroom is enforced in both directions: the cluster scales up when it cannot
+be kept, and an instance is only drained when it can still be kept without
+that instance.
+"""
+
+import logging
+from typing import List, Optional, Tuple
+
+from .placement import PlacementSimulator, TaskRequirements
+from .services import Service, get_task_instances
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# (service name, requirements, count), the service name is `None` for the
+# buffer.
+Block = Tuple[Optional[str], TaskRequirements, int]
+
+
+class Headroom:
+    """
+    The headroom to keep on a cluster.
+
+    Parameters
+    ----------
+    blocks : List[Block]
+        Tasks to keep room for.
+
+    cpu_percent : float
+        Share of the registered CPU to keep unreserved, in percent.
+
+    mem_percent : float
+        Share of the registered memory to keep unreserved, in percent.
+
+    services : List[Service]
+        The services with warm spares.
+
+    """
+
+    def __init__(self,
+                 blocks: List[Block] = None,
+                 cpu_percent: float = 0.0,
+                 mem_percent: float = 0.0,
+                 services: List[Service] = None) -> None:
+        self.blocks = blocks or []
+        self.cpu_percent = cpu_percent
+        self.mem_percent = mem_percent
+        self.services = services or []
+
+    @classmethod
+    def from_cluster_def(cls,
+                         cluster_def: dict,
+                         services: List[Service]) -> "Headroom":
+        """The headroom of a cluster, with warm spares for `services`."""
+        blocks: List[Block] = []
+        spare_services = []
+        for service in services:
+            if service.service_name is None or service.fargate:
+                continue
+            service_def = cluster_def["services"].get(service.service_name, {})
+            wanted = int(service_def.get("warm_spares") or 0)
+            if service.idle and not service.task_diff and \
+                    service.idle_def.get("warm"):
+                # Room for the first task of an idle service.
+                wanted = max(wanted, 1)
+            after = service.desired_tasks if service.task_diff else \
+                service.desired_count
+            count = min(wanted, max(service.max_tasks - after, 0))
+            if count <= 0:
+                continue
+            service.load_task_definition()
+            if service.fargate:
+                continue
+            if service.requirements.distinct_instance and \
+                    not service.task_instance_arns:
+                service.task_instance_arns = get_task_instances(
+                    service.cluster_name, service.service_name)
+            blocks.append((service.service_name, service.requirements, count))
+            spare_services.append(service)
+
+        if cluster_def.get("cpu_buffer", 0) > 0 or \
+                cluster_def.get("mem_buffer", 0) > 0:
+            blocks.append((None, TaskRequirements(
+                cpu=cluster_def.get("cpu_buffer", 0),
+                mem=cluster_def.get("mem_buffer", 0),
+            ), 1))
+
+        rules = cluster_def.get("headroom") or {}
+        return cls(blocks,
+                   cpu_percent=float(rules.get("cpu_percent") or 0),
+                   mem_percent=float(rules.get("mem_percent") or 0),
+                   services=spare_services)
+
+    @property
+    def empty(self) -> bool:
+        return not self.blocks and not self.cpu_percent and \
+            not self.mem_percent
+
+    def describe(self) -> str:
+        lines = []
+        for service_name, requirements, count in self.blocks:
+            if service_name is None:
+                lines.append(" => Buffer: {:d} CPU units, {:d} MB".format(
+                    requirements.cpu, requirements.mem))
+            else:
+                lines.append(" => Warm spares: {:d} tasks of {:s}".format(
+                    count, service_name))
+        if self.cpu_percent:
+            lines.append(" => Spare CPU: {:g}%".format(self.cpu_percent))
+        if self.mem_percent:
+            lines.append(" => Spare memory: {:g}%".format(self.mem_percent))
+        return "\n".join(lines)
+
+    def reserve(self, simulator: PlacementSimulator) -> Optional[str]:
+        """
+        Keep the headroom free on `simulator`, after the tasks services need
+        have been placed. Returns why it cannot be kept, or `None`.
+        """
+        for service_name, requirements, count in self.blocks:
+            placed = simulator.place_many(requirements, count, service_name)
+            if placed < count:
+                return "room for {:d} more tasks of {:s}, only {:d} fit" \
+                    .format(count, service_name or "the buffer", placed)
+
+        for name, percent, free, total in (
+                ("CPU", self.cpu_percent,
+                 sum(x.cpu for x in simulator.instances),
+                 sum(x.registered_cpu for x in simulator.instances)),
+                ("memory", self.mem_percent,
+                 sum(x.mem for x in simulator.instances),
+                 sum(x.registered_mem for x in simulator.instances)),
+        ):
+            if percent and total and free * 100 < percent * total:
+                return "{:g}% spare {:s}, only {:.1f}% left".format(
+                    percent, name, 100.0 * free / total)
+        return None
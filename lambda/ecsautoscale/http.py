@@ -0,0 +1,45 @@
+"""Shared HTTP session used by metric sources."""
+
+from contextlib import contextmanager
+import threading
+
+import requests
+from requests.adapters import BaseAdapter
+
+
+_local = threading.local()
+
+# Transport adapter mounted on new sessions instead of the default one, see
+# `use_adapter`. Bumping the generation makes threads start new sessions.
+_adapter = None
+_generation = 0
+
+
+def get_session() -> requests.Session:
+    """
+    Get the HTTP session of the current thread. Sessions keep connections
+    alive, so repeated requests to the same host don't reconnect.
+    """
+    session = getattr(_local, "session", None)
+    if session is None or getattr(_local, "generation", None) != _generation:
+        session = requests.Session()
+        if _adapter is not None:
+            session.mount("http://", _adapter)
+            session.mount("https://", _adapter)
+        _local.session = session
+        _local.generation = _generation
+    return session
+
+
+@contextmanager
+def use_adapter(adapter: BaseAdapter):
+    """Temporarily send all requests through another transport adapter."""
+    global _adapter, _generation  # pylint: disable=global-statement
+    previous = _adapter
+    _adapter = adapter
+    _generation += 1
+    try:
+        yield adapter
+    finally:
+        _adapter = previous
+        _generation += 1
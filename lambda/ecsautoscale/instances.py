@@ -1,10 +1,13 @@
 """Handles scaling of EC2 instances within an ECS cluster."""
 
 import logging
-from typing import List, Tuple
+from typing import List
 
 from . import ecs_client, asg_client
+from .fingerprint import ClusterFingerprint
 from .exceptions import ClusterARNError, ASGGroupError, MissingResourceValueError
+from .headroom import Headroom
+from .placement import InstanceState, PlacementSimulator, instance_block
 from .services import Service
 
 
@@ -168,26 +171,99 @@ def get_mem_used(instance: dict) -> int:
     return mem_registered - get_mem_avail(instance)
 
 
-def place_task(instance_tuples: List[Tuple[int, int]],
-               cpu: int,
-               mem: int) -> Tuple[List[Tuple[int, int]], bool]:
-    for i, tup in enumerate(instance_tuples):
-        if tup[0] > cpu and tup[1] > mem:
-            instance_tuples[i] = (tup[0] - cpu, tup[1] - mem)
-            return instance_tuples, True
-    return instance_tuples, False
+def build_simulator(instances: List[dict],
+                    services: List[Service],
+                    headroom: Headroom = None) -> PlacementSimulator:
+    """
+    Create a placement simulator for the given container instances, aware of
+    where the tasks of services with a `distinctInstance` constraint run,
+    including the services with warm spares in `headroom`.
+    """
+    simulator = PlacementSimulator.from_container_instances(instances)
+    spare_services = [x for x in headroom.services
+                      if x not in services] if headroom is not None else []
+    for service in services + spare_services:
+        if service.task_instance_arns:
+            simulator.register_tasks(service.service_name,
+                                     service.task_instance_arns)
+    return simulator
+
+
+def count_launching_instances(cluster_data: dict,
+                              asg_group_data: dict) -> int:
+    """
+    Count the instances the autoscaling group is launching that have not
+    registered with the cluster yet. Instances in service or on standby that
+    never registered, e.g. because their agent is broken, are not launching.
+    """
+    registered = {
+        x["ec2InstanceId"]
+        for key in ("active_container_described",
+                    "draining_container_described")
+        for x in cluster_data[key]["containerInstances"]
+    }
+    if "Instances" not in asg_group_data:
+        return max(asg_group_data["DesiredCapacity"] - len(registered), 0)
+
+    pending = [x for x in asg_group_data["Instances"]
+               if x.get("LifecycleState", "").startswith("Pending")]
+    in_service = [x for x in asg_group_data["Instances"]
+                  if x.get("LifecycleState") == "InService"]
+    launching = sum(1 for x in pending if x["InstanceId"] not in registered)
+    # Capacity the group has not even created instances for yet.
+    requested = max(asg_group_data["DesiredCapacity"] - len(pending) -
+                    len(in_service), 0)
+    return launching + requested
+
+
+def get_launching_instances(cluster_data: dict,
+                            asg_group_data: dict) -> List[InstanceState]:
+    """
+    Model the instances that are still launching as empty copies of the
+    largest active instance, so that the capacity they bring is only asked
+    for once. Nothing can be modelled without an active instance.
+    """
+    active = cluster_data["active_container_described"]["containerInstances"]
+    count = count_launching_instances(cluster_data, asg_group_data)
+    if not active or not count:
+        return []
+    template = max(active, key=lambda x: (get_cpu_used(x) + get_cpu_avail(x),
+                                          get_mem_used(x) + get_mem_avail(x)))
+    return [InstanceState.launching(template, "launching-{:d}".format(i))
+            for i in range(count)]
+
+
+def add_instance(cluster_data: dict,
+                 cluster_def: dict,
+                 asg_group_data: dict,
+                 is_test_run: bool = False) -> None:
+    """Ask the autoscaling group for one more instance."""
+    desired_capacity = asg_group_data["DesiredCapacity"] + 1
+    logger.info(
+        "[Cluster: {:s}] Scaling cluster up to {} instances"
+        .format(cluster_data["cluster_name"], desired_capacity)
+    )
+    if not is_test_run:
+        asg_client.set_desired_capacity(
+            AutoScalingGroupName=cluster_def["autoscale_group"],
+            DesiredCapacity=desired_capacity,
+        )
 
 
 def scale_up(cluster_data: dict,
              cluster_def: dict,
              asg_group_data: dict,
              services: List[Service],
-             is_test_run: bool = False) -> bool:
+             is_test_run: bool = False,
+             headroom: Headroom = None) -> bool:
     """
     Check if cluster should scale up.
 
     We scale out when the services that need to scale cannot fit on the
-    existing instances.
+    existing instances, counting the instances that are still launching,
+    or when the `headroom` cannot be kept once they are placed.
+    Tasks that are pending already hold their resources on an instance,
+    tasks that ECS could not place yet are placed along with the new ones.
     """
     logger.info(
         "[Cluster: {:s}] Checking if we should scale up"
@@ -200,33 +276,42 @@ def scale_up(cluster_data: dict,
         )
         return False
 
-    instances = [
-        (get_cpu_avail(x), get_mem_avail(x)) for x in
-        cluster_data["active_container_described"]["containerInstances"]
-    ]
+    simulator = build_simulator(
+        cluster_data["active_container_described"]["containerInstances"],
+        services,
+        headroom,
+    )
+    launching = get_launching_instances(cluster_data, asg_group_data)
+    if launching:
+        logger.info(
+            "[Cluster: {:s}] Counting {:d} instances that are still launching"
+            .format(cluster_data["cluster_name"], len(launching))
+        )
+        simulator.instances.extend(launching)
+
     for service in services:
-        if service.task_diff <= 0:
+        if service.tasks_to_place <= 0:
             continue
-        for _ in range(service.task_diff):
-            # Try and place task.
-            instances, placeable = place_task(instances, service.task_cpu,
-                                              service.task_mem)
-            if placeable:
-                continue
-
-            # If we can't place the task, need to scale up.
-            desired_capacity = asg_group_data["DesiredCapacity"] + 1
-            logger.info(
-                "[Cluster: {:s}] Scaling cluster up to {} instances"
-                .format(cluster_data["cluster_name"], desired_capacity)
-            )
-            if not is_test_run:
-                asg_client.set_desired_capacity(
-                    AutoScalingGroupName=cluster_def["autoscale_group"],
-                    DesiredCapacity=desired_capacity,
-                )
+        # Try and place the new tasks.
+        placed = simulator.place_many(service.requirements,
+                                      service.tasks_to_place,
+                                      service.service_name)
+        if placed < service.tasks_to_place:
+            # If we can't place all of the tasks, need to scale up.
+            add_instance(cluster_data, cluster_def, asg_group_data,
+                         is_test_run=is_test_run)
             return True
 
+    reason = headroom.reserve(simulator) if headroom is not None else None
+    if reason is not None:
+        logger.info(
+            "[Cluster: %s] Not enough headroom: %s",
+            cluster_data["cluster_name"], reason,
+        )
+        add_instance(cluster_data, cluster_def, asg_group_data,
+                     is_test_run=is_test_run)
+        return True
+
     logger.info(
         "[Cluster: {:s}] Cluster is sufficiently sized, not scaling up"
         .format(cluster_data["cluster_name"])
@@ -242,55 +327,50 @@ def get_min_mem_instance(instances: List[dict]) -> dict:
     return min(instances, key=get_mem_used)
 
 
-def allocate_instances(desired_cpu: int,
-                       desired_mem: int,
-                       instance_tuples: List[Tuple[int, int]]) -> Tuple[List[Tuple[int, int]], bool]:
-    for i, item in enumerate(instance_tuples):
-        cpu, mem = item
-        if desired_cpu < cpu and desired_mem < mem:
-            instance_tuples[i] = (cpu - desired_cpu, mem - desired_mem)
-            return instance_tuples, True
-    return instance_tuples, False
-
-
 def place_instance(instance: dict,
                    instances: List[dict],
-                   services: List[Service]) -> bool:
+                   services: List[Service],
+                   draining: List[dict] = None,
+                   headroom: Headroom = None) -> bool:
     """
     Check if we can fit the memory and cpu reserved by this instance onto one
     of the other instances with enough room left over for any services that
-    need to scale out.
+    need to scale out, and the `headroom`. The tasks still running on
+    `draining` instances have to move too, so they are placed first.
     """
-    other_instances = [(get_cpu_avail(x), get_mem_avail(x)) for x in instances
+    other_instances = [x for x in instances
                        if x["ec2InstanceId"] != instance["ec2InstanceId"]]
     if not other_instances:
         return False
 
+    simulator = build_simulator(other_instances, services, headroom)
+    for draining_instance in draining or []:
+        if not draining_instance["runningTasksCount"]:
+            continue
+        if simulator.place(instance_block(draining_instance)) is None:
+            return False
+
     # First check if we can place the tasks on this instance onto another
     # instance.
-    cpu_needed = get_cpu_used(instance)
-    mem_needed = get_mem_used(instance)
-    other_instances, allocated = allocate_instances(
-        cpu_needed,
-        mem_needed,
-        other_instances)
-    if not allocated:
+    if simulator.place(instance_block(instance)) is None:
         return False
 
     # Now check if we still have room left for all of the services that need
     # to scale up.
     for service in services:
         # Ignore services that are scaling down.
-        if service.task_diff <= 0:
+        if service.tasks_to_place <= 0:
             continue
 
-        # Try and place task.
-        for _ in range(service.task_diff):
-            other_instances, placeable = place_task(
-                other_instances, service.task_cpu, service.task_mem
-            )
-            if not placeable:
-                return False
+        # Try and place tasks.
+        placed = simulator.place_many(service.requirements,
+                                      service.tasks_to_place,
+                                      service.service_name)
+        if placed < service.tasks_to_place:
+            return False
+
+    if headroom is not None and headroom.reserve(simulator) is not None:
+        return False
 
     # If we have gotten this far, all new tasks are placeable onto one of the
     # other instances.
@@ -300,7 +380,8 @@ def place_instance(instance: dict,
 def scale_down(cluster_data: dict,
                asg_group_data: dict,
                services: List[Service],
-               is_test_run: bool = False) -> bool:
+               is_test_run: bool = False,
+               headroom: Headroom = None) -> bool:
     """
     Check if cluster should scale down.
 
@@ -319,13 +400,23 @@ def scale_down(cluster_data: dict,
         )
         return False
 
+    if count_launching_instances(cluster_data, asg_group_data):
+        logger.info(
+            "[Cluster: {:s}] Instances are still launching, not scaling down"
+            .format(cluster_data["cluster_name"])
+        )
+        return False
+
     instances = \
         cluster_data["active_container_described"]["containerInstances"]
+    draining = \
+        cluster_data["draining_container_described"]["containerInstances"]
 
     # First see if we can move all of the tasks from the instance with the
     # smallest amount of reserved memory to another instance.
     min_mem_instance = get_min_mem_instance(instances)
-    if place_instance(min_mem_instance, instances, services):
+    if place_instance(min_mem_instance, instances, services, draining,
+                       headroom):
         # Scale down this instance.
         drain_instance(cluster_data, min_mem_instance, is_test_run=is_test_run)
         return True
@@ -333,7 +424,8 @@ def scale_down(cluster_data: dict,
     # Otherwise see if we can move all of the tasks from the instance with the
     # smallest amount of reserved CPU units to another instance.
     min_cpu_instance = get_min_cpu_instance(instances)
-    if place_instance(min_cpu_instance, instances, services):
+    if place_instance(min_cpu_instance, instances, services, draining,
+                       headroom):
         # Scale down this instance.
         drain_instance(cluster_data, min_cpu_instance, is_test_run=is_test_run)
         return True
@@ -373,22 +465,27 @@ def _scale_ec2_instances(cluster_data: dict,
                          cluster_def: dict,
                          asg_group_data: dict,
                          services: List[Service],
-                         is_test_run: bool = False) -> bool:
+                         is_test_run: bool = False,
+                         allow_scale_down: bool = True,
+                         report: dict = None,
+                         headroom: Headroom = None) -> bool:
     active_instances = \
         cluster_data["active_container_described"]["containerInstances"]
     draining_instances = \
         cluster_data["draining_container_described"]["containerInstances"]
     logger.info(
         "[Cluster: {:s}] Current state:\n"
-        " => Active instances:   {:d}\n"
-        " => Draining instances: {:d}\n"
-        " => Desired capacity:   {:d}\n"
-        " => Minimum capacity:   {:d}\n"
-        " => Maximum capacity:   {:d}"
+        " => Active instances:    {:d}\n"
+        " => Draining instances:  {:d}\n"
+        " => Launching instances: {:d}\n"
+        " => Desired capacity:    {:d}\n"
+        " => Minimum capacity:    {:d}\n"
+        " => Maximum capacity:    {:d}"
         .format(
             cluster_data["cluster_name"],
             len(active_instances),
             len(draining_instances),
+            count_launching_instances(cluster_data, asg_group_data),
             asg_group_data["DesiredCapacity"],
             asg_group_data["MinSize"],
             asg_group_data["MaxSize"],
@@ -410,6 +507,8 @@ def _scale_ec2_instances(cluster_data: dict,
             is_test_run=is_test_run,
         )
 
+    report = report if report is not None else {}
+
     # Check if we should scale up.
     scaled = scale_up(
         cluster_data,
@@ -417,9 +516,12 @@ def _scale_ec2_instances(cluster_data: dict,
         asg_group_data,
         services,
         is_test_run=is_test_run,
+        headroom=headroom,
     )
     if scaled:
-        return True
+        report["action"] = "scale_up"
+    if scaled or not allow_scale_down:
+        return scaled
 
     # If we didn't scale up, check if we should scale down.
     scaled = scale_down(
@@ -427,7 +529,10 @@ def _scale_ec2_instances(cluster_data: dict,
         asg_group_data,
         services,
         is_test_run=is_test_run,
+        headroom=headroom,
     )
+    if scaled:
+        report["action"] = "scale_down"
     return scaled
 
 
@@ -436,10 +541,25 @@ def scale_ec2_instances(cluster_name: str,
                         asg_data: dict,
                         cluster_list: List[str],
                         services: List[Service],
-                        is_test_run: bool = False) -> int:
+                        is_test_run: bool = False,
+                        allow_scale_down: bool = True,
+                        fingerprint: ClusterFingerprint = None,
+                        report: dict = None,
+                        headroom: Headroom = None) -> int:
     """
     Scale EC2 instances in a cluster. Returns -1 if the maximum capacity of the
     cluster is 0, otherwise returns 1 if a scaling event occured, and 0 if not.
+
+    Scaling in is skipped when `allow_scale_down` is false, e.g. when only
+    some of the services of the cluster were evaluated. When a `fingerprint`
+    of the services is given, the cluster is skipped if none of its inputs
+    changed since the last tick, which did nothing.
+
+    If a `report` dict is given, it is filled with the cluster and
+    autoscaling group data and the action taken, if any.
+
+    The `headroom` is kept free on the instances, both when scaling out and
+    when deciding whether an instance can be drained.
     """
     # Gather data needed.
     asg_group_name = cluster_def["autoscale_group"]
@@ -474,6 +594,22 @@ def scale_ec2_instances(cluster_name: str,
             asg_group_data["MinSize"] = min_instances
             asg_group_data["MaxSize"] = max_instances
 
+    if report is not None:
+        report.update(cluster_data=cluster_data,
+                      asg_group_data=asg_group_data, action=None)
+
+    if fingerprint is not None:
+        fingerprint.add_cluster(cluster_data, asg_group_data)
+        if fingerprint.unchanged():
+            logger.info(
+                "[Cluster: %s] Inputs unchanged since last tick, skipping",
+                cluster_name,
+            )
+            fingerprint.record(acted=False, skipped=True)
+            if report is not None:
+                report["action"] = "skipped"
+            return -1 if asg_group_data["MaxSize"] == 0 else 0
+
     # Attempt scaling.
     res = _scale_ec2_instances(
         cluster_data,
@@ -481,7 +617,12 @@ def scale_ec2_instances(cluster_name: str,
         asg_group_data,
         services,
         is_test_run=is_test_run,
+        allow_scale_down=allow_scale_down,
+        report=report,
+        headroom=headroom,
     )
+    if fingerprint is not None:
+        fingerprint.record(acted=res)
 
     if asg_group_data["MaxSize"] == 0:
         return -1
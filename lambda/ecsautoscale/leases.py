@@ -0,0 +1,349 @@
+"""
+Per-cluster leases, so that overlapping invocations never act on the same
+cluster together.
+
+A tick that runs longer than the schedule period, or a manual invocation
+overlapping a scheduled one, would otherwise count the same shortfall twice
+or drain two instances at once. Before evaluating a cluster, an invocation
+takes the cluster's lease. A lease that is held by another invocation makes
+the cluster wait up to `LEASE_WAIT` seconds and then skip this tick.
+
+Leases expire on their own when the invocation that holds them would have
+been stopped by Lambda, or after `LEASE_TTL` seconds outside of Lambda, so a
+crashed invocation never blocks a cluster for long. Test runs take no leases,
+since they do not act.
+
+Backends (`LEASE_BACKEND`):
+
+- ``dynamodb`` (default on Lambda): conditional writes to the table
+  `LEASE_TABLE`, with the string partition key ``lease``. Set the table's
+  TTL attribute to ``expires`` to clean up old leases.
+- ``file`` (default elsewhere): lock files under `LEASE_DIR`. They only guard
+  against invocations sharing a file system, e.g. local runs. Concurrent
+  Lambda invocations run in separate environments, so it is refused there.
+- ``none``: no leases.
+
+When the backend cannot be reached, clusters are evaluated anyway rather
+than left unscaled, and the ``LeaseErrors`` metric counts them.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import re
+import time
+from typing import Callable, Optional, Set
+import uuid
+
+from botocore.exceptions import ClientError
+
+from . import clients
+from .clients import account_from_role, current_scope
+from .deadline import Deadline, MIN_CLUSTER_SECONDS, SAFETY_MARGIN_SECONDS
+from .publisher import MetricsPublisher, publisher
+from .state import STATE_DIR
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# "dynamodb", "file" or "none". Lambda needs "dynamodb" to guard anything.
+LEASE_BACKEND = os.environ.get(
+    "LEASE_BACKEND",
+    "dynamodb" if os.environ.get("AWS_LAMBDA_FUNCTION_NAME") else "file",
+).lower()
+
+LEASE_DIR = os.environ.get("LEASE_DIR", os.path.join(STATE_DIR, "leases"))
+
+LEASE_TABLE = os.environ.get("LEASE_TABLE", "ecs-autoscale-leases")
+
+# Longest a lease is held, in seconds. Invocations on Lambda hold it only
+# until they would time out.
+LEASE_TTL = float(os.environ.get("LEASE_TTL", "900"))
+
+# How long to wait for a cluster whose lease is held, 0 to skip it at once.
+LEASE_WAIT = float(os.environ.get("LEASE_WAIT", "0"))
+
+# Seconds between attempts while waiting.
+LEASE_POLL = float(os.environ.get("LEASE_POLL", "1"))
+
+
+def cluster_lease_name(cluster_name: str) -> str:
+    """The lease of a cluster in the current region and account."""
+    region, role_arn = current_scope()
+    return "{:s}/{:s}/{:s}".format(account_from_role(role_arn),
+                                   region or "default", cluster_name)
+
+
+class LeaseBackend:
+    """Where leases are kept."""
+
+    def acquire(self, name: str, owner: str, expires: float,
+                now: float) -> bool:
+        """
+        Take the lease `name` until `expires`, if it is free, expired or
+        already held by `owner`.
+        """
+        raise NotImplementedError
+
+    def release(self, name: str, owner: str) -> None:
+        """Give up the lease `name`, if `owner` still holds it."""
+        raise NotImplementedError
+
+
+class FileLeaseBackend(LeaseBackend):
+    """
+    Leases as JSON files, updated under an exclusive lock.
+
+    Parameters
+    ----------
+    directory : str
+        Where lease files are kept.
+
+    """
+
+    def __init__(self, directory: str = LEASE_DIR) -> None:
+        self.directory = directory
+
+    @contextmanager
+    def _locked(self, name: str):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory,
+                            re.sub(r"[^\w.-]", "_", name) + ".lease")
+        with open(path, "a+", encoding="utf-8") as leasefile:
+            fcntl.flock(leasefile, fcntl.LOCK_EX)
+            try:
+                leasefile.seek(0)
+                raw = leasefile.read()
+                try:
+                    current = json.loads(raw) if raw else None
+                except ValueError:
+                    current = None
+                yield leasefile, current
+            finally:
+                fcntl.flock(leasefile, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write(leasefile, value: Optional[dict]) -> None:
+        leasefile.seek(0)
+        leasefile.truncate()
+        if value is not None:
+            leasefile.write(json.dumps(value))
+        leasefile.flush()
+
+    def acquire(self, name: str, owner: str, expires: float,
+                now: float) -> bool:
+        with self._locked(name) as (leasefile, current):
+            if current is not None and current["owner"] != owner and \
+                    current["expires"] > now:
+                return False
+            self._write(leasefile, {"owner": owner, "expires": expires})
+            return True
+
+    def release(self, name: str, owner: str) -> None:
+        with self._locked(name) as (leasefile, current):
+            if current is not None and current["owner"] == owner:
+                self._write(leasefile, None)
+
+
+class DynamoDBLeaseBackend(LeaseBackend):
+    """
+    Leases as items of a DynamoDB table, taken with conditional writes.
+
+    Parameters
+    ----------
+    table : str
+        The table, with the string partition key ``lease``.
+
+    client
+        A DynamoDB client, or anything answering `put_item` and
+        `delete_item` the same way. By default the client of the function's
+        own region and account.
+
+    """
+
+    def __init__(self, table: str = LEASE_TABLE, client=None) -> None:
+        self.table = table
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is not None:
+            return self._client
+        # Leases live with the function, not in the account of the cluster.
+        return clients.pool.get("dynamodb")
+
+    def acquire(self, name: str, owner: str, expires: float,
+                now: float) -> bool:
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={
+                    "lease": {"S": name},
+                    "owner": {"S": owner},
+                    "expires": {"N": str(int(expires))},
+                },
+                ConditionExpression="attribute_not_exists(lease) OR "
+                                    "#expires < :now OR #owner = :owner",
+                ExpressionAttributeNames={"#expires": "expires",
+                                          "#owner": "owner"},
+                ExpressionAttributeValues={":now": {"N": str(int(now))},
+                                           ":owner": {"S": owner}},
+            )
+        except ClientError as ex:
+            if ex.response["Error"]["Code"] == \
+                    "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def release(self, name: str, owner: str) -> None:
+        try:
+            self.client.delete_item(
+                TableName=self.table,
+                Key={"lease": {"S": name}},
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#owner": "owner"},
+                ExpressionAttributeValues={":owner": {"S": owner}},
+            )
+        except ClientError as ex:
+            if ex.response["Error"]["Code"] != \
+                    "ConditionalCheckFailedException":
+                raise
+
+
+def get_backend(name: str = LEASE_BACKEND) -> Optional[LeaseBackend]:
+    if name in ("", "none"):
+        return None
+    if name == "file":
+        if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+            raise ValueError(
+                "Lease backend \"file\" does not guard against overlapping "
+                "invocations on Lambda, set LEASE_BACKEND to \"dynamodb\" "
+                "or \"none\"")
+        return FileLeaseBackend()
+    if name == "dynamodb":
+        return DynamoDBLeaseBackend()
+    raise ValueError("Unknown lease backend: " + name)
+
+
+class LeaseManager:
+    """
+    Takes and gives back the leases of one invocation.
+
+    Parameters
+    ----------
+    backend : LeaseBackend
+        Where leases are kept, `None` to not use leases.
+
+    ttl : float
+        Longest a lease is held, in seconds.
+
+    wait : float
+        How long to wait for a lease held by another invocation.
+
+    poll : float
+        Seconds between attempts while waiting.
+
+    clock : Callable
+        Returns the current Unix time.
+
+    sleep : Callable
+        Sleeps for a number of seconds.
+
+    metrics : MetricsPublisher
+        Where ``LeaseErrors`` is counted, the default publisher by default.
+
+    """
+
+    def __init__(self,
+                 backend: Optional[LeaseBackend],
+                 ttl: float = LEASE_TTL,
+                 wait: float = LEASE_WAIT,
+                 poll: float = LEASE_POLL,
+                 clock: Callable = time.time,
+                 sleep: Callable = time.sleep,
+                 metrics: MetricsPublisher = None) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.wait = wait
+        self.poll = poll
+        self.clock = clock
+        self.sleep = sleep
+        self.metrics = metrics
+        self.owner = uuid.uuid4().hex
+        self.held: Set[str] = set()
+        self.errors = 0
+
+    def new_tick(self, owner: str = None) -> None:
+        """Start an invocation, e.g. with its Lambda request ID."""
+        self.owner = owner or uuid.uuid4().hex
+        self.held = set()
+        self.errors = 0
+
+    def _ttl(self, deadline: Optional[Deadline]) -> float:
+        if deadline is None:
+            return self.ttl
+        # Lambda stops the invocation shortly after its deadline.
+        return max(min(deadline.remaining() + SAFETY_MARGIN_SECONDS,
+                       self.ttl), 1.0)
+
+    def acquire(self, name: str, deadline: Deadline = None) -> bool:
+        """
+        Take a lease, waiting for it up to `wait` seconds. Returns whether
+        the lease was taken.
+        """
+        # pylint: disable=broad-except
+        if self.backend is None:
+            return True
+        waited = 0.0
+        while True:
+            now = self.clock()
+            try:
+                taken = self.backend.acquire(name, self.owner,
+                                             now + self._ttl(deadline), now)
+            except Exception as ex:
+                logger.warning("Could not take lease %s, going ahead "
+                               "without it: %s", name, ex)
+                self.errors += 1
+                (self.metrics or publisher).add("LeaseErrors", self.errors)
+                return True
+            if taken:
+                self.held.add(name)
+                return True
+            left = self.wait - waited
+            if deadline is not None:
+                left = min(left, deadline.remaining() - MIN_CLUSTER_SECONDS)
+            if left <= 0:
+                return False
+            pause = min(self.poll, left)
+            self.sleep(pause)
+            waited += pause
+
+    def release(self, name: str) -> None:
+        # pylint: disable=broad-except
+        if self.backend is None or name not in self.held:
+            return
+        self.held.discard(name)
+        try:
+            self.backend.release(name, self.owner)
+        except Exception as ex:
+            logger.warning("Could not release lease %s: %s", name, ex)
+
+
+manager = LeaseManager(get_backend())
+
+
+@contextmanager
+def use_leases(lease_manager: LeaseManager):
+    """Temporarily use another lease manager."""
+    global manager  # pylint: disable=global-statement
+    previous = manager
+    manager = lease_manager
+    try:
+        yield lease_manager
+    finally:
+        manager = previous
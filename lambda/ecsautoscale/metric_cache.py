@@ -0,0 +1,69 @@
+"""
+Last known good metric values, used when a source fails or runs out of time.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+from . import state
+from .state import StateStore
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# How old a cached value may be, in seconds, to still be used.
+METRIC_MAX_STALENESS = float(os.environ.get("METRIC_MAX_STALENESS", "600"))
+
+NAMESPACE = "metrics"
+
+
+def _key(source_name: str, item: dict) -> str:
+    # Hashed, since items may contain credentials, e.g. in URLs.
+    raw = json.dumps([source_name, item], sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class MetricCache:
+    """
+    Remembers the values each metric source item returned.
+
+    Parameters
+    ----------
+    state_store : StateStore
+        Where values are kept between ticks.
+
+    clock : Callable
+        Returns the current Unix time.
+
+    """
+
+    def __init__(self,
+                 state_store: StateStore = None,
+                 clock: Callable = time.time) -> None:
+        self.store = state_store or state.store
+        self.clock = clock
+
+    def put(self, source_name: str, item: dict, values: dict) -> None:
+        self.store.set(NAMESPACE, _key(source_name, item),
+                       {"values": values, "time": self.clock()})
+
+    def get(self,
+            source_name: str,
+            item: dict,
+            max_staleness: float = None) -> Optional[dict]:
+        """Get the last values, if they are recent enough."""
+        if max_staleness is None:
+            max_staleness = METRIC_MAX_STALENESS
+        entry = self.store.get(NAMESPACE, _key(source_name, item))
+        if entry is None:
+            return None
+        age = self.clock() - entry["time"]
+        if age > max_staleness:
+            return None
+        return entry["values"]
@@ -0,0 +1,141 @@
+"""
+Registry of metric sources.
+
+A metric source turns the items listed under a source name in a service's
+`metric_sources` into metric values keyed by alias. Sources implement
+`MetricSource.fetch_many`, which receives every item for that source across
+all of the services and clusters evaluated in a tick, so that sources can
+batch their requests.
+
+Sources are found by name, in this order:
+
+1. Sources registered with `register`.
+2. The built-in sources (`cloudwatch`, `third_party`, `prometheus`, `sqs`,
+   `redis`).
+3. Entry points in the `ecsautoscale.metric_sources` group.
+4. An import path of the form ``package.module:attribute``, either given
+   directly as the source name or mapped to a name under
+   `metric_source_plugins` in a cluster definition.
+"""
+
+import importlib
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+ENTRY_POINT_GROUP = "ecsautoscale.metric_sources"
+
+BUILTIN_SOURCES = {
+    "cloudwatch": "ecsautoscale.metric_sources.cloudwatch:source",
+    "third_party": "ecsautoscale.metric_sources.third_party:source",
+    "prometheus": "ecsautoscale.metric_sources.prometheus:source",
+    "sqs": "ecsautoscale.metric_sources.sqs:source",
+    "redis": "ecsautoscale.metric_sources.redis_queue:source",
+}
+
+
+class MetricSource:
+    """
+    Base class for metric sources.
+
+    Subclasses implement either `get_data`, to fetch a single item, or
+    `fetch_many` to fetch many items at once.
+    """
+
+    name: Optional[str] = None
+
+    def get_data(self, **item) -> dict:
+        """Fetch the metrics of a single item."""
+        raise NotImplementedError
+
+    def fetch_many(self, requests: List[dict]) -> List[Union[dict, Exception]]:
+        """
+        Fetch the metrics for a list of items. Returns a list aligned with
+        `requests`, containing either the metrics keyed by alias or the
+        exception raised while fetching that item.
+        """
+        # pylint: disable=broad-except
+        out: List[Union[dict, Exception]] = []
+        for item in requests:
+            try:
+                out.append(self.get_data(**item))
+            except Exception as ex:
+                out.append(ex)
+        return out
+
+
+_registry: Dict[str, MetricSource] = {}
+
+
+def register(name: str, source=None):
+    """
+    Register a metric source under a name. `source` may be a `MetricSource`
+    instance or class. Can also be used as a class decorator.
+    """
+    def decorator(obj):
+        _registry[name] = obj() if isinstance(obj, type) else obj
+        return obj
+    if source is None:
+        return decorator
+    return decorator(source)
+
+
+def _import(path: str):
+    module_name, _, attr = path.partition(":")
+    obj = importlib.import_module(module_name)
+    for part in attr.split(".") if attr else []:
+        obj = getattr(obj, part)
+    return obj() if isinstance(obj, type) else obj
+
+
+def _entry_point(name: str):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # pragma: no cover, Python < 3.8
+        import pkg_resources
+        for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+            if entry_point.name == name:
+                return entry_point.load()
+        return None
+    all_eps: Any = entry_points()
+    eps: Iterable[Any]
+    if hasattr(all_eps, "select"):
+        eps = all_eps.select(group=ENTRY_POINT_GROUP)
+    else:  # pragma: no cover, Python < 3.10 returns a dict of groups
+        eps = all_eps.get(ENTRY_POINT_GROUP, [])
+    for entry_point in eps:
+        if entry_point.name == name:
+            return entry_point.load()
+    return None
+
+
+def register_plugins(plugins: Optional[Dict[str, str]]) -> None:
+    """Register sources from a mapping of name to import path."""
+    for name, path in (plugins or {}).items():
+        if name not in _registry:
+            register(name, _import(path))
+
+
+def get_source(name: str) -> MetricSource:
+    """Look up a metric source by name."""
+    source = _registry.get(name)
+    if source is not None:
+        return source
+
+    if name in BUILTIN_SOURCES:
+        source = _import(BUILTIN_SOURCES[name])
+    else:
+        obj = _entry_point(name)
+        if obj is not None:
+            source = obj() if isinstance(obj, type) else obj
+        elif ":" in name:
+            source = _import(name)
+        else:
+            raise KeyError("Unknown metric source {!r}".format(name))
+
+    _registry[name] = source
+    return source
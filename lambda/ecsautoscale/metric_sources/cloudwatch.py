@@ -2,16 +2,21 @@
 
 from datetime import datetime, timedelta
 import logging
-from typing import List
+from typing import Dict, List, Union
 
 from ecsautoscale import cdw_client
 from ecsautoscale.exceptions import CloudWatchError
+from ecsautoscale.metric_sources import MetricSource, register
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+# Maximum number of queries in a single `get_metric_data` call.
+MAX_QUERIES = 500
+
+
 def _format_dimensions(dimensions: List[dict]) -> List[dict]:
     out = []
     for item in dimensions:
@@ -22,6 +27,128 @@ def _format_dimensions(dimensions: List[dict]) -> List[dict]:
     return out
 
 
+def _normalize(metric_name: str = "MemoryUtilization",
+               dimensions: List[dict] = None,
+               statistics: List[dict] = None,
+               namespace: str = "AWS/ECS",
+               period: int = 300) -> dict:
+    return {
+        "metric_name": metric_name,
+        "dimensions": dimensions or [],
+        "statistics": statistics or [],
+        "namespace": namespace,
+        "period": period,
+    }
+
+
+class CloudWatchSource(MetricSource):
+    """
+    Retreive metrics from AWS CloudWatch.
+
+    Each item takes the following fields:
+
+    metric_name : str
+        The name of the metric.
+
+    dimensions : List[dict]
+        AWS metric dimension names.
+
+    statistics : List[dict]
+        AWS metric statistic names.
+
+    namespace : str
+        AWS metric namespace name.
+
+    period : int
+        AWS metric period.
+
+    All statistics of all items are fetched with as few `get_metric_data`
+    calls as possible: one per distinct period and 500 statistics.
+    """
+
+    name = "cloudwatch"
+
+    def get_data(self, **item) -> dict:
+        res = self.fetch_many([item])[0]
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def fetch_many(self, requests: List[dict]) -> List[Union[dict, Exception]]:
+        items = [_normalize(**x) for x in requests]
+
+        # Build one query per statistic, grouped by period since the query
+        # window depends on it.
+        queries: Dict[int, List[dict]] = {}
+        for i, item in enumerate(items):
+            for j, stat in enumerate(item["statistics"]):
+                queries.setdefault(item["period"], []).append({
+                    "Id": "m{}_{}".format(i, j),
+                    "MetricStat": {
+                        "Metric": {
+                            "Namespace": item["namespace"],
+                            "MetricName": item["metric_name"],
+                            "Dimensions":
+                                _format_dimensions(item["dimensions"]),
+                        },
+                        "Period": item["period"],
+                        "Stat": stat["name"],
+                    },
+                    "ReturnData": True,
+                })
+
+        values: Dict[str, List[float]] = {}
+        now = datetime.now()
+        for period, period_queries in queries.items():
+            for start in range(0, len(period_queries), MAX_QUERIES):
+                kwargs = {
+                    "MetricDataQueries":
+                        period_queries[start:start + MAX_QUERIES],
+                    "StartTime": now - timedelta(seconds=period),
+                    "EndTime": now,
+                    "ScanBy": "TimestampDescending",
+                }
+                while True:
+                    res = cdw_client.get_metric_data(**kwargs)
+                    for result in res["MetricDataResults"]:
+                        values.setdefault(result["Id"], []) \
+                            .extend(result["Values"])
+                    if not res.get("NextToken"):
+                        break
+                    kwargs["NextToken"] = res["NextToken"]
+
+        out: List[Union[dict, Exception]] = []
+        for i, item in enumerate(items):
+            metrics = {}
+            log_messages = [
+                "Retreived the following statistics from CloudWatch:"]
+            missing = False
+            for j, stat in enumerate(item["statistics"]):
+                datapoints = values.get("m{}_{}".format(i, j))
+                if not datapoints:
+                    missing = True
+                    break
+                metrics[stat["alias"]] = datapoints[0]
+                log_messages.append(
+                    " => {}: {}".format(stat["alias"], datapoints[0]))
+            if missing:
+                out.append(CloudWatchError(
+                    item["namespace"],
+                    item["metric_name"],
+                    _format_dimensions(item["dimensions"]),
+                    item["period"],
+                    [x["name"] for x in item["statistics"]],
+                ))
+                continue
+            if metrics:
+                logger.debug("\n".join(log_messages))
+            out.append(metrics)
+        return out
+
+
+source = register("cloudwatch", CloudWatchSource())
+
+
 def get_data(metric_name: str = "MemoryUtilization",
              dimensions: List[dict] = None,
              statistics: List[dict] = None,
@@ -53,36 +180,6 @@ def get_data(metric_name: str = "MemoryUtilization",
         The desired metrics.
 
     """
-    statistics = statistics or []
-    dimensions = dimensions or []
-
-    out = {x["alias"]: None for x in statistics}
-
-    dimensions_ = _format_dimensions(dimensions)
-    statistics_ = [x["name"] for x in statistics]
-    now = datetime.now()
-    res = cdw_client.get_metric_statistics(
-        Namespace=namespace,
-        MetricName=metric_name,
-        Dimensions=dimensions_,
-        StartTime=now - timedelta(seconds=period),
-        EndTime=now,
-        Period=period,
-        Statistics=statistics_,
-    )
-    datapoints = res["Datapoints"]
-    if not datapoints:
-        raise CloudWatchError(
-            namespace, metric_name, dimensions_, period, statistics_)
-
-    log_messages = ["Retreived the following statistics from CloudWatch:"]
-    for stat in statistics:
-        key = stat["alias"]
-        val = datapoints[0].get(stat["name"])
-        out[key] = val
-        log_messages.append(" => {}: {}".format(key, val))
-
-    if out:
-        logger.debug("\n".join(log_messages))
-
-    return out
+    return source.get_data(metric_name=metric_name, dimensions=dimensions,
+                           statistics=statistics, namespace=namespace,
+                           period=period)
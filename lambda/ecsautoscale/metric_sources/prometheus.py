@@ -0,0 +1,160 @@
+"""Metrics from Prometheus."""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from ecsautoscale.exceptions import PrometheusError
+from ecsautoscale.http import get_session
+from ecsautoscale.metric_sources import MetricSource, register
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# Maximum number of queries in flight at once.
+MAX_WORKERS = 8
+
+AGGREGATIONS: Dict[str, Callable[[List[float]], float]] = {
+    "sum": sum,
+    "avg": lambda values: sum(values) / len(values),
+    "max": max,
+    "min": min,
+    "count": len,
+}
+
+
+def _sample_values(result_type: str, result) -> List[float]:
+    if result_type in ("scalar", "string"):
+        return [float(result[1])]
+    if result_type == "vector":
+        return [float(x["value"][1]) for x in result]
+    if result_type == "matrix":
+        # Latest sample of each series.
+        return [float(x["values"][-1][1]) for x in result if x["values"]]
+    raise ValueError("Unknown result type {!r}".format(result_type))
+
+
+def _query(url: str,
+           query: str,
+           eval_time: float,
+           headers: Optional[dict],
+           timeout: float) -> Union[Tuple[str, list], Exception]:
+    # pylint: disable=broad-except
+    try:
+        resp = get_session().post(
+            url.rstrip("/") + "/api/v1/query",
+            data={"query": query, "time": "{:.3f}".format(eval_time)},
+            headers=headers,
+            timeout=timeout,
+        )
+        body = resp.json()
+    except Exception as ex:
+        return PrometheusError(url, query, ex)
+    if resp.status_code != 200 or body.get("status") != "success":
+        return PrometheusError(
+            url, query, body.get("error") or
+            "status code {}".format(resp.status_code))
+    return body["data"]["resultType"], body["data"]["result"]
+
+
+class PrometheusSource(MetricSource):
+    """
+    Evaluate PromQL expressions with the Prometheus HTTP API.
+
+    Each item takes the following fields:
+
+    url : str
+        The base URL of the Prometheus server.
+
+    queries : List[dict]
+        The queries to evaluate. Each has a `query` (PromQL), an `alias`,
+        optionally an `aggregate` (`sum`, `avg`, `max`, `min` or `count`,
+        default `sum`) used to reduce vector results to a single value, and
+        optionally a `default` used when the query returns no samples.
+
+    headers : dict
+        Extra HTTP headers, e.g. for authentication.
+
+    timeout : float
+        Request timeout in seconds.
+
+    All queries in a tick are evaluated at the same timestamp, identical
+    queries are only sent once, and requests share keep-alive connections.
+    """
+
+    name = "prometheus"
+
+    def __init__(self, clock=time.time) -> None:
+        self.clock = clock
+
+    def get_data(self, **item) -> dict:
+        res = self.fetch_many([item])[0]
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def fetch_many(self, requests: List[dict]) -> List[Union[dict, Exception]]:
+        eval_time = self.clock()
+
+        unique: Dict[Tuple[str, str], dict] = {}
+        for item in requests:
+            for query in item.get("queries", []):
+                key = (item["url"], query["query"])
+                unique.setdefault(key, item)
+
+        def run(key):
+            item = unique[key]
+            return _query(key[0], key[1], eval_time, item.get("headers"),
+                          item.get("timeout", 10))
+
+        keys = list(unique)
+        responses = {}
+        if len(keys) == 1:
+            responses[keys[0]] = run(keys[0])
+        elif keys:
+            workers = min(MAX_WORKERS, len(keys))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for key, res in zip(keys, executor.map(run, keys)):
+                    responses[key] = res
+
+        out: List[Union[dict, Exception]] = []
+        for item in requests:
+            try:
+                out.append(self._extract(item, responses))
+            except PrometheusError as ex:
+                out.append(ex)
+        return out
+
+    @staticmethod
+    def _extract(item: dict, responses: dict) -> dict:
+        metrics = {}
+        log_messages = ["Retreived the following metrics from Prometheus:"]
+        for query in item.get("queries", []):
+            res = responses[(item["url"], query["query"])]
+            if isinstance(res, Exception):
+                raise res
+            result_type, result = res
+            try:
+                values = _sample_values(result_type, result)
+            except (ValueError, KeyError, IndexError) as ex:
+                raise PrometheusError(item["url"], query["query"], ex) \
+                    from ex
+            if values:
+                aggregate = AGGREGATIONS[query.get("aggregate", "sum")]
+                value = aggregate(values)
+            elif "default" in query:
+                value = query["default"]
+            else:
+                raise PrometheusError(item["url"], query["query"],
+                                      "no samples")
+            metrics[query["alias"]] = value
+            log_messages.append(" => {}: {}".format(query["alias"], value))
+        if metrics:
+            logger.debug("\n".join(log_messages))
+        return metrics
+
+
+source = register("prometheus", PrometheusSource())
@@ -0,0 +1,142 @@
+"""Queue depth metrics from Redis, e.g. for Celery workers."""
+
+import logging
+import threading
+from typing import Callable, Dict, List, Tuple, Union
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from ecsautoscale.exceptions import QueueDepthError
+from ecsautoscale.metric_sources import MetricSource, register
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# Commands that return the size of a key.
+COMMANDS = ("llen", "zcard", "scard", "xlen")
+
+
+REDACTED = "<redacted>"
+
+
+def _passwords(url: str) -> List[str]:
+    """The passwords in a Redis URL, in its user info or query string."""
+    parts = urlsplit(url)
+    return [x for x in [parts.password] + [
+        v for k, v in parse_qsl(parts.query) if k == "password"] if x]
+
+
+def _queue_error(url: str, ex: Exception) -> QueueDepthError:
+    """An error naming the server and the reason without its password."""
+    parts = urlsplit(url)
+    netloc = parts.netloc
+    if parts.password is not None:
+        netloc = "{:s}:{:s}@{:s}".format(parts.username or "", REDACTED,
+                                         netloc.rpartition("@")[2])
+    query = urlencode([(k, REDACTED if k == "password" else v)
+                       for k, v in parse_qsl(parts.query)])
+    reason: Union[str, Exception] = ex
+    for password in _passwords(url):
+        if password in str(reason):
+            reason = str(reason).replace(password, REDACTED)
+    return QueueDepthError(
+        urlunsplit(parts._replace(netloc=netloc, query=query)), reason)
+
+
+def _default_client_factory(url: str):
+    # Optional dependency, only needed when this source is used.
+    import redis
+    return redis.Redis.from_url(url)
+
+
+class RedisQueueSource(MetricSource):
+    """
+    Read the length of Redis keys, e.g. the lists Celery uses as queues.
+
+    Each item takes the following fields:
+
+    url : str
+        The Redis URL, e.g. ``redis://my-redis:6379/0``.
+
+    statistics : List[dict]
+        Keys to read, each with a `name` (the key), an `alias` and optionally
+        a `command` (`llen` by default, or `zcard`, `scard`, `xlen`).
+
+    All keys on the same server are read in a single pipeline round trip per
+    tick, and connections are reused between ticks.
+
+    Parameters
+    ----------
+    client_factory : Callable
+        Creates a Redis client from a URL.
+
+    """
+
+    name = "redis"
+
+    def __init__(self, client_factory: Callable = None) -> None:
+        self.client_factory = client_factory or _default_client_factory
+        self._clients: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def get_data(self, **item) -> dict:
+        res = self.fetch_many([item])[0]
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def _client(self, url: str):
+        with self._lock:
+            client = self._clients.get(url)
+            if client is None:
+                client = self.client_factory(url)
+                self._clients[url] = client
+            return client
+
+    def fetch_many(self, requests: List[dict]) -> List[Union[dict, Exception]]:
+        # pylint: disable=broad-except
+        keys: Dict[str, List[Tuple[str, str]]] = {}
+        for item in requests:
+            server_keys = keys.setdefault(item["url"], [])
+            for stat in item.get("statistics", []):
+                key = (stat.get("command", "llen").lower(), stat["name"])
+                if key not in server_keys:
+                    server_keys.append(key)
+
+        values: Dict[str, Union[Dict[Tuple[str, str], int], Exception]] = {}
+        for url, server_keys in keys.items():
+            try:
+                pipeline = self._client(url).pipeline(transaction=False)
+                for command, name in server_keys:
+                    if command not in COMMANDS:
+                        raise ValueError(
+                            "Unsupported command {!r}".format(command))
+                    getattr(pipeline, command)(name)
+                values[url] = dict(zip(server_keys, pipeline.execute()))
+            except Exception as ex:
+                # Drop the connection, it may be broken.
+                with self._lock:
+                    self._clients.pop(url, None)
+                values[url] = _queue_error(url, ex)
+
+        out: List[Union[dict, Exception]] = []
+        for item in requests:
+            server_values = values[item["url"]]
+            if isinstance(server_values, Exception):
+                out.append(server_values)
+                continue
+            metrics = {}
+            log_messages = ["Retreived the following metrics from Redis:"]
+            for stat in item.get("statistics", []):
+                key = (stat.get("command", "llen").lower(), stat["name"])
+                metrics[stat["alias"]] = int(server_values[key])
+                log_messages.append(
+                    " => {}: {}".format(stat["alias"], metrics[stat["alias"]]))
+            if metrics:
+                logger.debug("\n".join(log_messages))
+            out.append(metrics)
+        return out
+
+
+source = register("redis", RedisQueueSource())
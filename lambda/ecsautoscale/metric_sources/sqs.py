@@ -0,0 +1,111 @@
+"""Queue depth metrics from Amazon SQS."""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from typing import Dict, List, Set, Tuple, Union
+
+from ecsautoscale import sqs_client
+from ecsautoscale.clients import bind_scope, current_scope
+from ecsautoscale.exceptions import QueueDepthError
+from ecsautoscale.metric_sources import MetricSource, register
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# Maximum number of queues read at once.
+MAX_WORKERS = 8
+
+DEFAULT_ATTRIBUTE = "ApproximateNumberOfMessages"
+
+# Queue URLs never change, so they are resolved once per (scope, name).
+_queue_urls: Dict[Tuple, str] = {}
+
+
+def _queue_url(queue: str) -> str:
+    if queue.startswith("https://") or queue.startswith("http://"):
+        return queue
+    key = (current_scope(), queue)
+    url = _queue_urls.get(key)
+    if url is None:
+        url = sqs_client.get_queue_url(QueueName=queue)["QueueUrl"]
+        _queue_urls[key] = url
+    return url
+
+
+class SQSSource(MetricSource):
+    """
+    Read queue attributes from SQS.
+
+    Each item takes the following fields:
+
+    queue : str
+        The queue name or URL.
+
+    statistics : List[dict]
+        Queue attributes to read, each with a `name` (default
+        `ApproximateNumberOfMessages`) and an `alias`.
+
+    Every queue is read once per tick with a single `GetQueueAttributes` call
+    for all attributes any service asked for, and queues are read
+    concurrently.
+    """
+
+    name = "sqs"
+
+    def get_data(self, **item) -> dict:
+        res = self.fetch_many([item])[0]
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def fetch_many(self, requests: List[dict]) -> List[Union[dict, Exception]]:
+        attributes: Dict[str, Set[str]] = {}
+        for item in requests:
+            names = attributes.setdefault(item["queue"], set())
+            for stat in item.get("statistics", []):
+                names.add(stat.get("name", DEFAULT_ATTRIBUTE))
+
+        def read(queue: str):
+            # pylint: disable=broad-except
+            try:
+                res = sqs_client.get_queue_attributes(
+                    QueueUrl=_queue_url(queue),
+                    AttributeNames=sorted(attributes[queue]),
+                )
+                return res["Attributes"]
+            except Exception as ex:
+                return QueueDepthError(queue, ex)
+
+        queues = list(attributes)
+        values = {}
+        if len(queues) == 1:
+            values[queues[0]] = read(queues[0])
+        elif queues:
+            workers = min(MAX_WORKERS, len(queues))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for queue, res in zip(queues,
+                                      executor.map(bind_scope(read), queues)):
+                    values[queue] = res
+
+        out: List[Union[dict, Exception]] = []
+        for item in requests:
+            queue_values = values[item["queue"]]
+            if isinstance(queue_values, Exception):
+                out.append(queue_values)
+                continue
+            metrics = {}
+            log_messages = ["Retreived the following metrics from SQS:"]
+            for stat in item.get("statistics", []):
+                name = stat.get("name", DEFAULT_ATTRIBUTE)
+                value = int(queue_values.get(name, 0))
+                metrics[stat["alias"]] = value
+                log_messages.append(" => {}: {}".format(stat["alias"], value))
+            if metrics:
+                logger.debug("\n".join(log_messages))
+            out.append(metrics)
+        return out
+
+
+source = register("sqs", SQSSource())
@@ -1,17 +1,23 @@
 """Interface to metric from third-party sources."""
 
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+import json
+from typing import Dict, List, Optional, Tuple, Union
 import logging
 
-import requests
-
 from ecsautoscale.exceptions import ThirdPartyError
+from ecsautoscale.http import get_session
+from ecsautoscale.metric_sources import MetricSource, register
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+# Maximum number of HTTP requests in flight at once.
+MAX_WORKERS = 8
+
+
 def _get_nested_field(data: dict, field: str):
     subdata = data
     levels = field.split(".")
@@ -20,6 +26,103 @@ def _get_nested_field(data: dict, field: str):
     return subdata
 
 
+def _request(url: str, method: str, payload) -> dict:
+    # pylint: disable=not-callable
+    assert method in ["GET", "POST"]
+    method_ = getattr(get_session(), method.lower())
+    resp = method_(url, json=payload)
+    if resp.status_code != 200:
+        raise ThirdPartyError(resp.status_code, url)
+    return resp.json()
+
+
+def _extract(data: dict, statistics: List[dict]) -> dict:
+    out = {x["alias"]: None for x in statistics}
+    log_messages = ["Retreived the following metrics:"]
+    for stat in statistics:
+        key = stat["alias"]
+        val = _get_nested_field(data, stat["name"])
+        out[key] = val
+        log_messages.append(" => {}: {}".format(key, val))
+    if out:
+        logger.debug("\n".join(log_messages))
+    return out
+
+
+class ThirdPartySource(MetricSource):
+    """
+    Retreive metrics from a URL with an HTTP POST or GET request.
+
+    Each item takes the following fields:
+
+    url : str
+        The URL of the resource.
+
+    statistics : List[dict]
+        A list of metric names to grab.
+
+    method : str
+        The HTTP method.
+
+    payload : dict
+        An arbitrary payload to include in the request.
+
+    Identical requests are only made once per tick, distinct ones are made
+    concurrently over shared keep-alive connections.
+    """
+
+    name = "third_party"
+
+    def get_data(self, **item) -> dict:
+        res = self.fetch_many([item])[0]
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def fetch_many(self, requests: List[dict]) -> List[Union[dict, Exception]]:
+        # pylint: disable=broad-except
+        keys: List[Tuple[Optional[str], str, str]] = []
+        for item in requests:
+            keys.append((
+                item.get("url"),
+                item.get("method", "GET"),
+                json.dumps(item.get("payload"), sort_keys=True),
+            ))
+        unique = list(dict.fromkeys(keys))
+
+        def fetch(key):
+            url, method, payload = key
+            try:
+                return _request(url, method, json.loads(payload))
+            except Exception as ex:
+                return ex
+
+        responses: Dict[Tuple[Optional[str], str, str],
+                        Union[dict, Exception]] = {}
+        if len(unique) == 1:
+            responses[unique[0]] = fetch(unique[0])
+        elif unique:
+            workers = min(MAX_WORKERS, len(unique))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for key, res in zip(unique, executor.map(fetch, unique)):
+                    responses[key] = res
+
+        out: List[Union[dict, Exception]] = []
+        for key, item in zip(keys, requests):
+            data = responses[key]
+            if isinstance(data, Exception):
+                out.append(data)
+                continue
+            try:
+                out.append(_extract(data, item.get("statistics") or []))
+            except Exception as ex:
+                out.append(ex)
+        return out
+
+
+source = register("third_party", ThirdPartySource())
+
+
 def get_data(url: str = None,
              statistics: List[dict] = None,
              method: str = "GET",
@@ -47,26 +150,5 @@ def get_data(url: str = None,
         The desired metrics.
 
     """
-    # pylint: disable=not-callable
-    assert method in ["GET", "POST"]
-
-    statistics = statistics or []
-
-    out = {x["alias"]: None for x in statistics}
-
-    method_ = getattr(requests, method.lower())
-    resp = method_(url, json=payload)
-    if resp.status_code != 200:
-        raise ThirdPartyError(resp.status_code, url)
-
-    data = resp.json()
-    log_messages = ["Retreived the following metrics:"]
-    for stat in statistics:
-        key = stat["alias"]
-        val = _get_nested_field(data, stat["name"])
-        out[key] = val
-        log_messages.append(" => {}: {}".format(key, val))
-    if out:
-        logger.debug("\n".join(log_messages))
-
-    return out
+    return source.get_data(url=url, statistics=statistics, method=method,
+                           payload=payload)
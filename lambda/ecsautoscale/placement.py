@@ -0,0 +1,533 @@
+"""
+Simulates ECS task placement across the container instances of a cluster.
+
+The simulator keeps a resource vector per instance (CPU, memory, GPUs, host
+ports and ENIs) along with the instance attributes, and checks each simulated
+task against the placement constraints declared on the service and the task
+definition, so that "fits on existing instances" means the same thing to us
+as it does to the ECS scheduler.
+"""
+
+from collections import Counter
+import fnmatch
+import logging
+import re
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+from .exceptions import MissingResourceValueError
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+AZ_ATTRIBUTE = "ecs.availability-zone"
+INSTANCE_TYPE_ATTRIBUTE = "ecs.instance-type"
+TRUNK_ATTRIBUTE = "ecs.awsvpc-trunk-id"
+
+# Maximum number of network interfaces by instance type. One of them is
+# always taken by the primary interface of the instance. Types that are not
+# listed here are treated as having no ENI limit.
+MAX_ENIS = {
+    "t2.micro": 2, "t2.small": 3, "t2.medium": 3, "t2.large": 3,
+    "t2.xlarge": 3, "t2.2xlarge": 3,
+    "t3.micro": 2, "t3.small": 3, "t3.medium": 3, "t3.large": 3,
+    "t3.xlarge": 4, "t3.2xlarge": 4,
+    "m4.large": 2, "m4.xlarge": 4, "m4.2xlarge": 4, "m4.4xlarge": 8,
+    "m5.large": 3, "m5.xlarge": 4, "m5.2xlarge": 4, "m5.4xlarge": 8,
+    "c4.large": 3, "c4.xlarge": 4, "c4.2xlarge": 4, "c4.4xlarge": 8,
+    "c5.large": 3, "c5.xlarge": 4, "c5.2xlarge": 4, "c5.4xlarge": 8,
+    "r4.large": 3, "r4.xlarge": 4, "r4.2xlarge": 4, "r4.4xlarge": 8,
+    "r5.large": 3, "r5.xlarge": 4, "r5.2xlarge": 4, "r5.4xlarge": 8,
+}
+
+
+def _get_resource(resources: List[dict], name: str, default=None):
+    for item in resources:
+        if item["name"] == name:
+            if item.get("type") == "STRINGSET":
+                return item.get("stringSetValue", [])
+            return item.get("integerValue", 0)
+    return default
+
+
+def _as_int(value) -> int:
+    if value is None:
+        return 0
+    return int(value)
+
+
+def parse_task_cpu(value) -> Optional[int]:
+    """Task-level CPU in units, given as e.g. ``"1024"`` or ``"1 vCPU"``."""
+    if value is None or value == "":
+        return None
+    text = str(value).strip().lower()
+    if text.endswith("vcpu"):
+        return int(float(text[:-len("vcpu")]) * 1024)
+    return int(text)
+
+
+def parse_task_memory(value) -> Optional[int]:
+    """Task-level memory in MB, given as e.g. ``"2048"`` or ``"2 GB"``."""
+    if value is None or value == "":
+        return None
+    text = str(value).strip().lower()
+    if text.endswith("gb"):
+        return int(float(text[:-len("gb")]) * 1024)
+    if text.endswith("mb"):
+        text = text[:-len("mb")]
+    return int(text)
+
+
+class TaskRequirements:
+    """
+    What a single task needs from the instance it is placed on.
+
+    Parameters
+    ----------
+    cpu : int
+        Reserved CPU units.
+
+    mem : int
+        Reserved memory in MB.
+
+    gpu : int
+        Number of GPUs.
+
+    ports : Iterable[str]
+        Static TCP host ports.
+
+    udp_ports : Iterable[str]
+        Static UDP host ports.
+
+    enis : int
+        Number of elastic network interfaces needed. Tasks in ``awsvpc``
+        network mode need one each.
+
+    constraints : List[dict]
+        ECS placement constraints, i.e. ``distinctInstance`` and ``memberOf``.
+
+    strategy : List[dict]
+        ECS placement strategy. Only ``spread`` is taken into account since
+        the other strategies do not change whether a task fits.
+
+    """
+
+    def __init__(self,
+                 cpu: int = 0,
+                 mem: int = 0,
+                 gpu: int = 0,
+                 ports: Iterable[str] = None,
+                 udp_ports: Iterable[str] = None,
+                 enis: int = 0,
+                 constraints: List[dict] = None,
+                 strategy: List[dict] = None) -> None:
+        self.cpu = cpu
+        self.mem = mem
+        self.gpu = gpu
+        self.ports: FrozenSet[str] = frozenset(ports or [])
+        self.udp_ports: FrozenSet[str] = frozenset(udp_ports or [])
+        self.enis = enis
+        self.constraints = constraints or []
+        self.strategy = strategy or []
+
+    @property
+    def distinct_instance(self) -> bool:
+        return any(c["type"] == "distinctInstance" for c in self.constraints)
+
+    @property
+    def spread_field(self) -> Optional[str]:
+        for item in self.strategy:
+            if item["type"] == "spread" and item.get("field"):
+                return item["field"]
+        return None
+
+    @classmethod
+    def from_task_definition(
+            cls,
+            task_definition: dict,
+            constraints: List[dict] = None,
+            strategy: List[dict] = None) -> "TaskRequirements":
+        """
+        Build the requirements of a task from its ECS task definition,
+        following the reservation rules of ECS: task-level CPU and memory
+        are reserved as a whole when they are set. Otherwise containers
+        reserve their soft memory limit (`memoryReservation`) if they have
+        one and their hard limit (`memory`) if not, and no CPU unless they
+        set `cpu`.
+        """
+        network_mode = task_definition.get("networkMode", "bridge")
+        cpu = 0
+        mem = 0
+        gpu = 0
+        ports = set()
+        udp_ports = set()
+        for container in task_definition["containerDefinitions"]:
+            cpu += _as_int(container.get("cpu"))
+            mem += _as_int(container.get("memoryReservation") or
+                           container.get("memory"))
+            for item in container.get("resourceRequirements", []):
+                if item["type"] == "GPU":
+                    gpu += int(item["value"])
+            if network_mode == "awsvpc":
+                continue
+            for mapping in container.get("portMappings", []):
+                host_port = mapping.get("hostPort")
+                if network_mode == "host":
+                    host_port = host_port or mapping.get("containerPort")
+                if not host_port:
+                    # Dynamic port mapping, never conflicts.
+                    continue
+                if mapping.get("protocol", "tcp") == "udp":
+                    udp_ports.add(str(host_port))
+                else:
+                    ports.add(str(host_port))
+
+        task_cpu = parse_task_cpu(task_definition.get("cpu"))
+        if task_cpu is not None:
+            cpu = task_cpu
+        task_mem = parse_task_memory(task_definition.get("memory"))
+        if task_mem is not None:
+            mem = task_mem
+
+        # Constraints can be declared on both the service and the task
+        # definition, ECS enforces all of them.
+        all_constraints = list(constraints or []) + \
+            list(task_definition.get("placementConstraints", []))
+
+        return cls(cpu=cpu, mem=mem, gpu=gpu, ports=ports,
+                   udp_ports=udp_ports, enis=int(network_mode == "awsvpc"),
+                   constraints=all_constraints, strategy=strategy)
+
+
+class InstanceState:
+    """
+    The simulated free resources of a single container instance.
+
+    Parameters
+    ----------
+    instance_id : str
+        The EC2 instance ID.
+
+    cpu : int
+        Remaining CPU units.
+
+    mem : int
+        Remaining memory in MB.
+
+    gpu : int
+        Remaining GPUs.
+
+    used_ports : Iterable[str]
+        TCP host ports already bound on the instance.
+
+    used_udp_ports : Iterable[str]
+        UDP host ports already bound on the instance.
+
+    eni : int
+        Remaining elastic network interfaces, or ``None`` if not limited.
+
+    attributes : dict
+        Instance attributes, e.g. ``ecs.availability-zone``.
+
+    arn : str
+        The container instance ARN.
+
+    registered_cpu : int
+        Registered CPU units, defaults to `cpu`.
+
+    registered_mem : int
+        Registered memory in MB, defaults to `mem`.
+
+    """
+
+    def __init__(self,
+                 instance_id: str,
+                 cpu: int,
+                 mem: int,
+                 gpu: int = 0,
+                 used_ports: Iterable[str] = None,
+                 used_udp_ports: Iterable[str] = None,
+                 eni: int = None,
+                 attributes: dict = None,
+                 arn: str = None,
+                 registered_cpu: int = None,
+                 registered_mem: int = None) -> None:
+        self.instance_id = instance_id
+        self.cpu = cpu
+        self.mem = mem
+        self.registered_cpu = cpu if registered_cpu is None else registered_cpu
+        self.registered_mem = mem if registered_mem is None else registered_mem
+        self.gpu = gpu
+        self.used_ports = set(used_ports or [])
+        self.used_udp_ports = set(used_udp_ports or [])
+        self.eni = eni
+        self.attributes = attributes or {}
+        self.arn = arn
+        self.service_tasks: Counter = Counter()
+
+    @property
+    def az(self) -> Optional[str]:
+        return self.attributes.get(AZ_ATTRIBUTE)
+
+    @classmethod
+    def from_container_instance(cls, instance: dict) -> "InstanceState":
+        """Build an instance's state from `describe_container_instances`."""
+        remaining = instance["remainingResources"]
+        cpu = _get_resource(remaining, "CPU")
+        mem = _get_resource(remaining, "MEMORY")
+        if cpu is None:
+            raise MissingResourceValueError("CPU available")
+        if mem is None:
+            raise MissingResourceValueError("memory available")
+        gpus = _get_resource(remaining, "GPU", [])
+
+        attributes = {
+            item["name"]: item.get("value")
+            for item in instance.get("attributes", [])
+        }
+
+        eni = None
+        instance_type = attributes.get(INSTANCE_TYPE_ATTRIBUTE)
+        if instance_type in MAX_ENIS and TRUNK_ATTRIBUTE not in attributes:
+            attached = sum(
+                1 for x in instance.get("attachments", [])
+                if x.get("type") == "ElasticNetworkInterface"
+            )
+            eni = max(MAX_ENIS[instance_type] - 1 - attached, 0)
+
+        return cls(
+            instance["ec2InstanceId"],
+            cpu,
+            mem,
+            gpu=len(gpus),
+            used_ports=_get_resource(remaining, "PORTS", []),
+            used_udp_ports=_get_resource(remaining, "PORTS_UDP", []),
+            eni=eni,
+            attributes=attributes,
+            arn=instance.get("containerInstanceArn"),
+            registered_cpu=_get_resource(
+                instance.get("registeredResources", []), "CPU"),
+            registered_mem=_get_resource(
+                instance.get("registeredResources", []), "MEMORY"),
+        )
+
+    @classmethod
+    def launching(cls, template: dict, instance_id: str) -> "InstanceState":
+        """
+        Model an instance that is still launching as an empty copy of
+        `template`, a container instance from `describe_container_instances`.
+        Its availability zone is not known yet.
+        """
+        registered = template["registeredResources"]
+        state = cls.from_container_instance(
+            dict(template, remainingResources=registered, attachments=[]))
+        state.instance_id = instance_id
+        state.arn = None
+        state.attributes.pop(AZ_ATTRIBUTE, None)
+        return state
+
+    def fits(self, task: TaskRequirements, service_name: str = None) -> bool:
+        """Check if a task can be placed on this instance."""
+        if task.cpu > self.cpu or task.mem > self.mem or task.gpu > self.gpu:
+            return False
+        if task.ports & self.used_ports or \
+                task.udp_ports & self.used_udp_ports:
+            return False
+        if task.enis and self.eni is not None and task.enis > self.eni:
+            return False
+        for constraint in task.constraints:
+            if constraint["type"] == "distinctInstance":
+                if service_name is not None and \
+                        self.service_tasks[service_name]:
+                    return False
+            elif constraint["type"] == "memberOf":
+                if not matches_expression(constraint.get("expression", ""),
+                                          self):
+                    return False
+        return True
+
+    def reserve(self,
+                task: TaskRequirements,
+                service_name: str = None) -> None:
+        """Reserve the resources of a task on this instance."""
+        self.cpu -= task.cpu
+        self.mem -= task.mem
+        self.gpu -= task.gpu
+        self.used_ports |= task.ports
+        self.used_udp_ports |= task.udp_ports
+        if self.eni is not None:
+            self.eni -= task.enis
+        if service_name is not None:
+            self.service_tasks[service_name] += 1
+
+
+_CLAUSE_RE = re.compile(
+    r"^\s*(?P<field>[\w.:-]+)\s*"
+    r"(?P<op>==|!=|=~|!~|not\s+in|in|not\s+exists|exists)\s*"
+    r"(?P<value>.*?)\s*$"
+)
+
+
+def _is_supported_field(field: str) -> bool:
+    return field.startswith("attribute:") or field == "ec2InstanceId"
+
+
+def _instance_field(field: str, instance: InstanceState) -> Optional[str]:
+    if field.startswith("attribute:"):
+        return instance.attributes.get(field[len("attribute:"):])
+    if field == "ec2InstanceId":
+        return instance.instance_id
+    return None
+
+
+def _matches_clause(clause: str, instance: InstanceState) -> bool:
+    match = _CLAUSE_RE.match(clause)
+    if not match:
+        logger.warning("Unsupported placement expression %r, ignoring", clause)
+        return True
+    field = match.group("field")
+    if not _is_supported_field(field):
+        logger.warning("Unsupported placement expression field %r in %r, "
+                       "ignoring", field, clause)
+        return True
+    op = " ".join(match.group("op").split())
+    value = match.group("value").strip()
+    actual = _instance_field(field, instance)
+
+    if op == "exists":
+        return actual is not None
+    if op == "not exists":
+        return actual is None
+    if op in ("in", "not in"):
+        options = [x.strip() for x in value.strip("[]()").split(",")]
+        result = actual in options
+        return result if op == "in" else not result
+    if op in ("=~", "!~"):
+        result = actual is not None and fnmatch.fnmatchcase(actual, value)
+        return result if op == "=~" else not result
+    if op == "==":
+        return actual == value
+    return actual != value
+
+
+def matches_expression(expression: str, instance: InstanceState) -> bool:
+    """
+    Evaluate a cluster query language expression against an instance.
+
+    Only the subset of the language that is used in `memberOf` constraints in
+    practice is supported: comparisons on attributes and `ec2InstanceId`
+    joined with `and` / `or`. Clauses on other fields, like `task:group`, are
+    ignored.
+    """
+    if not expression.strip():
+        return True
+    for disjunct in re.split(r"\s+or\s+", expression):
+        clauses = re.split(r"\s+and\s+", disjunct.strip().strip("()"))
+        if all(_matches_clause(clause, instance) for clause in clauses):
+            return True
+    return False
+
+
+class PlacementSimulator:
+    """
+    Simulates placing tasks onto a set of instances.
+
+    Parameters
+    ----------
+    instances : List[InstanceState]
+        The instances available for placement.
+
+    """
+
+    def __init__(self, instances: List[InstanceState]) -> None:
+        self.instances = instances
+        self._az_counts: Dict[str, Counter] = {}
+
+    @classmethod
+    def from_container_instances(
+            cls, instances: List[dict]) -> "PlacementSimulator":
+        return cls([InstanceState.from_container_instance(x)
+                    for x in instances])
+
+    def register_tasks(self,
+                       service_name: str,
+                       container_instance_arns: Iterable[str]) -> None:
+        """Record which instances already run tasks of a service."""
+        by_arn = {x.arn: x for x in self.instances}
+        for arn in container_instance_arns:
+            instance = by_arn.get(arn)
+            if instance is None:
+                continue
+            instance.service_tasks[service_name] += 1
+            if instance.az is not None:
+                counts = self._az_counts.setdefault(service_name, Counter())
+                counts[instance.az] += 1
+
+    def remove(self, instance_id: str) -> Optional[InstanceState]:
+        """Take an instance out of the simulation and return it."""
+        for i, instance in enumerate(self.instances):
+            if instance.instance_id == instance_id:
+                return self.instances.pop(i)
+        return None
+
+    def place(self,
+              task: TaskRequirements,
+              service_name: str = None) -> Optional[InstanceState]:
+        """
+        Place a task and return the instance it landed on, or `None` if no
+        instance can take it.
+        """
+        candidates = [x for x in self.instances if x.fits(task, service_name)]
+        if not candidates:
+            return None
+
+        if task.spread_field == "attribute:" + AZ_ATTRIBUTE and \
+                service_name is not None:
+            counts = self._az_counts.setdefault(service_name, Counter())
+            # Stable: first candidate within the least loaded zone.
+            chosen = min(candidates, key=lambda x: counts[x.az])
+            counts[chosen.az] += 1
+        else:
+            chosen = candidates[0]
+
+        chosen.reserve(task, service_name)
+        return chosen
+
+    def place_many(self,
+                   task: TaskRequirements,
+                   count: int,
+                   service_name: str = None) -> int:
+        """Place up to `count` tasks, returning how many could be placed."""
+        for i in range(count):
+            if self.place(task, service_name) is None:
+                return i
+        return count
+
+
+def instance_block(instance: dict) -> TaskRequirements:
+    """
+    The combined requirements of everything currently running on an instance,
+    used when checking whether the instance could be drained.
+    """
+    registered = instance["registeredResources"]
+    remaining = instance["remainingResources"]
+
+    def used(name):
+        return _as_int(_get_resource(registered, name, 0)) - \
+            _as_int(_get_resource(remaining, name, 0))
+
+    gpus_used = len(_get_resource(registered, "GPU", [])) - \
+        len(_get_resource(remaining, "GPU", []))
+    # Ports reserved by the agent show up as registered ports on every
+    # instance, only the ones bound by tasks need to move.
+    ports = set(_get_resource(remaining, "PORTS", [])) - \
+        set(_get_resource(registered, "PORTS", []))
+    udp_ports = set(_get_resource(remaining, "PORTS_UDP", [])) - \
+        set(_get_resource(registered, "PORTS_UDP", []))
+    enis = sum(1 for x in instance.get("attachments", [])
+               if x.get("type") == "ElasticNetworkInterface")
+
+    return TaskRequirements(cpu=used("CPU"), mem=used("MEMORY"),
+                            gpu=gpus_used, ports=ports, udp_ports=udp_ports,
+                            enis=enis)
@@ -0,0 +1,269 @@
+"""
+Profiling a single invocation.
+
+With ``"profile": true`` in the event, or `PROFILE_TICKS` set, the tick runs
+under cProfile and tracemalloc. Every phase of the tick is profiled on its
+own: loading the cluster definitions, the four numbered steps of scaling
+clusters, and saving state. The report lists the wall time, the functions
+with the most cumulative time and the lines that allocated the most memory
+for each phase. It is logged, and written to `PROFILE_DIR` along with the
+raw profile in pstats format (e.g. for snakeviz).
+
+cProfile only sees the thread a phase runs in, so time spent in the threads
+of metric sources shows up as waiting in step 1. When profiling is off,
+`phase` hands out one shared no-op context manager.
+"""
+
+import contextlib
+import cProfile
+from datetime import datetime, timezone
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+PROFILE_TICKS = os.environ.get("PROFILE_TICKS", "").lower() in \
+    ("1", "true", "yes")
+
+# Where reports are written, nothing is written when empty.
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/ecsautoscale/profiles")
+
+# Number of functions and allocation sites listed per phase.
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", "15"))
+
+LOAD = "load cluster definitions"
+SERVICES = "(1 / 4) services and metrics"
+HEADROOM = "(2 / 4) headroom"
+INSTANCES = "(3 / 4) EC2 instances"
+SCALE_SERVICES = "(4 / 4) scale services"
+SAVE = "save state"
+
+PHASES = [LOAD, SERVICES, HEADROOM, INSTANCES, SCALE_SERVICES, SAVE]
+
+# Allocations by the profilers themselves are left out.
+_IGNORED_FILES = [tracemalloc.__file__, cProfile.__file__, pstats.__file__,
+                  __file__, "<frozen importlib._bootstrap>",
+                  "<frozen importlib._bootstrap_external>", "<unknown>"]
+
+
+class PhaseProfile:
+    """What was measured for one phase, over all the times it ran."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.count = 0
+        self.wall = 0.0
+        self.stats: Optional[pstats.Stats] = None
+        # (file:line) -> [bytes, blocks]
+        self.allocations: Dict[str, List[int]] = {}
+
+    def add(self,
+            profile: Optional[cProfile.Profile],
+            wall: float,
+            allocations: List[tracemalloc.StatisticDiff]) -> None:
+        self.count += 1
+        self.wall += wall
+        if profile is not None:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+        for item in allocations:
+            frame = item.traceback[0]
+            key = "{:s}:{:d}".format(frame.filename, frame.lineno)
+            totals = self.allocations.setdefault(key, [0, 0])
+            totals[0] += item.size_diff
+            totals[1] += item.count_diff
+
+
+class Profiler:
+    """
+    Profiles the phases of a tick.
+
+    Parameters
+    ----------
+    top : int
+        Number of functions and allocation sites listed per phase.
+
+    trace_memory : bool
+        Trace allocations with tracemalloc.
+
+    """
+
+    def __init__(self, top: int = PROFILE_TOP, trace_memory: bool = True):
+        self.top = top
+        self.trace_memory = trace_memory
+        self.phases: Dict[str, PhaseProfile] = {}
+        self.wall = 0.0
+        self.peak_memory = 0
+        self._started = 0.0
+        self._started_tracing = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        self._started = time.perf_counter()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self) -> None:
+        self.wall = time.perf_counter() - self._started
+        if tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def _snapshot(self) -> Optional[tracemalloc.Snapshot]:
+        if not tracemalloc.is_tracing():
+            return None
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, x) for x in _IGNORED_FILES])
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Profile a phase. Nested phases pause the phase they run in."""
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        if stack and stack[-1] is not None:
+            stack[-1].disable()
+
+        before = self._snapshot()
+        profile: Optional[cProfile.Profile] = None
+        started = time.perf_counter()
+        try:
+            profile = cProfile.Profile()
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12 only one profiler can be active at a time,
+            # phases running in parallel threads only get timed.
+            profile = None
+        stack.append(profile)
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            wall = time.perf_counter() - started
+            stack.pop()
+            allocations: List[tracemalloc.StatisticDiff] = []
+            after = self._snapshot()
+            if before is not None and after is not None:
+                allocations = [x for x in after.compare_to(before, "lineno")
+                               if x.size_diff > 0][:self.top]
+            with self._lock:
+                if name not in self.phases:
+                    self.phases[name] = PhaseProfile(name)
+                self.phases[name].add(profile, wall, allocations)
+            if stack and stack[-1] is not None:
+                stack[-1].enable()
+
+    def _ordered(self) -> List[PhaseProfile]:
+        order = {name: i for i, name in enumerate(PHASES)}
+        return sorted(self.phases.values(),
+                      key=lambda x: (order.get(x.name, len(order)), x.name))
+
+    def report(self) -> str:
+        """A text report of every phase."""
+        lines = ["Profile of tick: {:.3f}s wall, {:.1f} KiB peak traced memory"
+                 .format(self.wall, self.peak_memory / 1024)]
+        for item in self._ordered():
+            lines.append("")
+            lines.append("== {:s}: {:.3f}s wall over {:d} run(s)".format(
+                item.name, item.wall, item.count))
+            if item.stats is not None:
+                out = io.StringIO()
+                stats = pstats.Stats(stream=out)
+                stats.add(item.stats)
+                stats.sort_stats("cumulative").print_stats(self.top)
+                lines += [x for x in out.getvalue().splitlines()
+                          if x.strip()]
+            if item.allocations:
+                lines.append("Top allocations:")
+                top = sorted(item.allocations.items(),
+                             key=lambda x: -x[1][0])[:self.top]
+                for site, (size, blocks) in top:
+                    lines.append("{:>10.1f} KiB {:>7d} blocks  {:s}".format(
+                        size / 1024, blocks, site))
+        return "\n".join(lines)
+
+    def save(self, directory: str) -> Optional[str]:
+        """
+        Write the report and the combined pstats profile to `directory`,
+        returning the path of the report.
+        """
+        stats = [x.stats for x in self._ordered() if x.stats is not None]
+        name = datetime.now(timezone.utc).strftime("profile-%Y%m%dT%H%M%S.%f")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, name + ".txt")
+            with open(path, "w", encoding="utf-8") as outfile:
+                outfile.write(self.report() + "\n")
+            if stats:
+                combined = stats[0]
+                for item in stats[1:]:
+                    combined.add(item)
+                combined.dump_stats(os.path.join(directory, name + ".pstats"))
+        except OSError as ex:
+            logger.warning("Could not write profile to %s: %s", directory, ex)
+            return None
+        return path
+
+
+# The profiler of the tick in progress, if it is being profiled.
+profiler: Optional[Profiler] = None
+
+class _NotProfiled:
+    """A context manager that does nothing, for phases of unprofiled ticks."""
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+
+_NOT_PROFILED = _NotProfiled()
+
+
+def phase(name: str):
+    """Profile a phase of the tick, if the tick is being profiled."""
+    if profiler is None:
+        return _NOT_PROFILED
+    return profiler.phase(name)
+
+
+@contextlib.contextmanager
+def profiling(enabled: bool = False, directory: str = None):
+    """
+    Profile the block if `enabled` or `PROFILE_TICKS` is set, then log the
+    report and write it to `directory` (`PROFILE_DIR` by default).
+    """
+    global profiler  # pylint: disable=global-statement
+    if not (enabled or PROFILE_TICKS) or profiler is not None:
+        yield None
+        return
+    profiler = Profiler()
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        current, profiler = profiler, None
+        current.stop()
+        logger.info(current.report())
+        directory = PROFILE_DIR if directory is None else directory
+        if directory:
+            path = current.save(directory)
+            if path:
+                logger.info("Wrote profile to %s", path)
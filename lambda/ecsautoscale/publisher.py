@@ -0,0 +1,243 @@
+"""
+Publishes what the autoscaler sees and decides as CloudWatch metrics.
+
+Per cluster: reserved and available CPU and memory, instance counts and the
+scaling decision. Per service: running, pending and desired counts, the
+decided change in tasks, and the headroom, i.e. how many more tasks of the
+service would fit on the current instances.
+
+Values are collected during a tick and sent in one go at the end of it,
+either with batched `PutMetricData` calls (``PUBLISH_METRICS=cloudwatch``)
+or as embedded metric format log lines (``PUBLISH_METRICS=emf``), which cost
+no API calls at all.
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, TextIO, Tuple
+
+from . import cdw_client
+from .instances import (
+    build_simulator, count_launching_instances, get_cpu_avail, get_cpu_used,
+    get_mem_avail, get_mem_used,
+)
+from .services import Service
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# "cloudwatch", "emf", or empty to disable publishing.
+PUBLISH_METRICS = os.environ.get("PUBLISH_METRICS", "").lower()
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ECSAutoscale")
+
+# Headroom is counted up to this many tasks.
+HEADROOM_LIMIT = int(os.environ.get("HEADROOM_LIMIT", "100"))
+
+# Values per `PutMetricData` call.
+MAX_DATUMS_PER_CALL = 1000
+
+# Metrics per embedded metric format document.
+MAX_EMF_METRICS = 100
+
+Dimensions = Tuple[Tuple[str, str], ...]
+
+
+class MetricsPublisher:
+    """
+    Collects metric values during a tick and publishes them with `flush`.
+
+    Parameters
+    ----------
+    mode : str
+        ``cloudwatch``, ``emf`` or empty to disable publishing.
+
+    namespace : str
+        The CloudWatch namespace.
+
+    clock : Callable
+        Returns the current Unix time.
+
+    stream : TextIO
+        Where embedded metric format documents are written, stdout by default.
+
+    """
+
+    def __init__(self,
+                 mode: str = PUBLISH_METRICS,
+                 namespace: str = METRICS_NAMESPACE,
+                 clock: Callable = time.time,
+                 stream: TextIO = None) -> None:
+        if mode not in ("", "cloudwatch", "emf"):
+            raise ValueError("Unknown metrics publishing mode: " + mode)
+        self.mode = mode
+        self.namespace = namespace
+        self.clock = clock
+        self.stream = stream
+        # (dimensions, name) -> (value, unit), so that the last value wins.
+        self._values: Dict[Tuple[Dimensions, str], Tuple[float, str]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.mode)
+
+    def add(self,
+            name: str,
+            value: float,
+            unit: str = "Count",
+            **dimensions: str) -> None:
+        if not self.enabled:
+            return
+        key = (tuple(sorted(dimensions.items())), name)
+        with self._lock:
+            self._values[key] = (float(value), unit)
+
+    def flush(self) -> int:
+        """Publish everything collected so far, returning the value count."""
+        with self._lock:
+            values, self._values = self._values, {}
+        if not values:
+            return 0
+        try:
+            if self.mode == "emf":
+                self._write_emf(values)
+            else:
+                self._put_metric_data(values)
+        except Exception as ex:  # pylint: disable=broad-except
+            # Metrics are nice to have, never fail the tick over them.
+            logger.warning("Could not publish metrics: %s", ex)
+            return 0
+        return len(values)
+
+    def _put_metric_data(self, values: dict) -> None:
+        timestamp = datetime.fromtimestamp(self.clock(), tz=timezone.utc)
+        data = [
+            {
+                "MetricName": name,
+                "Dimensions": [{"Name": k, "Value": v} for k, v in dimensions],
+                "Timestamp": timestamp,
+                "Value": value,
+                "Unit": unit,
+            }
+            for (dimensions, name), (value, unit) in sorted(values.items())
+        ]
+        for i in range(0, len(data), MAX_DATUMS_PER_CALL):
+            cdw_client.put_metric_data(
+                Namespace=self.namespace,
+                MetricData=data[i:i + MAX_DATUMS_PER_CALL],
+            )
+
+    def _write_emf(self, values: dict) -> None:
+        by_dimensions: Dict[Dimensions, List[Tuple[str, float, str]]] = {}
+        for (dimensions, name), (value, unit) in sorted(values.items()):
+            by_dimensions.setdefault(dimensions, []).append(
+                (name, value, unit))
+
+        stream = self.stream or sys.stdout
+        timestamp = int(self.clock() * 1000)
+        for dimensions, metrics in by_dimensions.items():
+            for i in range(0, len(metrics), MAX_EMF_METRICS):
+                chunk = metrics[i:i + MAX_EMF_METRICS]
+                doc: dict = {"_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": self.namespace,
+                        "Dimensions": [[k for k, _ in dimensions]],
+                        "Metrics": [{"Name": name, "Unit": unit}
+                                    for name, _, unit in chunk],
+                    }],
+                }}
+                doc.update(dimensions)
+                doc.update({name: value for name, value, _ in chunk})
+                stream.write(json.dumps(doc) + "\n")
+        stream.flush()
+
+
+publisher = MetricsPublisher()
+
+
+def service_headroom(instances: List[dict],
+                     service: Service,
+                     limit: int = HEADROOM_LIMIT) -> int:
+    """How many more tasks of `service` fit on `instances`, up to `limit`."""
+    simulator = build_simulator(instances, [service])
+    return simulator.place_many(service.requirements, limit,
+                                service.service_name)
+
+
+def _percent(part: int, total: int) -> float:
+    return 100.0 * part / total if total else 0.0
+
+
+def record_cluster(cluster_name: str,
+                   report: dict,
+                   services: List[Service],
+                   metrics: Optional[MetricsPublisher] = None) -> None:
+    """
+    Record the metrics of a cluster and its services, given the `report` of
+    `scale_ec2_instances`. Without one, e.g. for clusters running only on
+    Fargate, only the metrics of the services are recorded.
+    """
+    metrics = metrics or publisher
+    if not metrics.enabled:
+        return
+    active: List[dict] = []
+    if "cluster_data" in report:
+        active = _record_instances(cluster_name, report, metrics)
+
+    for service in services:
+        if service.service_name is None:
+            continue
+        dimensions = {"Cluster": cluster_name, "Service": service.service_name}
+        metrics.add("RunningCount", service.task_count, **dimensions)
+        metrics.add("PendingCount", service.pending_count, **dimensions)
+        metrics.add("DesiredCount", service.desired_count, **dimensions)
+        metrics.add("TaskDiff", service.task_diff, **dimensions)
+        if active and not service.fargate and \
+                service.task_definition_loaded:
+            metrics.add("Headroom", service_headroom(active, service),
+                        **dimensions)
+
+
+def _record_instances(cluster_name: str,
+                      report: dict,
+                      metrics: MetricsPublisher) -> List[dict]:
+    cluster_data = report["cluster_data"]
+    asg_group_data = report["asg_group_data"]
+    active = cluster_data["active_container_described"]["containerInstances"]
+    draining = \
+        cluster_data["draining_container_described"]["containerInstances"]
+
+    cpu_used = sum(get_cpu_used(x) for x in active)
+    cpu_avail = sum(get_cpu_avail(x) for x in active)
+    mem_used = sum(get_mem_used(x) for x in active)
+    mem_avail = sum(get_mem_avail(x) for x in active)
+    action = report.get("action")
+    for name, value, unit in [
+            ("ActiveInstances", len(active), "Count"),
+            ("DrainingInstances", len(draining), "Count"),
+            ("LaunchingInstances",
+             count_launching_instances(cluster_data, asg_group_data), "Count"),
+            ("DesiredCapacity", asg_group_data["DesiredCapacity"], "Count"),
+            ("CPUReserved", cpu_used, "None"),
+            ("CPUAvailable", cpu_avail, "None"),
+            ("MemoryReserved", mem_used, "Megabytes"),
+            ("MemoryAvailable", mem_avail, "Megabytes"),
+            ("CPUReservation", _percent(cpu_used, cpu_used + cpu_avail),
+             "Percent"),
+            ("MemoryReservation", _percent(mem_used, mem_used + mem_avail),
+             "Percent"),
+            ("ScaledOut", int(action == "scale_up"), "Count"),
+            ("ScaledIn", int(action == "scale_down"), "Count"),
+            ("Skipped", int(action == "skipped"), "Count"),
+    ]:
+        metrics.add(name, value, unit, Cluster=cluster_name)
+    return active
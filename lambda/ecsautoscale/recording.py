@@ -0,0 +1,647 @@
+"""
+Recording ticks and replaying them offline.
+
+With `RECORD_TICKS` set to a directory or to ``s3://bucket/prefix/``, every
+invocation writes a recording of its tick: the event, the cluster
+definitions, the state carried over from the previous tick, and every AWS
+API call and HTTP request made by metric sources, along with the responses.
+Recordings are gzipped JSON lines, one line per call.
+
+`replay` runs `lambda_handler` against a recording without any network
+access. AWS calls and HTTP requests are answered from the recording,
+matched by their parameters in the order they were made. Timestamps in AWS
+parameters and the evaluation time of Prometheus queries are ignored when
+matching, since they change with the clock. Calls that change something,
+like `update_service`, are collected as the actions of the replayed tick,
+so a replay shows what the tick did, or would do after a code change.
+
+Recordings leave out secrets: the credentials of assumed roles, decrypted
+SSM parameters and secrets, and passwords and token-like query parameters
+and form fields of HTTP requests are replaced by ``<redacted>``, both in
+what is recorded and in what calls are matched by.
+"""
+
+import base64
+from collections import deque
+from contextlib import contextmanager
+import copy
+from datetime import datetime, timezone
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from dateutil.parser import isoparse
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+import yaml
+
+from . import clients, http, s3_client, state
+from .exceptions import ReplayMissError
+from .services import _task_definitions
+from .state import StateStore, use_store
+from .throttling import READ_PREFIXES
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# Where recordings are written, a directory or ``s3://bucket/prefix/``.
+# Empty to disable recording.
+RECORD_TICKS = os.environ.get("RECORD_TICKS", "")
+
+# Recordings kept in a local directory, oldest ones are removed first.
+RECORD_KEEP = int(os.environ.get("RECORD_KEEP", "50"))
+
+FORMAT_VERSION = 1
+
+# Form fields of HTTP requests that change on every tick.
+VOLATILE_FIELDS = {"time"}
+
+REDACTED = "<redacted>"
+
+# Fields of AWS responses that hold secrets, by service.
+SECRET_FIELDS = {
+    "sts": {"AccessKeyId", "SecretAccessKey", "SessionToken"},
+    "ssm": {"Value"},
+    "secretsmanager": {"SecretString", "SecretBinary"},
+}
+
+# Query parameters and form fields of HTTP requests that hold secrets.
+SECRET_PARAMS = re.compile(
+    r"token|key|secret|passw|pwd|auth|signature|credential", re.IGNORECASE)
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    return str(value)
+
+
+def _decode(obj: dict) -> Any:
+    if len(obj) == 1:
+        if "__datetime__" in obj:
+            return isoparse(obj["__datetime__"])
+        if "__bytes__" in obj:
+            return base64.b64decode(obj["__bytes__"])
+        if "__body__" in obj:
+            data = base64.b64decode(obj["__body__"])
+            return StreamingBody(io.BytesIO(data), len(data))
+    return obj
+
+
+def _mask(value: Any) -> str:
+    if isinstance(value, datetime):
+        return "<time>"
+    return str(value)
+
+
+def _redact(value: Any, fields: set) -> Any:
+    if isinstance(value, dict):
+        return {k: REDACTED if k in fields else _redact(v, fields)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact(x, fields) for x in value]
+    return value
+
+
+def redact_response(service: str, response: dict) -> dict:
+    """A copy of an AWS response without the secrets in it."""
+    fields = SECRET_FIELDS.get(service)
+    return _redact(response, fields) if fields else response
+
+
+def _redact_fields(fields: List[tuple]) -> List[tuple]:
+    return [(k, REDACTED if SECRET_PARAMS.search(k) else v)
+            for k, v in fields]
+
+
+def redact_url(url: str) -> str:
+    """A URL without its password and secret query parameters.
+
+    A user name without a password is redacted too, it is often a token.
+    """
+    parts = urlsplit(url)
+    netloc = parts.netloc
+    if parts.password is not None:
+        netloc = "{:s}:{:s}@{:s}".format(parts.username or "", REDACTED,
+                                         netloc.rpartition("@")[2])
+    elif parts.username:
+        netloc = "{:s}@{:s}".format(REDACTED, netloc.rpartition("@")[2])
+    query = parts.query
+    if query:
+        query = urlencode(_redact_fields(
+            parse_qsl(query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme, netloc, parts.path, query,
+                       parts.fragment))
+
+
+def redact_cluster_defs(value: Any) -> Any:
+    """A copy of cluster definitions without the secrets in them.
+
+    Values of fields whose names look like tokens, keys or passwords,
+    e.g. an ``Authorization`` header, are replaced and URLs are passed
+    through `redact_url`.
+    """
+    if isinstance(value, dict):
+        return {k: REDACTED if isinstance(k, str) and SECRET_PARAMS.search(k)
+                else redact_cluster_defs(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact_cluster_defs(x) for x in value]
+    if isinstance(value, str) and "://" in value:
+        return redact_url(value)
+    return value
+
+
+def call_key(service: str,
+             region: Optional[str],
+             operation: str,
+             params: dict) -> str:
+    """What an AWS call is matched by when replaying."""
+    return json.dumps(["aws", service, region, operation, params],
+                      sort_keys=True, default=_mask)
+
+
+def request_key(request: requests.PreparedRequest) -> str:
+    """What an HTTP request is matched by when replaying."""
+    body = request.body
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    content_type = str(request.headers.get("Content-Type", ""))
+    if isinstance(body, str) and \
+            content_type.startswith("application/x-www-form-urlencoded"):
+        fields = [(k, v) for k, v in parse_qsl(body, keep_blank_values=True)
+                  if k not in VOLATILE_FIELDS]
+        body = urlencode(sorted(_redact_fields(fields)))
+    return json.dumps(["http", request.method,
+                       redact_url(request.url or ""), body])
+
+
+def _buffer_bodies(response: dict) -> Dict[str, bytes]:
+    """
+    Read streamed bodies, e.g. of `get_object`, so they can be recorded, and
+    put fresh streams over the data in their place.
+    """
+    bodies = {}
+    for key, value in list(response.items()):
+        if isinstance(value, StreamingBody):
+            data = value.read()
+            response[key] = StreamingBody(io.BytesIO(data), len(data))
+            bodies[key] = data
+    return bodies
+
+
+class Recorder:
+    """
+    Collects the calls of a tick and writes them to a recording.
+
+    Parameters
+    ----------
+    destination : str
+        A directory or ``s3://bucket/prefix/``.
+
+    clock : Callable
+        Returns the current Unix time.
+
+    """
+
+    def __init__(self, destination: str, clock: Callable = time.time) -> None:
+        self.destination = destination
+        self.started = clock()
+        self._entries: List[str] = []
+        self._lock = threading.Lock()
+
+    def add(self, entry: dict) -> None:
+        line = json.dumps(entry, sort_keys=True, default=_encode)
+        with self._lock:
+            self._entries.append(line)
+
+    def start(self, event: Any, state_data: dict) -> None:
+        self.add({"kind": "tick", "version": FORMAT_VERSION,
+                  "started": self.started, "event": event,
+                  "state": state_data})
+
+    def add_cluster_defs(self, cluster_defs: dict) -> None:
+        self.add({"kind": "cluster_defs",
+                  "cluster_defs": redact_cluster_defs(cluster_defs)})
+
+    def add_call(self,
+                 service: str,
+                 region: Optional[str],
+                 operation: str,
+                 params: dict,
+                 response: dict = None,
+                 error: dict = None,
+                 bodies: Dict[str, bytes] = None) -> None:
+        entry: Dict[str, Any] = {
+            "kind": "aws",
+            "key": call_key(service, region, operation, params),
+            "service": service, "region": region,
+            "operation": operation, "params": params,
+        }
+        if error is not None:
+            entry["error"] = error
+        else:
+            response = redact_response(service, response or {})
+            entry["response"] = dict(response, **{
+                key: {"__body__": base64.b64encode(data).decode("ascii")}
+                for key, data in (bodies or {}).items()
+            })
+        self.add(entry)
+
+    def add_request(self,
+                    request: requests.PreparedRequest,
+                    response: requests.Response = None,
+                    error: Exception = None) -> None:
+        entry: Dict[str, Any] = {
+            "kind": "http", "key": request_key(request),
+            "method": request.method, "url": redact_url(request.url or ""),
+        }
+        if error is not None:
+            entry["error"] = repr(error)
+        else:
+            assert response is not None
+            entry.update({
+                "status": response.status_code,
+                "reason": response.reason,
+                "headers": dict(response.headers),
+                "content": base64.b64encode(response.content).decode("ascii"),
+            })
+        self.add(entry)
+
+    def dumps(self) -> bytes:
+        with self._lock:
+            raw = "\n".join(self._entries) + "\n"
+        # A fixed mtime keeps recordings of the same tick identical.
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode="wb", mtime=0) as gzfile:
+            gzfile.write(raw.encode("utf-8"))
+        return out.getvalue()
+
+    @property
+    def filename(self) -> str:
+        started = datetime.fromtimestamp(self.started, tz=timezone.utc)
+        return started.strftime("tick-%Y%m%dT%H%M%S.%fZ.jsonl.gz")
+
+    def save(self) -> Optional[str]:
+        """Write the recording, returning where it went."""
+        # pylint: disable=broad-except
+        data = self.dumps()
+        try:
+            if self.destination.startswith("s3://"):
+                bucket, _, prefix = \
+                    self.destination[len("s3://"):].partition("/")
+                key = prefix + self.filename
+                s3_client.put_object(Bucket=bucket, Key=key, Body=data)
+                path = "s3://{:s}/{:s}".format(bucket, key)
+            else:
+                os.makedirs(self.destination, exist_ok=True)
+                path = os.path.join(self.destination, self.filename)
+                with open(path, "wb") as outfile:
+                    outfile.write(data)
+                self._prune()
+        except Exception as ex:
+            # Recording is a debugging aid, never fail the tick over it.
+            logger.warning("Could not save recording to %s: %s",
+                           self.destination, ex)
+            return None
+        logger.info("Recorded tick to %s (%d bytes)", path, len(data))
+        return path
+
+    def _prune(self) -> None:
+        names = sorted(x for x in os.listdir(self.destination)
+                       if x.startswith("tick-") and x.endswith(".jsonl.gz"))
+        for name in names[:max(len(names) - RECORD_KEEP, 0)]:
+            os.remove(os.path.join(self.destination, name))
+
+
+class RecordingClient:
+    """Wraps a boto3 client and records every call made through it."""
+
+    def __init__(self,
+                 client,
+                 service: str,
+                 region: Optional[str],
+                 recorder: Recorder) -> None:
+        self.client = client
+        self.service = service
+        self.region = region
+        self.recorder = recorder
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def method(**kwargs):
+            try:
+                res = attr(**kwargs)
+            except ClientError as ex:
+                self.recorder.add_call(self.service, self.region, name, kwargs,
+                                       error=ex.response)
+                raise
+            bodies = _buffer_bodies(res)
+            self.recorder.add_call(self.service, self.region, name, kwargs,
+                                   response=res, bodies=bodies)
+            return res
+        return method
+
+
+class RecordingSession:
+    """Wraps a boto3 session so that its clients record their calls."""
+
+    def __init__(self,
+                 session,
+                 recorder: Recorder,
+                 region: Optional[str]) -> None:
+        self.session = session
+        self.recorder = recorder
+        self.region = region
+
+    def client(self, service: str, **kwargs):
+        return RecordingClient(self.session.client(service, **kwargs),
+                               service, self.region, self.recorder)
+
+
+class RecordingAdapter(BaseAdapter):
+    """
+    Records HTTP requests and responses.
+
+    Parameters
+    ----------
+    recorder : Recorder
+        Where requests are recorded.
+
+    transport : BaseAdapter
+        The adapter that actually sends requests, `HTTPAdapter` by default.
+
+    """
+
+    def __init__(self, recorder: Recorder, transport: BaseAdapter = None):
+        super().__init__()
+        self.recorder = recorder
+        self.transport = transport or HTTPAdapter()
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        try:
+            resp = self.transport.send(request, **kwargs)
+        except requests.RequestException as ex:
+            self.recorder.add_request(request, error=ex)
+            raise
+        self.recorder.add_request(request, response=resp)
+        return resp
+
+    def close(self):
+        self.transport.close()
+
+
+class Replayer:
+    """
+    Answers calls from a recording.
+
+    Parameters
+    ----------
+    lines : List[str]
+        The lines of the recording.
+
+    name : str
+        The name of the recording, for error messages.
+
+    """
+
+    def __init__(self, lines: List[str], name: str = "recording") -> None:
+        self.name = name
+        self.event: Any = None
+        self.state: dict = {}
+        self.cluster_defs: dict = {}
+        self.actions: List[dict] = []
+        self.misses: List[str] = []
+        self._queues: Dict[str, Deque[dict]] = {}
+        self._lock = threading.Lock()
+
+        for line in lines:
+            if not line.strip():
+                continue
+            entry = json.loads(line, object_hook=_decode)
+            kind = entry["kind"]
+            if kind == "tick":
+                self.event = entry["event"]
+                self.state = entry["state"]
+            elif kind == "cluster_defs":
+                self.cluster_defs = entry["cluster_defs"]
+            else:
+                self._queues.setdefault(entry["key"], deque()).append(entry)
+
+    @classmethod
+    def load(cls, path: str) -> "Replayer":
+        with gzip.open(path, "rt", encoding="utf-8") as infile:
+            return cls(infile.read().splitlines(), name=path)
+
+    def _next(self, key: str) -> Optional[dict]:
+        with self._lock:
+            queue = self._queues.get(key)
+            return queue.popleft() if queue else None
+
+    def _miss(self, key: str) -> ReplayMissError:
+        with self._lock:
+            self.misses.append(key)
+        return ReplayMissError(key, self.name)
+
+    def call(self,
+             service: str,
+             region: Optional[str],
+             operation: str,
+             params: dict) -> dict:
+        read_only = operation.startswith(READ_PREFIXES)
+        if not read_only:
+            with self._lock:
+                self.actions.append({
+                    "service": service, "region": region,
+                    "operation": operation, "params": copy.deepcopy(params),
+                })
+        entry = self._next(call_key(service, region, operation, params))
+        if entry is None:
+            if not read_only:
+                # The tick does something it did not do when recorded.
+                return {}
+            raise self._miss(call_key(service, region, operation, params))
+        if "error" in entry:
+            raise ClientError(entry["error"], operation)
+        return entry["response"]
+
+    def request(self, request: requests.PreparedRequest) -> requests.Response:
+        entry = self._next(request_key(request))
+        if entry is None:
+            raise self._miss(request_key(request))
+        if "error" in entry:
+            raise requests.ConnectionError(entry["error"], request=request)
+        resp = requests.Response()
+        resp.status_code = entry["status"]
+        resp.reason = entry["reason"]
+        resp.headers = CaseInsensitiveDict(entry["headers"])
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        # pylint: disable=protected-access
+        resp._content = base64.b64decode(entry["content"])
+        resp.url = request.url or ""
+        resp.request = request
+        return resp
+
+    def unused(self) -> int:
+        """The number of recorded calls that were not replayed."""
+        with self._lock:
+            return sum(len(x) for x in self._queues.values())
+
+
+class ReplayClient:
+    """Stands in for a boto3 client and answers from a recording."""
+
+    def __init__(self,
+                 replayer: Replayer,
+                 service: str,
+                 region: Optional[str]) -> None:
+        self.replayer = replayer
+        self.service = service
+        self.region = region
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def method(**kwargs):
+            return self.replayer.call(self.service, self.region, name, kwargs)
+        return method
+
+
+class ReplaySession:
+    """Stands in for a boto3 session handing out replaying clients."""
+
+    def __init__(self, replayer: Replayer,
+                 region_name: Optional[str] = None) -> None:
+        self.replayer = replayer
+        self.region = region_name
+
+    def client(self, service: str) -> ReplayClient:
+        return ReplayClient(self.replayer, service, self.region)
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answers HTTP requests from a recording."""
+
+    def __init__(self, replayer: Replayer) -> None:
+        super().__init__()
+        self.replayer = replayer
+
+    def send(self, request, **_options):  # pylint: disable=arguments-differ
+        # Timeouts, proxies and TLS options don't apply to a recording.
+        return self.replayer.request(request)
+
+    def close(self):
+        pass
+
+
+# The recorder or replayer of the tick in progress.
+active = None
+
+
+@contextmanager
+def _activate(obj):
+    global active  # pylint: disable=global-statement
+    active = obj
+    try:
+        yield obj
+    finally:
+        active = None
+
+
+@contextmanager
+def recording(recorder: Recorder, event: Any = None):
+    """
+    Record every AWS call and HTTP request made in the block. Recording goes
+    through the clients and transport currently in use, so it also records
+    fake clients.
+    """
+    current = clients.pool
+    client_pool = clients.ClientPool(
+        session_factory=lambda **kwargs: RecordingSession(
+            current.session_factory(**kwargs), recorder,
+            kwargs.get("region_name")),
+        refresh_margin=current.refresh_margin,
+        role_session_name=current.role_session_name,
+        throttle=current.throttle,
+    )
+    transport = http._adapter  # pylint: disable=protected-access
+    recorder.start(event, state.store.dump())
+    # Cached task definitions would be missing from the recording.
+    _task_definitions.clear()
+    with clients.use_pool(client_pool), \
+            http.use_adapter(RecordingAdapter(recorder, transport)), \
+            _activate(recorder):
+        yield recorder
+
+
+def record_cluster_defs(cluster_defs: dict) -> None:
+    """Add the cluster definitions of the tick to its recording, if any."""
+    if isinstance(active, Recorder):
+        active.add_cluster_defs(cluster_defs)
+
+
+@contextmanager
+def replaying(replayer: Replayer):
+    """Answer every AWS call and HTTP request made in the block from a
+    recording, with the state and cluster definitions of the recording."""
+    client_pool = clients.ClientPool(
+        # Credentials of assumed roles are not needed to replay.
+        session_factory=lambda region_name=None, **_credentials:
+        ReplaySession(replayer, region_name),
+    )
+    state_store = StateStore()
+    state_store.restore(replayer.state)
+    previous = os.environ.get("CLUSTER_DEFS_SOURCE")
+    _task_definitions.clear()
+    with tempfile.TemporaryDirectory() as defs_dir:
+        for cluster_name, cluster_def in replayer.cluster_defs.items():
+            with open(os.path.join(defs_dir, cluster_name + ".yml"),
+                      "w", encoding="utf-8") as outfile:
+                yaml.safe_dump(cluster_def, outfile)
+        os.environ["CLUSTER_DEFS_SOURCE"] = defs_dir
+        try:
+            with clients.use_pool(client_pool), use_store(state_store), \
+                    http.use_adapter(ReplayAdapter(replayer)), \
+                    _activate(replayer):
+                yield replayer
+        finally:
+            if previous is None:
+                del os.environ["CLUSTER_DEFS_SOURCE"]
+            else:
+                os.environ["CLUSTER_DEFS_SOURCE"] = previous
+            _task_definitions.clear()
+
+
+def replay(path: str, handler: Callable, event: Any = None) -> dict:
+    """
+    Run `handler` offline against the recording at `path`, with the
+    recorded event unless another `event` is given.
+    """
+    replayer = Replayer.load(path)
+    with replaying(replayer):
+        handler(replayer.event if event is None else event, None)
+    return {
+        "recording": path,
+        "actions": replayer.actions,
+        "misses": replayer.misses,
+        "unused": replayer.unused(),
+    }
@@ -0,0 +1,349 @@
+"""
+Scheduled capacity profiles.
+
+A cluster definition can declare windows during which the cluster and its
+services get other `min` / `max` values, e.g. to have capacity in place before
+a daily peak instead of reacting to it:
+
+    schedules:
+      - name: business-hours
+        cron: "30 7 * * MON-FRI"   # When the window opens.
+        duration: 10h              # How long it stays open.
+        timezone: Europe/Berlin    # Defaults to UTC.
+        min: 4                     # Limits of the cluster's instances.
+        max: 12
+        services:
+          web: {min: 6, max: 30}
+
+Cron expressions have the usual five fields (minute, hour, day of month,
+month and day of week) with lists, ranges, steps and month and day names.
+When windows overlap, the highest `min` and `max` win.
+
+Schedules are parsed once per definition and finding the open windows only
+walks back over the days a window can span, so resolving them is cheap on
+every tick.
+"""
+
+import copy
+from datetime import date, datetime, time, timedelta, timezone
+import json
+import logging
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+from dateutil import tz
+
+from .exceptions import ScheduleError
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# How far ahead upcoming windows are listed, and at most how many of them
+# per schedule.
+UPCOMING_HORIZON = timedelta(days=1)
+MAX_UPCOMING = 10
+
+MONTHS = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP",
+          "OCT", "NOV", "DEC"]
+WEEKDAYS = ["SUN", "MON", "TUE", "WED", "THU", "FRI", "SAT"]
+
+Window = Tuple[datetime, datetime]
+
+
+def _parse_value(value: str, names: List[str], offset: int) -> int:
+    upper = value.upper()
+    if upper in names:
+        return names.index(upper) + offset
+    return int(value)
+
+
+def _parse_field(field: str,
+                 low: int,
+                 high: int,
+                 names: List[str] = None,
+                 offset: int = 0) -> List[int]:
+    values: Set[int] = set()
+    for part in field.split(","):
+        part, _, step = part.partition("/")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (_parse_value(x, names or [], offset)
+                          for x in part.split("-", 1))
+        else:
+            start = _parse_value(part, names or [], offset)
+            end = high if step else start
+        if not low <= start <= end <= high:
+            raise ValueError("{!r} is out of range".format(field))
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return sorted(values)
+
+
+class Cron:
+    """
+    A five field cron expression, evaluated in local wall time.
+
+    Parameters
+    ----------
+    expression : str
+        E.g. ``30 7 * * MON-FRI``.
+
+    """
+
+    def __init__(self, expression: str) -> None:
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("Expected 5 fields in {!r}".format(expression))
+        self.expression = expression
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = set(_parse_field(fields[2], 1, 31))
+        self.months = set(_parse_field(fields[3], 1, 12, MONTHS, 1))
+        # Both 0 and 7 are Sunday.
+        self.weekdays = {x % 7 for x in _parse_field(fields[4], 0, 7,
+                                                     WEEKDAYS)}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def matches_day(self, day: date) -> bool:
+        if day.month not in self.months:
+            return False
+        in_days = day.day in self.days
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays
+        # Like cron, a restricted day of month and day of week match either.
+        if self._any_day:
+            return in_weekdays
+        if self._any_weekday:
+            return in_days
+        return in_days or in_weekdays
+
+    def previous(self, moment: datetime, max_days: int) -> Optional[datetime]:
+        """The last time at or before `moment`, up to `max_days` back."""
+        for i in range(max_days + 1):
+            day = moment.date() - timedelta(days=i)
+            if not self.matches_day(day):
+                continue
+            for hour in reversed(self.hours):
+                if i == 0 and hour > moment.hour:
+                    continue
+                for minute in reversed(self.minutes):
+                    if i == 0 and hour == moment.hour and \
+                            minute > moment.minute:
+                        continue
+                    return datetime.combine(day, time(hour, minute))
+        return None
+
+    def next(self, moment: datetime, max_days: int) -> Optional[datetime]:
+        """The first time after `moment`, up to `max_days` ahead."""
+        for i in range(max_days + 1):
+            day = moment.date() + timedelta(days=i)
+            if not self.matches_day(day):
+                continue
+            for hour in self.hours:
+                if i == 0 and hour < moment.hour:
+                    continue
+                for minute in self.minutes:
+                    if i == 0 and hour == moment.hour and \
+                            minute <= moment.minute:
+                        continue
+                    return datetime.combine(day, time(hour, minute))
+        return None
+
+
+def parse_duration(value) -> timedelta:
+    """
+    Parse a duration like ``90m``, ``1h30m`` or ``2d``. Numbers are minutes.
+    """
+    if isinstance(value, (int, float)):
+        return timedelta(minutes=value)
+    parts = re.findall(r"(\d+(?:\.\d+)?)\s*([dhm])", str(value).lower())
+    if not parts or \
+            re.sub(r"[\d.\sdhm]", "", str(value).lower()):
+        raise ValueError("Invalid duration {!r}".format(value))
+    units = {"d": "days", "h": "hours", "m": "minutes"}
+    return sum((timedelta(**{units[unit]: float(amount)})
+                for amount, unit in parts), timedelta())
+
+
+def _limits(item: dict) -> Dict[str, int]:
+    return {k: int(item[k]) for k in ("min", "max") if item.get(k) is not None}
+
+
+class Schedule:
+    """
+    A recurring window with its own limits.
+
+    Parameters
+    ----------
+    item : dict
+        The schedule block from the cluster definition.
+
+    """
+
+    def __init__(self, item: dict) -> None:
+        self.name = str(item.get("name") or item.get("cron"))
+        try:
+            self.cron = Cron(item["cron"])
+            self.duration = parse_duration(item["duration"])
+            self.tz = tz.gettz(item.get("timezone") or "UTC")
+            if self.tz is None:
+                raise ValueError("Unknown time zone {!r}"
+                                 .format(item["timezone"]))
+            self.cluster = _limits(item)
+            self.services = {name: _limits(limits or {})
+                             for name, limits in
+                             (item.get("services") or {}).items()}
+        except (KeyError, TypeError, ValueError) as ex:
+            raise ScheduleError(self.name, repr(ex)) from ex
+        # A window opened at most this many days ago can still be open.
+        self._lookback = self.duration.days + 1
+
+    def _aware(self, local: datetime) -> datetime:
+        return local.replace(tzinfo=self.tz).astimezone(timezone.utc)
+
+    def window_at(self, now: datetime) -> Optional[Window]:
+        """The window that is open at `now`, if any."""
+        local = now.astimezone(self.tz).replace(tzinfo=None)
+        start = self.cron.previous(local, self._lookback)
+        if start is None:
+            return None
+        start_utc = self._aware(start)
+        end_utc = start_utc + self.duration
+        if start_utc <= now < end_utc:
+            return start_utc, end_utc
+        return None
+
+    def upcoming(self,
+                 now: datetime,
+                 horizon: timedelta = UPCOMING_HORIZON) -> List[Window]:
+        """The windows opening within `horizon` of `now`."""
+        out: List[Window] = []
+        local = now.astimezone(self.tz).replace(tzinfo=None)
+        max_days = horizon.days + 1
+        while len(out) < MAX_UPCOMING:
+            start = self.cron.next(local, max_days)
+            if start is None:
+                break
+            start_utc = self._aware(start)
+            if start_utc > now + horizon:
+                break
+            out.append((start_utc, start_utc + self.duration))
+            local = start
+        return out
+
+
+# Parsed schedules by the JSON of their definition.
+_parsed: Dict[str, List[Schedule]] = {}
+
+
+def get_schedules(cluster_name: str, cluster_def: dict) -> List[Schedule]:
+    """Parse the schedules of a cluster, skipping invalid ones."""
+    items = cluster_def.get("schedules") or []
+    if not items:
+        return []
+    key = json.dumps(items, sort_keys=True, default=str)
+    if key in _parsed:
+        return _parsed[key]
+    schedules = []
+    for item in items:
+        try:
+            schedule = Schedule(item)
+        except ScheduleError as ex:
+            logger.error("[Cluster: %s] Ignoring schedule:\n%s",
+                         cluster_name, ex)
+            continue
+        if schedule.cluster and (cluster_def.get("min") is None or
+                                 cluster_def.get("max") is None):
+            # The cluster limits could never be put back after the window.
+            logger.error(
+                "[Cluster: %s] Schedule %s sets min / max, which needs min "
+                "and max in the cluster definition as well, ignoring them",
+                cluster_name, schedule.name,
+            )
+            schedule.cluster = {}
+        schedules.append(schedule)
+    _parsed[key] = schedules
+    return schedules
+
+
+def _combine(base: dict, overrides: List[Dict[str, int]]) -> dict:
+    out = dict(base)
+    for key in ("min", "max"):
+        values = [x[key] for x in overrides if key in x]
+        if values:
+            out[key] = max(values)
+    if "min" in out and "max" in out and out["min"] is not None and \
+            out["max"] is not None and out["max"] < out["min"]:
+        out["max"] = out["min"]
+    return out
+
+
+def apply_schedules(cluster_name: str,
+                    cluster_def: dict,
+                    now: datetime = None) -> dict:
+    """
+    The cluster definition in effect at `now`: a copy with the limits of the
+    open windows, or `cluster_def` itself when no window is open.
+    """
+    schedules = get_schedules(cluster_name, cluster_def)
+    if not schedules:
+        return cluster_def
+    now = now or datetime.now(timezone.utc)
+    open_windows = [(x, window) for x in schedules
+                    for window in [x.window_at(now)] if window is not None]
+    if not open_windows:
+        return cluster_def
+
+    out = copy.copy(cluster_def)
+    out.update(_combine(cluster_def, [x.cluster for x, _ in open_windows]))
+    out["services"] = dict(cluster_def["services"])
+    for service_name, service_def in cluster_def["services"].items():
+        overrides = [x.services[service_name] for x, _ in open_windows
+                     if service_name in x.services]
+        if overrides:
+            out["services"][service_name] = _combine(service_def, overrides)
+    for schedule, (_, end) in open_windows:
+        logger.info(
+            "[Cluster: %s] Schedule %s is active until %s",
+            cluster_name, schedule.name, end.isoformat(),
+        )
+    return out
+
+
+def describe_schedules(cluster_name: str,
+                       cluster_def: dict,
+                       now: datetime = None,
+                       horizon: timedelta = UPCOMING_HORIZON) -> dict:
+    """The open and upcoming windows of a cluster, e.g. for dry runs."""
+    now = now or datetime.now(timezone.utc)
+    active = []
+    upcoming = []
+    for schedule in get_schedules(cluster_name, cluster_def):
+        window = schedule.window_at(now)
+        if window is not None:
+            active.append({"name": schedule.name,
+                           "start": window[0].isoformat(),
+                           "end": window[1].isoformat()})
+        for start, end in schedule.upcoming(now, horizon):
+            upcoming.append({"name": schedule.name,
+                             "start": start.isoformat(),
+                             "end": end.isoformat()})
+    upcoming.sort(key=lambda x: x["start"])
+    return {"active": active, "upcoming": upcoming}
+
+
+def log_schedules(cluster_name: str,
+                  cluster_def: dict,
+                  now: datetime = None) -> None:
+    """Log the open and upcoming windows of a cluster."""
+    windows = describe_schedules(cluster_name, cluster_def, now)
+    if not windows["active"] and not windows["upcoming"]:
+        return
+    lines = ["[Cluster: {:s}] Schedule:".format(cluster_name)]
+    for item in windows["active"]:
+        lines.append(" => {name:s}: active until {end:s}".format(**item))
+    for item in windows["upcoming"]:
+        lines.append(" => {name:s}: {start:s} to {end:s}".format(**item))
+    logger.info("\n".join(lines))
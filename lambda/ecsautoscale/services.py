@@ -2,17 +2,49 @@
 Handles scaling individual services within a cluster.
 """
 
+from concurrent.futures import ThreadPoolExecutor, wait
 import logging
-from typing import List
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
 
-import ecsautoscale.metric_sources.third_party
-import ecsautoscale.metric_sources.cloudwatch
 from . import ecs_client, LOG_LEVEL
+from .clients import bind_scope
+from .conditions import ServiceConditions
+from .deadline import Deadline, METRICS_FRACTION
+from .metric_cache import MetricCache
+from .metric_sources import get_source
+from .fingerprint import ClusterFingerprint
+from .placement import TaskRequirements
 
 
 logger = logging.getLogger()
 logger.setLevel(LOG_LEVEL)
 
+# Maximum time in seconds a single metric source may take, on top of the
+# share of the tick's deadline given to collecting metrics.
+METRIC_SOURCE_TIMEOUT = float(os.environ["METRIC_SOURCE_TIMEOUT"]) \
+    if os.environ.get("METRIC_SOURCE_TIMEOUT") else None
+# Task definition revisions are immutable, so they are cached by ARN for as
+# long as the container lives.
+_task_definitions: Dict[str, dict] = {}
+
+# Capacity providers that run tasks on Fargate.
+FARGATE_PROVIDERS = {"FARGATE", "FARGATE_SPOT"}
+
+
+def describe_task_definition(task_name: str) -> dict:
+    """Describe a task definition, cached when a specific revision is given."""
+    cached = _task_definitions.get(task_name)
+    if cached is not None:
+        return cached
+    task_definition = ecs_client.describe_task_definition(
+        taskDefinition=task_name)["taskDefinition"]
+    if re.search(r":\d+$", task_name):
+        _task_definitions[task_name] = task_definition
+    return task_definition
+
+
 class Service:
     """
     An object for scaling arbitrary services.
@@ -46,6 +78,34 @@ class Service:
     state : dict
         The current state of metrics.
 
+    placement_constraints : List[dict]
+        The placement constraints of the service on ECS.
+
+    placement_strategy : List[dict]
+        The placement strategy of the service on ECS.
+
+    max_staleness : float
+        How old, in seconds, the last known value of a metric may be to be
+        used when its source fails. `None` for the default.
+
+    desired_count : int
+        The desired count of the service on ECS, defaults to `task_count`.
+
+    pending_count : int
+        The number of tasks placed on an instance but not running yet.
+
+    launch_type : str
+        ``EC2`` or ``FARGATE``. When not known, tasks whose definition only
+        supports Fargate are taken to run on Fargate.
+
+    idle : dict
+        Idle mode of the service: ``metric``, a cheap "is there any work"
+        signal, an alias or an expression of aliases, ``wake``, the tasks
+        to start when it is above ``above`` (0 by default), and ``warm``,
+        whether to keep room for a task while idle. While the service runs
+        no tasks, only the signal is fetched and the task definition is
+        described once it wakes up.
+
     """
 
     def __init__(self, cluster_name: str,
@@ -56,151 +116,325 @@ class Service:
                  metric_sources: dict = None,
                  min_tasks: int = 0,
                  max_tasks: int = 5,
-                 state: dict = None) -> None:
+                 state: dict = None,
+                 placement_constraints: List[dict] = None,
+                 placement_strategy: List[dict] = None,
+                 max_staleness: float = None,
+                 desired_count: int = None,
+                 pending_count: int = 0,
+                 launch_type: str = None,
+                 idle: dict = None) -> None:
         self.cluster_name = cluster_name
         self.service_name = service_name
         self.task_count = task_count
+        self.desired_count = task_count if desired_count is None \
+            else desired_count
+        self.pending_count = pending_count
         self.task_name = task_name
         self.min_tasks = min_tasks
         self.max_tasks = max_tasks
         self.events = events or []
         self.metric_sources = metric_sources or {}
+        self.max_staleness = max_staleness
+
+        self.idle_def = idle or {}
+        self.idle = bool(self.idle_def) and not self.desired_count and \
+            not self.task_count and not self.pending_count
+        if self.idle:
+            self.metric_sources = signal_sources(self.metric_sources,
+                                                 self.idle_def["metric"])
+
+        # ARNs of the container instances running tasks of this service. Only
+        # needed for services with a `distinctInstance` placement constraint.
+        self.task_instance_arns: List[str] = []
+
+        self.launch_type = launch_type
+        self._placement = (placement_constraints, placement_strategy)
+        self.requirements = TaskRequirements(
+            constraints=placement_constraints,
+            strategy=placement_strategy,
+        )
+        self.task_definition_loaded = not task_name
+        if not self.idle:
+            self.load_task_definition()
 
-        if task_name:
-            task_definition_data = \
-                ecs_client.describe_task_definition(taskDefinition=task_name)
-            self.task_cpu = 0
-            self.task_mem = 0
-            containers = \
-                task_definition_data["taskDefinition"]["containerDefinitions"]
-            for container in containers:
-                self.task_cpu += container["cpu"]
-                self.task_mem += container["memory"]
-        else:
-            self.task_cpu = 0
-            self.task_mem = 0
-
-        # Get metric data.
+        # Metric data is filled in by `collect_metrics`.
         self.state = state or {}
-        for source_name in self.metric_sources:
-            source = getattr(ecsautoscale.metric_sources, source_name)
-            for item in self.metric_sources[source_name]:
-                res = source.get_data(**item)
-                if res:
-                    self.state.update(res)
+        self.metrics_error: Optional[Exception] = None
 
         self.desired_tasks = 0
         self.task_diff = 0
+        # New tasks held back until capacity registers (see
+        # `ecsautoscale.staging`).
+        self.staged_tasks = 0
+        # Why the service scales: "min", "max", "event:<index>" or "wake".
+        self.decision: Optional[str] = None
 
         if self.service_name is not None:
             logger.info(
                 "[Cluster: {:s}, Service: {:s}] Current state:\n"
                 " => Running count:    {:d}\n"
+                " => Pending count:    {:d}\n"
+                " => Desired count:    {:d}\n"
                 " => Minimum capacity: {:d}\n"
                 " => Maximum capacity: {:d}"
                 .format(
                     self.cluster_name,
                     self.service_name,
                     self.task_count,
+                    self.pending_count,
+                    self.desired_count,
                     self.min_tasks,
                     self.max_tasks,
                 )
             )
 
+    @property
+    def task_cpu(self) -> int:
+        return self.requirements.cpu
+
+    @task_cpu.setter
+    def task_cpu(self, value: int) -> None:
+        self.requirements.cpu = value
+
+    @property
+    def task_mem(self) -> int:
+        return self.requirements.mem
+
+    @task_mem.setter
+    def task_mem(self, value: int) -> None:
+        self.requirements.mem = value
+
     def _get_metric(self, metric_str: str) -> float:
         for metric_name in self.state:
             metric_str = metric_str.replace(metric_name,
                                             str(self.state[metric_name]))
         return eval(metric_str)
 
-    def pretend_scale(self) -> bool:
+    def get_metric(self, metric_str: str) -> float:
+        """
+        The value of a metric expression of the service's event conditions,
+        e.g. ``"queue_length / 10"``, with its current metric values.
+        """
+        return self._get_metric(metric_str)
+
+    def load_task_definition(self) -> None:
+        """Describe the task definition, for what its tasks need."""
+        if self.task_definition_loaded:
+            return
+        self.task_definition_loaded = True
+        constraints, strategy = self._placement
+        task_definition = describe_task_definition(self.task_name)
+        self.requirements = TaskRequirements.from_task_definition(
+            task_definition,
+            constraints=constraints,
+            strategy=strategy,
+        )
+        if self.launch_type is None and \
+                task_definition.get("requiresCompatibilities") == \
+                ["FARGATE"]:
+            self.launch_type = "FARGATE"
+
+    @property
+    def fargate(self) -> bool:
+        """Fargate provisions capacity for every task, not our instances."""
+        return self.launch_type == "FARGATE"
+
+    @property
+    def starting_count(self) -> int:
+        """Tasks the service asked for that are not running yet."""
+        return max(self.desired_count - self.task_count, 0)
+
+    @property
+    def unplaced_count(self) -> int:
+        """Tasks the service asked for that ECS could not place yet."""
+        return max(self.starting_count - self.pending_count, 0)
+
+    @property
+    def tasks_to_place(self) -> int:
+        """Tasks that still need room on an instance, including new ones."""
+        return max(self.task_diff, 0) + self.unplaced_count
+
+    def pretend_scale(self, save: bool = True) -> bool:
         """
         Check trigger events in order to determine what needs to scale.
+
+        Decisions are made relative to the desired count, so tasks that are
+        still starting are not asked for a second time: they are taken off
+        the tasks a scale-out event adds. With `save`, the samples and
+        streaks of windowed events are kept for the next ticks (see
+        `ecsautoscale.conditions`).
         """
-        if self.task_count < self.min_tasks:
-            self.task_diff = self.min_tasks - self.task_count
+        current = self.desired_count
+        if current < self.min_tasks:
+            self.task_diff = self.min_tasks - current
             self.desired_tasks = self.min_tasks
+            self.decision = "min"
             return True
 
-        if self.task_count > self.max_tasks:
-            self.task_diff = self.task_count - self.max_tasks
+        if current > self.max_tasks:
+            self.task_diff = self.max_tasks - current
             self.desired_tasks = self.max_tasks
+            self.decision = "max"
             return True
 
-        for event in self.events:
-            metric_name = event["metric"]
-            metric = self._get_metric(metric_name)
-            if metric is None:
-                return False
+        if self.idle:
+            return self._wake()
 
-            if event["max"] is not None and metric > event["max"]:
+        conditions = ServiceConditions(self.cluster_name, self.service_name,
+                                       self.events)
+        for event, fires in conditions.evaluate(self._get_metric, save=save):
+            if not fires:
                 continue
 
-            if event["min"] is not None and metric < event["min"]:
-                continue
+            action = event.action
+            if action > 0 and self.starting_count:
+                # Tasks that are still starting already answer part of
+                # the demand the metrics show.
+                action -= self.starting_count
+                if action <= 0:
+                    logger.info(
+                        "[Cluster: %s, Service: %s] Waiting for %d tasks to "
+                        "start before scaling out further",
+                        self.cluster_name,
+                        self.service_name,
+                        self.starting_count,
+                    )
+                    continue
 
-            desired_tasks = self.task_count + event["action"]
+            desired_tasks = current + action
             if desired_tasks < self.min_tasks:
-                if self.task_count == self.min_tasks:
+                if current == self.min_tasks:
                     continue
                 desired_tasks = self.min_tasks
 
             elif desired_tasks > self.max_tasks:
-                if self.task_count == self.max_tasks:
+                if current == self.max_tasks:
                     continue
                 desired_tasks = self.max_tasks
 
             self.desired_tasks = desired_tasks
-            self.task_diff = self.desired_tasks - self.task_count
+            self.task_diff = self.desired_tasks - current
+            self.decision = "event:{:d}".format(event.index)
+            # Set by `evaluate`.
+            assert conditions.history is not None
             logger.info(
                 "[Cluster: %s, Service: %s] Event satisfied:\n"
-                " => Metric name:   %s\n"
-                " => Current: %s\n"
-                " => Min:     %s\n"
-                " => Max:     %s\n"
+                "%s\n"
                 " => Action:  %s",
                 self.cluster_name,
                 self.service_name,
-                metric_name,
-                metric,
-                event["min"],
-                event["max"],
-                event["action"],
+                event.describe(conditions.history),
+                event.action,
             )
             return True
 
         return False
 
+    def _wake(self) -> bool:
+        """Scale an idle service straight to its wake-up count on work."""
+        # pylint: disable=broad-except
+        signal = self.idle_def["metric"]
+        try:
+            value = self._get_metric(signal)
+        except Exception as ex:
+            # A signal that cannot be evaluated shows no work.
+            logger.warning(
+                "[Cluster: %s, Service: %s] Could not evaluate %s: %s",
+                self.cluster_name, self.service_name, signal, ex,
+            )
+            value = None
+        if value is None or value <= self.idle_def.get("above", 0):
+            logger.info(
+                "[Cluster: %s, Service: %s] Idle, no work (%s: %s)",
+                self.cluster_name, self.service_name, signal, value,
+            )
+            return False
+
+        desired_tasks = min(max(int(self.idle_def.get("wake", 1)),
+                                self.min_tasks, 1), self.max_tasks)
+        if desired_tasks <= 0:
+            return False
+        self.desired_tasks = desired_tasks
+        self.task_diff = desired_tasks
+        self.decision = "wake"
+        logger.info(
+            "[Cluster: %s, Service: %s] Work arrived (%s: %s), waking up "
+            "with %d tasks",
+            self.cluster_name, self.service_name, signal, value,
+            desired_tasks,
+        )
+        return True
+
     def scale(self, is_test_run: bool = False) -> None:
         """
         Scale service.
         """
         if self.desired_tasks is not None and \
-                self.task_diff != 0 and \
+                self.task_diff != self.staged_tasks and \
                 self.service_name is not None:
+            desired_tasks = self.desired_tasks - self.staged_tasks
             logger.info(
                 "[Cluster: {:s}, Service: {:s}] Setting desired count to {:d}"
                 .format(
                     self.cluster_name,
                     self.service_name,
-                    self.desired_tasks,
+                    desired_tasks,
                 )
             )
             if not is_test_run:
                 ecs_client.update_service(
                     cluster=self.cluster_name,
                     service=self.service_name,
-                    desiredCount=self.desired_tasks,
+                    desiredCount=desired_tasks,
                 )
 
+def signal_sources(metric_sources: dict, signal: str) -> dict:
+    """
+    The items of `metric_sources` that fetch a metric used by `signal`, an
+    alias or an expression of aliases, or all of them if none do.
+    """
+    def used(item: dict) -> bool:
+        return any(
+            isinstance(x, dict) and x.get("alias") and
+            re.search(r"\b{:s}\b".format(re.escape(x["alias"])), signal)
+            for value in item.values() if isinstance(value, list)
+            for x in value
+        )
+
+    out = {}
+    for source_name, items in metric_sources.items():
+        matching = [item for item in items if used(item)]
+        if matching:
+            out[source_name] = matching
+    return out or metric_sources
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
-def get_services(cluster_name: str, cluster_def: dict) -> dict:
+def get_launch_type(service: dict) -> Optional[str]:
+    """The launch type of a described service, `None` if it isn't known."""
+    if service.get("launchType"):
+        return service["launchType"]
+    providers = [x["capacityProvider"]
+                 for x in service.get("capacityProviderStrategy", [])]
+    if providers and all(x in FARGATE_PROVIDERS for x in providers):
+        return "FARGATE"
+    return None
+
+
+def get_services(cluster_name: str,
+                 cluster_def: dict,
+                 service_names: Iterable[str] = None) -> dict:
     out: dict = {}
-    service_names = cluster_def["services"].keys()
+    if service_names is None:
+        service_names = cluster_def["services"].keys()
+    else:
+        service_names = [x for x in service_names
+                         if x in cluster_def["services"]]
     if not service_names:
         return out
     for service_names_chunk in chunks(list(service_names), 10):
@@ -212,18 +446,123 @@ def get_services(cluster_name: str, cluster_def: dict) -> dict:
             name = item["serviceName"]
             out[name] = {
                 "task_count": item["runningCount"],
+                "desired_count": item.get("desiredCount"),
+                "pending_count": item.get("pendingCount", 0),
                 "task_name": item["taskDefinition"],
+                "placement_constraints": item.get("placementConstraints", []),
+                "placement_strategy": item.get("placementStrategy", []),
+                "launch_type": get_launch_type(item),
             }
     return out
 
 
-def gather_services(cluster_name: str, cluster_def: dict) -> List[Service]:
+def get_task_instances(cluster_name: str, service_name: str) -> List[str]:
+    """Get the container instance ARNs the tasks of a service run on."""
+    task_arns: List[str] = []
+    kwargs = {"cluster": cluster_name, "serviceName": service_name}
+    while True:
+        res = ecs_client.list_tasks(**kwargs)
+        task_arns += res["taskArns"]
+        if not res.get("nextToken"):
+            break
+        kwargs["nextToken"] = res["nextToken"]
+    out = []
+    for task_arns_chunk in chunks(task_arns, 100):
+        res = ecs_client.describe_tasks(cluster=cluster_name,
+                                        tasks=task_arns_chunk)
+        for task in res["tasks"]:
+            if task.get("containerInstanceArn"):
+                out.append(task["containerInstanceArn"])
+    return out
+
+
+def _fetch(source_name: str, items: List[dict]) -> list:
+    # pylint: disable=broad-except
+    try:
+        return get_source(source_name).fetch_many(items)
+    except Exception as ex:
+        return [ex] * len(items)
+
+
+def collect_metrics(services: List[Service],
+                    deadline: Deadline = None,
+                    cache: MetricCache = None) -> None:
+    """
+    Fetch the metrics of all of the services. All items for the same source
+    are handed to the source in one `fetch_many` call, no matter which
+    service or cluster they belong to.
+
+    Sources run concurrently. When a `deadline` is given, sources get a slice
+    of the remaining time, and any item whose source fails or misses its
+    slice falls back to its last known good value, as long as that is no
+    older than the service's `max_staleness`.
+    """
+    cache = cache or MetricCache()
+    requests: Dict[str, List[Tuple[Service, dict]]] = {}
+    for service in services:
+        for source_name, items in service.metric_sources.items():
+            for item in items:
+                requests.setdefault(source_name, []).append((service, item))
+    if not requests:
+        return
+
+    timeout = None
+    if deadline is not None:
+        timeout = deadline.slice(METRICS_FRACTION, METRIC_SOURCE_TIMEOUT)
+
+    executor = ThreadPoolExecutor(max_workers=len(requests))
+    futures = {
+        source_name: executor.submit(
+            bind_scope(_fetch), source_name, [item for _, item in entries])
+        for source_name, entries in requests.items()
+    }
+    wait(futures.values(), timeout=timeout)
+    # Sources that missed the deadline are left to finish in the background.
+    executor.shutdown(wait=False)
+
+    for source_name, entries in requests.items():
+        future = futures[source_name]
+        if future.done():
+            results = future.result()
+        else:
+            logger.warning(
+                "Metric source %s did not finish within %.1fs",
+                source_name, timeout,
+            )
+            results = [TimeoutError(source_name)] * len(entries)
+
+        for (service, item), res in zip(entries, results):
+            if not isinstance(res, Exception):
+                if res:
+                    service.state.update(res)
+                    cache.put(source_name, item, res)
+                continue
+            stale = cache.get(source_name, item, service.max_staleness)
+            if stale is None:
+                service.metrics_error = res
+                continue
+            logger.warning(
+                "[Cluster: %s, Service: %s] Using last known values from %s:"
+                " %s (%s)",
+                service.cluster_name, service.service_name, source_name,
+                stale, res,
+            )
+            service.state.update(stale)
+
+
+def build_services(cluster_name: str,
+                   cluster_def: dict,
+                   service_names: Iterable[str] = None) -> List[Service]:
+    """
+    Create the enabled services of a cluster. If `service_names` is given, only
+    those services are considered. Metrics are not fetched yet.
+    """
     logger.info(
         "[Cluster: {:s}] Gathering services"
         .format(cluster_name)
     )
 
-    services_data = get_services(cluster_name, cluster_def)
+    services_data = get_services(cluster_name, cluster_def, service_names)
     services = []
     for service_name in services_data:
         logger.info(
@@ -244,10 +583,62 @@ def gather_services(cluster_name: str, cluster_def: dict) -> List[Service]:
             events=service["events"],
             metric_sources=service["metric_sources"],
             min_tasks=service["min"],
-            max_tasks=service["max"]
+            max_tasks=service["max"],
+            placement_constraints=\
+                services_data[service_name]["placement_constraints"],
+            placement_strategy=\
+                services_data[service_name]["placement_strategy"],
+            max_staleness=cluster_def.get("metric_max_staleness"),
+            desired_count=services_data[service_name]["desired_count"],
+            pending_count=services_data[service_name]["pending_count"],
+            launch_type=services_data[service_name]["launch_type"],
+            idle=service.get("idle"),
         )
-        should_scale = service.pretend_scale()
-        if should_scale:
-            services.append(service)
+        services.append(service)
 
     return services
+
+
+def select_services(services: List[Service],
+                    fingerprint: ClusterFingerprint = None,
+                    save: bool = True) -> List[Service]:
+    """
+    Decide which services need to scale, once their metrics are collected.
+    Every service is added to `fingerprint`, if given. With `save`, samples
+    of windowed events are kept for the next ticks.
+    """
+    out: List[Service] = []
+    for service in services:
+        if service.metrics_error is not None:
+            logger.error(
+                "[Cluster: %s, Service: %s] Could not collect metrics, "
+                "not scaling:\n%s",
+                service.cluster_name,
+                service.service_name,
+                service.metrics_error,
+            )
+            continue
+        should_scale = service.pretend_scale(save=save)
+        if fingerprint is not None:
+            fingerprint.add_service(service)
+        if service.unplaced_count and not service.fargate:
+            # Tasks ECS could not place still need capacity, even when the
+            # service itself does not scale.
+            logger.info(
+                "[Cluster: %s, Service: %s] %d tasks waiting for capacity",
+                service.cluster_name,
+                service.service_name,
+                service.unplaced_count,
+            )
+            should_scale = True
+        if should_scale:
+            # Idle services only need to know what their tasks need now.
+            service.load_task_definition()
+        if should_scale and service.requirements.distinct_instance and \
+                not service.fargate:
+            service.task_instance_arns = \
+                get_task_instances(service.cluster_name, service.service_name)
+        if should_scale:
+            out.append(service)
+
+    return out
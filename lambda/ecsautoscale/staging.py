@@ -0,0 +1,261 @@
+"""
+Coordinated scale-out: service updates that need capacity which is still on
+its way are staged until the new container instance registers.
+
+Without it, a tick that scales the cluster out also raises the desired count
+of every service at once, and the new tasks wait in PENDING for the instance
+to register, until the next tick has a look. With
+
+    stage_scale_out: true
+    stage_timeout: 600   # Optional, seconds before staged updates go ahead.
+
+in the cluster definition, the new tasks of a service that fit on the
+registered instances are started right away, and the rest are staged.
+Staged updates are released as soon as an instance that was not registered
+when they were staged shows up:
+
+- on every tick evaluating the cluster,
+- on "ECS Container Instance State Change" events (see `ecsautoscale.events`),
+- by polling every `STAGE_POLL` seconds for up to `STAGE_WAIT` seconds at the
+  end of the invocation that staged them.
+
+Staged updates go ahead anyway after `stage_timeout` seconds, and are dropped
+when a later tick decides differently for the service. With DynamoDB leases
+(see `ecsautoscale.leases`) they are kept in the lease table, so that any
+container can release them. Otherwise they are kept in the state store (see
+`ecsautoscale.state`) and only the container that staged them releases them
+early. Either way they are only read and written under the cluster's lease.
+"""
+
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+from . import ecs_client, leases, state
+from .deadline import Deadline, MIN_CLUSTER_SECONDS
+from .instances import build_simulator, count_launching_instances
+from .leases import cluster_lease_name
+from .services import Service
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+NAMESPACE = "staged"
+
+# Seconds before staged updates go ahead without new capacity.
+STAGE_TIMEOUT = 600.0
+
+# How long an invocation that staged updates polls for new instances, 0 to
+# leave them to events and later ticks.
+STAGE_WAIT = float(os.environ.get("STAGE_WAIT", "0"))
+
+# Seconds between polls.
+STAGE_POLL = float(os.environ.get("STAGE_POLL", "5"))
+
+
+def registered_instances(cluster_name: str) -> List[str]:
+    """The ARNs of the active container instances of a cluster."""
+    arns: List[str] = []
+    kwargs = {"cluster": cluster_name, "status": "ACTIVE"}
+    while True:
+        res = ecs_client.list_container_instances(**kwargs)
+        arns += res["containerInstanceArns"]
+        if not res.get("nextToken"):
+            return arns
+        kwargs["nextToken"] = res["nextToken"]
+
+
+class ScaleOutStage:
+    """
+    The staged service updates of a cluster.
+
+    Parameters
+    ----------
+    cluster_name : str
+        The name of the cluster.
+
+    cluster_def : dict
+        The definition of the cluster.
+
+    state_store : StateStore
+        Where staged updates are kept. By default the lease table with
+        DynamoDB leases, and the shared store otherwise.
+
+    clock : Callable
+        Returns the current Unix time.
+
+    """
+
+    def __init__(self,
+                 cluster_name: str,
+                 cluster_def: dict,
+                 state_store: state.StateStore = None,
+                 clock: Callable = time.time) -> None:
+        self.cluster_name = cluster_name
+        self.enabled = bool(cluster_def.get("stage_scale_out"))
+        self.timeout = float(cluster_def.get("stage_timeout", STAGE_TIMEOUT))
+        self._store = state_store
+        self.clock = clock
+
+    @property
+    def store(self) -> Union[state.StateStore, state.DynamoDBStateStore]:
+        if self._store is not None:
+            return self._store
+        backend = leases.manager.backend
+        if isinstance(backend, leases.DynamoDBLeaseBackend):
+            return state.DynamoDBStateStore(backend.table,
+                                            client=backend.client)
+        return state.store
+
+    def staged(self) -> Dict[str, dict]:
+        """The staged updates of the cluster, by service."""
+        return dict(self.store.get(NAMESPACE, self.cluster_name) or {})
+
+    def _save(self, staged: Dict[str, dict]) -> None:
+        if staged:
+            self.store.set(NAMESPACE, self.cluster_name, staged)
+        else:
+            self.store.delete(NAMESPACE, self.cluster_name)
+
+    def hold(self,
+             services: List[Service],
+             report: dict,
+             is_test_run: bool = False) -> None:
+        """
+        Hold back the new tasks of `services` that do not fit on the
+        registered instances while capacity is being added, by setting their
+        `staged_tasks`. `report` is the one filled in by
+        `scale_ec2_instances`. Staged updates of services that scale are
+        replaced by the new decision.
+        """
+        staged = self.staged()
+        before = dict(staged)
+        cluster_data = report["cluster_data"]
+        active = cluster_data["active_container_described"][
+            "containerInstances"]
+        waiting = self.enabled and (
+            report.get("action") == "scale_up" or
+            count_launching_instances(cluster_data,
+                                      report["asg_group_data"]) > 0)
+        simulator = build_simulator(active, services) if waiting else None
+
+        for service in services:
+            previous = staged.get(service.service_name)
+            if previous is not None and service.task_diff:
+                del staged[service.service_name]
+            if simulator is None or service.tasks_to_place <= 0:
+                continue
+            placed = simulator.place_many(service.requirements,
+                                          service.tasks_to_place,
+                                          service.service_name)
+            # Tasks ECS could not place yet go first.
+            fits = max(placed - service.unplaced_count, 0)
+            if fits >= service.task_diff:
+                continue
+
+            service.staged_tasks = service.task_diff - fits
+            logger.info(
+                "[Cluster: %s, Service: %s] Staging %d tasks until new "
+                "capacity registers",
+                self.cluster_name, service.service_name, service.staged_tasks,
+            )
+            staged[service.service_name] = {
+                "desired": service.desired_tasks,
+                "since": previous["since"] if previous else self.clock(),
+                "instances": [x["containerInstanceArn"] for x in active],
+            }
+        if staged != before and not is_test_run:
+            self._save(staged)
+
+    def release(self,
+                registered: Optional[Iterable[str]] = None,
+                services: List[Service] = None,
+                is_test_run: bool = False) -> List[str]:
+        """
+        Release the staged updates that new capacity has registered for, or
+        that waited for too long. `registered` are the ARNs of the active
+        container instances, which are listed when needed. Staged updates of
+        `services` that were evaluated and no longer need to scale out are
+        dropped. Returns the services whose updates were released.
+        """
+        staged = self.staged()
+        changed = False
+        for service in services or []:
+            if service.service_name not in staged or service.task_diff or \
+                    service.starting_count or service.metrics_error:
+                continue
+            logger.info(
+                "[Cluster: %s, Service: %s] Dropping staged update, no "
+                "longer needed",
+                self.cluster_name, service.service_name,
+            )
+            del staged[service.service_name]
+            changed = True
+        if not staged:
+            if changed and not is_test_run:
+                self._save(staged)
+            return []
+
+        registered = set(registered if registered is not None
+                         else registered_instances(self.cluster_name))
+        released = []
+        for service_name, update in sorted(staged.items()):
+            if registered - set(update["instances"]):
+                reason = "new capacity registered"
+            elif self.clock() - update["since"] >= self.timeout:
+                reason = "timed out waiting for capacity"
+            else:
+                continue
+            logger.info(
+                "[Cluster: %s, Service: %s] Releasing staged update, %s:\n"
+                " => Desired count: %d",
+                self.cluster_name, service_name, reason, update["desired"],
+            )
+            released.append(service_name)
+            if is_test_run:
+                continue
+            ecs_client.update_service(
+                cluster=self.cluster_name,
+                service=service_name,
+                desiredCount=update["desired"],
+            )
+            del staged[service_name]
+            changed = True
+        if changed and not is_test_run:
+            self._save(staged)
+        return released
+
+
+def wait_for_capacity(stages: List[ScaleOutStage],
+                      deadline: Deadline = None,
+                      wait: float = STAGE_WAIT,
+                      poll: float = STAGE_POLL,
+                      sleep: Callable = time.sleep) -> None:
+    """
+    Poll the clusters of `stages` for new instances for up to `wait` seconds,
+    releasing staged updates as soon as capacity registers.
+    """
+    # pylint: disable=broad-except
+    waited = 0.0
+    stages = [x for x in stages if x.staged()]
+    while stages and waited < wait:
+        if deadline is not None and \
+                deadline.remaining() < MIN_CLUSTER_SECONDS + poll:
+            return
+        sleep(poll)
+        waited += poll
+        for stage in list(stages):
+            lease_name = cluster_lease_name(stage.cluster_name)
+            if not leases.manager.acquire(lease_name, deadline=deadline):
+                continue
+            try:
+                stage.release()
+            except Exception as ex:
+                logger.exception(ex)
+            finally:
+                leases.manager.release(lease_name)
+            if not stage.staged():
+                stages.remove(stage)
@@ -0,0 +1,187 @@
+"""
+Small key-value store for state that is carried over between ticks.
+
+Values live in memory, which survives between invocations of a warm Lambda
+container, and are also written to a JSON file under `STATE_DIR` so that a
+local process or a container that was recycled can pick them back up.
+
+State that invocations in other containers need to see, like staged service
+updates, can be kept in DynamoDB instead with `DynamoDBStateStore`.
+"""
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+from . import clients
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+STATE_DIR = os.environ.get("STATE_DIR", "/tmp/ecsautoscale")
+
+
+class StateStore:
+    """
+    A namespaced key-value store backed by a JSON file.
+
+    Parameters
+    ----------
+    path : str
+        The file to persist the store to, or `None` to keep it in memory only.
+
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.path = path
+        self._data: Dict[str, Dict[str, Any]] = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as statefile:
+                self._data = json.load(statefile)
+        except (OSError, ValueError) as ex:
+            logger.warning("Could not load state from %s: %s", self.path, ex)
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        with self._lock:
+            self._load()
+            return self._data.get(namespace, {}).get(key, default)
+
+    def set(self, namespace: str, key: str, value: Any) -> None:
+        with self._lock:
+            self._load()
+            self._data.setdefault(namespace, {})[key] = value
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._load()
+            self._data.get(namespace, {}).pop(key, None)
+
+    def items(self, namespace: str) -> Dict[str, Any]:
+        with self._lock:
+            self._load()
+            return dict(self._data.get(namespace, {}))
+
+    def save(self) -> None:
+        """Write the store to disk."""
+        if not self.path:
+            return
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as statefile:
+                    json.dump(self._data, statefile, default=str)
+                os.replace(tmp_path, self.path)
+            except OSError as ex:
+                logger.warning("Could not save state to %s: %s", self.path, ex)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data = {}
+
+    def dump(self) -> Dict[str, Dict[str, Any]]:
+        """A copy of everything in the store."""
+        with self._lock:
+            self._load()
+            return json.loads(json.dumps(self._data, default=str))
+
+    def restore(self, data: Dict[str, Dict[str, Any]]) -> None:
+        """Replace everything in the store, e.g. with the output of `dump`."""
+        with self._lock:
+            self._loaded = True
+            self._data = json.loads(json.dumps(data))
+
+
+class DynamoDBStateStore:
+    """
+    A namespaced key-value store whose values are items of a DynamoDB table,
+    seen by every container. Only supports `get`, `set` and `delete`.
+
+    Parameters
+    ----------
+    table : str
+        The table, with the string partition key ``lease``. Values share
+        the lease table (see `ecsautoscale.leases`) under ``state/`` names.
+
+    client
+        A DynamoDB client, or anything answering `get_item`, `put_item` and
+        `delete_item` the same way. By default the client of the function's
+        own region and account.
+
+    ttl : float
+        Seconds before the table's TTL attribute ``expires`` lets an item
+        go, if it is not set again before.
+
+    clock : Callable
+        Returns the current Unix time.
+
+    """
+
+    def __init__(self,
+                 table: str,
+                 client=None,
+                 ttl: float = 86400,
+                 clock: Callable = time.time) -> None:
+        self.table = table
+        self._client = client
+        self.ttl = ttl
+        self.clock = clock
+
+    @property
+    def client(self):
+        if self._client is not None:
+            return self._client
+        return clients.pool.get("dynamodb")
+
+    @staticmethod
+    def _key(namespace: str, key: str) -> dict:
+        return {"lease": {"S": "state/{:s}/{:s}".format(namespace, key)}}
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        res = self.client.get_item(TableName=self.table,
+                                   Key=self._key(namespace, key),
+                                   ConsistentRead=True)
+        if "Item" not in res:
+            return default
+        return json.loads(res["Item"]["value"]["S"])
+
+    def set(self, namespace: str, key: str, value: Any) -> None:
+        self.client.put_item(TableName=self.table, Item=dict(
+            self._key(namespace, key),
+            value={"S": json.dumps(value, default=str)},
+            expires={"N": str(int(self.clock() + self.ttl))},
+        ))
+
+    def delete(self, namespace: str, key: str) -> None:
+        self.client.delete_item(TableName=self.table,
+                                Key=self._key(namespace, key))
+
+
+store = StateStore(os.path.join(STATE_DIR, "state.json"))
+
+
+@contextmanager
+def use_store(state_store: StateStore):
+    """Temporarily use another store, e.g. to keep dry runs off this one."""
+    global store  # pylint: disable=global-statement
+    previous = store
+    store = state_store
+    try:
+        yield state_store
+    finally:
+        store = previous
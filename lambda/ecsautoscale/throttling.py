@@ -0,0 +1,257 @@
+"""
+Throttling-aware wrapper around boto3 clients.
+
+Every API operation gets its own token bucket. When AWS throttles a call the
+bucket's rate is halved and the call is retried with exponential backoff and
+full jitter; each successful call nudges the rate back up. Read-only calls
+(`describe_*`, `list_*`, `get_*`) with identical arguments are memoized until
+the next tick or until a write goes through the same client.
+"""
+
+import copy
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Tuple
+
+from botocore.exceptions import ClientError
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+THROTTLE_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+}
+
+READ_PREFIXES = ("describe_", "list_", "get_")
+
+# Read-only calls whose responses hold a stream, which cannot be replayed, or
+# that are polled for changes within a tick.
+NOT_MEMOIZED = {"get_object", "list_container_instances"}
+
+# Attributes of a client that are not API calls.
+PASSTHROUGH = {"get_paginator", "get_waiter", "can_paginate", "exceptions",
+               "meta", "waiter_names"}
+
+# Default (requests per second, burst) per service.
+DEFAULT_RATES = {
+    "ecs": (20.0, 40),
+    "autoscaling": (10.0, 20),
+    "cloudwatch": (20.0, 40),
+}
+FALLBACK_RATE = (10.0, 20)
+
+
+def is_throttle(ex: Exception) -> bool:
+    return isinstance(ex, ClientError) and \
+        ex.response.get("Error", {}).get("Code") in THROTTLE_CODES
+
+
+class TokenBucket:
+    """
+    A token bucket whose rate adapts to throttling (additive increase,
+    multiplicative decrease).
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second.
+
+    burst : int
+        Maximum number of tokens.
+
+    clock : Callable
+        Returns the current time in seconds.
+
+    sleep : Callable
+        Sleeps for a number of seconds.
+
+    """
+
+    def __init__(self,
+                 rate: float,
+                 burst: int,
+                 clock: Callable = time.monotonic,
+                 sleep: Callable = time.sleep) -> None:
+        self.max_rate = rate
+        self.min_rate = rate / 16
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """Take a token, waiting if needed. Returns the time waited."""
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def throttled(self) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class ThrottledClient:
+    """
+    Wraps a boto3 client with rate limiting, retries and memoization.
+
+    Parameters
+    ----------
+    client : object
+        The boto3 client (or anything that looks like one).
+
+    service : str
+        The service name, used to pick default rates.
+
+    max_attempts : int
+        Total attempts for a throttled call.
+
+    base_delay : float
+        Base backoff delay in seconds.
+
+    max_delay : float
+        Maximum backoff delay in seconds.
+
+    sleep : Callable
+        Sleeps for a number of seconds.
+
+    clock : Callable
+        Returns the current time in seconds.
+
+    """
+
+    def __init__(self,
+                 client,
+                 service: str = None,
+                 max_attempts: int = 8,
+                 base_delay: float = 0.1,
+                 max_delay: float = 5.0,
+                 sleep: Callable = time.sleep,
+                 clock: Callable = time.monotonic) -> None:
+        self.client = client
+        self.service = service
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.clock = clock
+        self.stats: Dict[str, Counter] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._memo: Dict[Tuple[str, str], dict] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, operation: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(operation)
+            if bucket is None:
+                rate, burst = DEFAULT_RATES.get(self.service or "",
+                                                FALLBACK_RATE)
+                bucket = TokenBucket(rate, burst, clock=self.clock,
+                                     sleep=self.sleep)
+                self._buckets[operation] = bucket
+            return bucket
+
+    def _count(self, operation: str, counter: str) -> None:
+        with self._lock:
+            self.stats.setdefault(operation, Counter())[counter] += 1
+
+    def _call(self, operation: str, method: Callable, kwargs: dict):
+        bucket = self._bucket(operation)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            self._count(operation, "calls")
+            try:
+                res = method(**kwargs)
+            except ClientError as ex:
+                if not is_throttle(ex):
+                    raise
+                attempt += 1
+                self._count(operation, "throttles")
+                bucket.throttled()
+                if attempt >= self.max_attempts:
+                    raise
+                self._count(operation, "retries")
+                delay = random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logger.debug("Throttled on %s, retrying in %.2fs",
+                             operation, delay)
+                self.sleep(delay)
+                continue
+            bucket.succeeded()
+            return res
+
+    def _wrap(self, operation: str, method: Callable) -> Callable:
+        read_only = operation.startswith(READ_PREFIXES)
+
+        def wrapped(**kwargs):
+            if operation in NOT_MEMOIZED:
+                return self._call(operation, method, kwargs)
+            if not read_only:
+                # Anything we memoized may be stale now.
+                self.reset()
+                return self._call(operation, method, kwargs)
+
+            key = (operation, json.dumps(kwargs, sort_keys=True, default=str))
+            with self._lock:
+                cached = self._memo.get(key)
+            if cached is not None:
+                self._count(operation, "memo_hits")
+                return copy.deepcopy(cached)
+            res = self._call(operation, method, kwargs)
+            with self._lock:
+                self._memo[key] = res
+            return copy.deepcopy(res)
+
+        wrapped.__name__ = operation
+        return wrapped
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.client, name)
+        if name.startswith("_") or name in PASSTHROUGH or not callable(attr):
+            return attr
+        return self._wrap(name, attr)
+
+    def reset(self) -> None:
+        """Forget memoized responses, e.g. at the start of a tick."""
+        with self._lock:
+            self._memo.clear()
+
+
+def summarize(clients) -> Dict[str, Dict[str, int]]:
+    """Sum up the call counters of several wrapped clients by operation."""
+    out: Dict[str, Counter] = {}
+    for client in clients:
+        for operation, counter in client.stats.items():
+            key = "{}.{}".format(client.service, operation)
+            out.setdefault(key, Counter()).update(counter)
+    return {k: dict(v) for k, v in out.items()}
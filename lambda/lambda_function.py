@@ -1,50 +1,59 @@
 # pylint: disable=wrong-import-position
 """Lambda function for autoscaling ECS clusters and services."""
 
+from concurrent.futures import ThreadPoolExecutor
 import inspect
+import json
 import logging
 import os
-import re
 import sys
-from typing import List
+import time
+from typing import Dict, List, Optional, Tuple
 
 BASE_PATH = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
 sys.path.append(os.path.join(BASE_PATH, "./packages/"))
 
-import yaml
-
-from ecsautoscale import asg_client, ecs_client, LOG_LEVEL
+from ecsautoscale import (
+    asg_client, clients, ecs_client, events, leases, profiling, recording,
+    state, LOG_LEVEL,
+)
+from ecsautoscale.audit import audit_log
+from ecsautoscale.clients import scope
+from ecsautoscale.config import get_config_source
+from ecsautoscale.deadline import Deadline, MIN_CLUSTER_SECONDS
+from ecsautoscale.events import Target, is_profile_run, parse_event
+from ecsautoscale.fingerprint import ClusterFingerprint
+from ecsautoscale.headroom import Headroom
 from ecsautoscale.instances import scale_ec2_instances
-from ecsautoscale.services import gather_services, Service
+from ecsautoscale.leases import cluster_lease_name
+from ecsautoscale.metric_sources import register_plugins
+from ecsautoscale.profiling import phase
+from ecsautoscale.publisher import publisher, record_cluster
+from ecsautoscale.schedules import apply_schedules, log_schedules
+from ecsautoscale.services import (
+    build_services, collect_metrics, select_services, Service,
+)
+from ecsautoscale.staging import ScaleOutStage, wait_for_capacity
 
 
 logger = logging.getLogger()
 logger.setLevel(LOG_LEVEL)
 
+# Maximum number of regions / accounts swept at the same time.
+SWEEP_CONCURRENCY = int(os.environ.get("SWEEP_CONCURRENCY", "8"))
 
-def load_yaml(path: str) -> dict:
-    """Load a YAML file into a dict object."""
-    with open(path, "r") as yamlfile:
-        raw = yamlfile.read()
-        # Replace env variables in the yaml defs.
-        for match, env_var in re.findall(r"(%\(([A-Za-z_]+)\))", raw):
-            raw = raw.replace(match, os.environ[env_var])
-    data = yaml.load(raw)
-    return data
+# (region, role ARN)
+Scope = Tuple[Optional[str], Optional[str]]
 
 
 def load_cluster_defs() -> dict:
-    """Load YAML cluster definitions."""
-    cluster_defs = {}
-    clusters_defs_path = os.path.join(BASE_PATH, "clusters/")
-    for fname in os.listdir(clusters_defs_path):
-        if not fname.endswith(".yml"):
-            continue
-        path = os.path.join(clusters_defs_path, fname)
-        cluster_name = os.path.splitext(fname)[0]
-        data = load_yaml(path)
-        cluster_defs[cluster_name] = data
-    return cluster_defs
+    """
+    Load YAML cluster definitions from `CLUSTER_DEFS_SOURCE`, or the
+    `clusters/` directory packaged with the function.
+    """
+    source = get_config_source(os.environ.get("CLUSTER_DEFS_SOURCE"),
+                               os.path.join(BASE_PATH, "clusters/"))
+    return source.load()
 
 
 def clusters() -> List[str]:
@@ -56,24 +65,164 @@ def clusters() -> List[str]:
     return response["clusterArns"]
 
 
-def lambda_handler(event, context):
-    """
-    Pull metrics and check to see which clusters and services should scale.
+def group_cluster_defs(cluster_defs: dict) -> Dict[Scope, dict]:
+    """Group cluster definitions by the region and role to access them with."""
+    groups: Dict[Scope, dict] = {}
+    for cluster_name, cluster_def in cluster_defs.items():
+        key = (cluster_def.get("region"), cluster_def.get("role_arn"))
+        groups.setdefault(key, {})[cluster_name] = cluster_def
+    return groups
+
+
+def build_headroom(cluster_name: str,
+                   cluster_def: dict,
+                   services: List[Service]) -> Headroom:
+    """The headroom to keep on the instances of a cluster, if any."""
+    headroom = Headroom.from_cluster_def(cluster_def, services)
+    if not headroom.empty:
+        logger.info(
+            "[Cluster: %s] Headroom requested:\n%s",
+            cluster_name, headroom.describe(),
+        )
+    return headroom
+
 
-    This is the function called by AWS Lambda. The 'event' and 'context' are
-    given by AWS, but we currently don't do anything with them.
+def scale_cluster(cluster_name: str,
+                  cluster_def: dict,
+                  all_services: List[Service],
+                  asg_data: dict,
+                  cluster_list: List[str],
+                  is_test_run: bool = False,
+                  partial: bool = False,
+                  report: dict = None,
+                  dry_run: bool = False) -> ScaleOutStage:
     """
-    # pylint: disable=unused-argument,broad-except
-    logger.info(event)
+    Scale a cluster and its services, once the metrics of its services have
+    been collected. `partial` means only some of the services were evaluated.
+    `report` is filled in by `scale_ec2_instances`. A `dry_run` makes the
+    same calls as a tick, e.g. to fake clients, but records nothing of it:
+    no metrics are published, and no fingerprint or samples are kept.
 
-    is_test_run = event == "TEST_RUN"
-    if is_test_run:
+    Returns the staged service updates of the cluster (see
+    `ecsautoscale.staging`).
+    """
+    # Fargate runs every task on capacity of its own, so only EC2 services
+    # count towards the instances of the cluster. Clusters without an
+    # autoscaling group have none to plan.
+    ec2_services = [x for x in all_services if not x.fargate]
+    plan_instances = bool(cluster_def.get("autoscale_group")) and \
+        (bool(ec2_services) or not partial)
+    if ec2_services and not cluster_def.get("autoscale_group"):
         logger.warning(
-            "Going through test run, will not actually scale anything"
+            "[Cluster: %s] No autoscaling group for EC2 services: %s",
+            cluster_name, ", ".join(x.service_name for x in ec2_services),
+        )
+
+    # Targeted, test and dry runs always evaluate fully.
+    fingerprint = None
+    if not partial and not is_test_run and not dry_run and plan_instances:
+        fingerprint = ClusterFingerprint(cluster_name, cluster_def)
+    stage = ScaleOutStage(cluster_name, cluster_def)
+    with phase(profiling.SERVICES):
+        # Only full ticks count towards windowed events.
+        services = select_services(all_services, fingerprint=fingerprint,
+                                   save=not partial and not is_test_run and
+                                   not dry_run)
+    n_services = len(services)
+    logger.info(
+        "[Cluster: {:s}] Found {:d} services that need to scale"
+        .format(cluster_name, n_services)
+    )
+
+    if not plan_instances:
+        logger.info(
+            "[Cluster: %s] No EC2 capacity to plan, only scaling services",
+            cluster_name,
         )
+        if not is_test_run and not dry_run:
+            record_cluster(cluster_name, report or {}, all_services)
+        with phase(profiling.SCALE_SERVICES):
+            for service in sorted(services, key=lambda x: x.task_diff):
+                service.scale(is_test_run=is_test_run)
+            stage.release(services=all_services, is_test_run=is_test_run)
+        return stage
+    fargate_services = [x for x in services if x.fargate]
+    services = [x for x in services if not x.fargate]
+
+    # (2 / 4) Work out the headroom to keep: the CPU and memory buffer,
+    # warm spares of services, and a share of the cluster.
+    with phase(profiling.HEADROOM):
+        headroom = build_headroom(cluster_name, cluster_def, ec2_services)
+
+    # (3 / 4) Scale EC2 instances according to the tasks that need to
+    # be scaled. We first check if we can place all new needed tasks on
+    # the existing instances. If not, we scale out.
+    #
+    # If we do not need to scale out, we check if we can place all of
+    # tasks from the instance with the smallest amount of reserved
+    # memory or CPU onto another instance in the cluster. And then
+    # still have room for all services that need to scale out. That
+    # is only safe to decide when all services have been evaluated,
+    # so targeted evaluations never scale in.
+    report = report if report is not None else {}
+    with phase(profiling.INSTANCES):
+        res = scale_ec2_instances(
+            cluster_name, cluster_def, asg_data, cluster_list, services,
+            is_test_run=is_test_run,
+            allow_scale_down=not partial,
+            fingerprint=fingerprint,
+            report=report,
+            headroom=headroom,
+        )
+        if not is_test_run and not dry_run:
+            record_cluster(cluster_name, report, all_services)
+    if res == -1:
+        if n_services > 0:
+            logger.warning(
+                "[Cluster: {:s}] Cannot scale services since max"
+                "capacity is 0"
+                .format(cluster_name)
+            )
+        # No instances in the cluster or something else went wrong. Fargate
+        # services don't need any.
+        services = []
+
+    # (4 / 4) Scale services. First do all services that are scaling
+    # down, then the ones that are scaling up. New tasks that have to wait
+    # for capacity being added are staged until it registers.
+    with phase(profiling.SCALE_SERVICES):
+        if services:
+            stage.hold(services, report, is_test_run=is_test_run)
+        for service in sorted(services + fargate_services,
+                              key=lambda x: x.task_diff):
+            service.scale(is_test_run=is_test_run)
+        active = report.get("cluster_data", {}).get(
+            "active_container_described", {}).get("containerInstances")
+        stage.release(
+            [x["containerInstanceArn"] for x in active]
+            if active is not None else None,
+            services=all_services, is_test_run=is_test_run,
+        )
+    return stage
+
 
+def sweep(cluster_defs: dict,
+          is_test_run: bool = False,
+          targets: Dict[str, Target] = None,
+          deadline: Deadline = None) -> None:
+    """
+    Check and scale clusters that all live in the current region and account.
+
+    When `targets` is given only the targeted clusters and services are
+    evaluated. When a `deadline` is given, metric sources get a slice of the
+    remaining time and clusters are skipped once it runs out. Clusters whose
+    lease is held by another invocation are skipped (see
+    `ecsautoscale.leases`). Service updates staged until new capacity
+    registers are polled for at the end, if `STAGE_WAIT` allows (see
+    `ecsautoscale.staging`).
+    """
+    # pylint: disable=broad-except
     # Initialize data.
-    cluster_defs = load_cluster_defs()
     cluster_list = clusters()
     asg_data = asg_client.describe_auto_scaling_groups()
     if 'NextToken' in asg_data:
@@ -81,9 +230,18 @@ def lambda_handler(event, context):
             NextToken=asg_data['NextToken']
         )['AutoScalingGroups']
 
-    for cluster_name in cluster_defs:
+    # (1 / 4) Collect individual services in every cluster and fetch their
+    # metrics. Requests to the same metric source are batched across all
+    # services and clusters. Scheduled profiles decide the limits in effect.
+    cluster_services: Dict[str, List[Service]] = {}
+    effective_defs: Dict[str, dict] = {}
+    for cluster_name, cluster_def in cluster_defs.items():
         try:
-            cluster_def = cluster_defs[cluster_name]
+            service_names = None
+            if targets is not None:
+                if cluster_name not in targets:
+                    continue
+                service_names = targets[cluster_name].service_names
 
             # Skip cluster if not enabled.
             if not cluster_def["enabled"]:
@@ -93,61 +251,168 @@ def lambda_handler(event, context):
                 )
                 continue
 
-            # (1 / 4) Collect individual services in the cluster that will need
-            # to be scaled.
-            services = gather_services(cluster_name, cluster_def)
-            n_services = len(services)
-            logger.info(
-                "[Cluster: {:s}] Found {:d} services that need to scale"
-                .format(cluster_name, n_services)
-            )
-
-            # (2 / 4) Add a fake task to account for CPU buffer and mem buffer.
-            if cluster_def["cpu_buffer"] > 0 or cluster_def["mem_buffer"] > 0:
-                logger.info(
-                    "[Cluster: {:s}] Buffer size requested:\n"
-                    " => CPU buffer:    {:d}\n"
-                    " => Memory buffer: {:d} MB"
-                    .format(cluster_name, cluster_def["cpu_buffer"],
-                            cluster_def["mem_buffer"])
+            # Another invocation may be acting on the cluster.
+            if not is_test_run and not leases.manager.acquire(
+                    cluster_lease_name(cluster_name), deadline=deadline):
+                logger.warning(
+                    "[Cluster: %s] Another invocation holds the lease, "
+                    "skipping until next tick",
+                    cluster_name,
                 )
-                buffer_service = Service(cluster_name, None, None, 1,
-                                         min_tasks=1,
-                                         max_tasks=2)
-                buffer_service.task_cpu = cluster_def["cpu_buffer"]
-                buffer_service.task_mem = cluster_def["mem_buffer"]
-                buffer_service.task_diff = 1
-                services.append(buffer_service)
-
-            # (3 / 4) Scale EC2 instances according to the tasks that need to
-            # be scaled. We first check if we can place all new needed tasks on
-            # the existing instances. If not, we scale out.
-            #
-            # If we do not need to scale out, we check if we can place all of
-            # tasks from the instance with the smallest amount of reserved
-            # memory or CPU onto another instance in the cluster. And then
-            # still have room for all services that need to scale out.
-            res = scale_ec2_instances(
-                cluster_name, cluster_def, asg_data, cluster_list, services,
-                is_test_run=is_test_run,
-            )
-            if res == -1:
-                if n_services > 0:
-                    logger.warning(
-                        "[Cluster: {:s}] Cannot scale services since max"
-                        "capacity is 0"
-                        .format(cluster_name)
-                    )
-                # No instances in the cluster or something else went wrong.
                 continue
 
-            # (4 / 4) Scale services. First do all services that are scaling
-            # down, then the ones that are scaling up.
-            for service in sorted(services, key=lambda x: x.task_diff):
-                service.scale(is_test_run=is_test_run)
+            if is_test_run:
+                log_schedules(cluster_name, cluster_def)
+            cluster_def = apply_schedules(cluster_name, cluster_def)
+            effective_defs[cluster_name] = cluster_def
 
+            register_plugins(cluster_def.get("metric_source_plugins"))
+            with phase(profiling.SERVICES):
+                cluster_services[cluster_name] = build_services(
+                    cluster_name, cluster_def, service_names=service_names)
         except Exception as ex:
             logger.exception(ex)
+            leases.manager.release(cluster_lease_name(cluster_name))
+
+    started = time.perf_counter()
+    with phase(profiling.SERVICES):
+        collect_metrics([service for services in cluster_services.values()
+                         for service in services], deadline=deadline)
+    metrics_seconds = time.perf_counter() - started
+
+    stages: List[ScaleOutStage] = []
+    for cluster_name, services in cluster_services.items():
+        lease_name = cluster_lease_name(cluster_name)
+        if deadline is not None and \
+                deadline.remaining() < MIN_CLUSTER_SECONDS:
+            logger.warning(
+                "[Cluster: %s] Out of time, skipping until next tick",
+                cluster_name,
+            )
+            leases.manager.release(lease_name)
+            continue
+        try:
+            partial = targets is not None and \
+                targets[cluster_name].service_names is not None
+            report: dict = {}
+            started = time.perf_counter()
+            stages.append(scale_cluster(
+                cluster_name, effective_defs[cluster_name], services, asg_data,
+                cluster_list, is_test_run=is_test_run, partial=partial,
+                report=report,
+            ))
+            audit_log.record_cluster(
+                cluster_name, report, services,
+                seconds=time.perf_counter() - started,
+                metrics_seconds=metrics_seconds,
+            )
+        except Exception as ex:
+            logger.exception(ex)
+        finally:
+            leases.manager.release(lease_name)
+
+    # Release staged service updates as soon as new instances register.
+    if not is_test_run:
+        wait_for_capacity(stages, deadline=deadline)
+
+
+def _sweep_scope(region: Optional[str],
+                 role_arn: Optional[str],
+                 cluster_defs: dict,
+                 is_test_run: bool = False,
+                 targets: Dict[str, Target] = None,
+                 deadline: Deadline = None) -> None:
+    # pylint: disable=broad-except
+    try:
+        with scope(region, role_arn):
+            sweep(cluster_defs, is_test_run=is_test_run, targets=targets,
+                  deadline=deadline)
+    except Exception as ex:
+        logger.error(
+            "Sweep failed for region %s, role %s", region or "default",
+            role_arn or "default",
+        )
+        logger.exception(ex)
+
+
+def lambda_handler(event, context):
+    """
+    Pull metrics and check to see which clusters and services should scale.
+
+    This is the function called by AWS Lambda. Scheduled events sweep every
+    cluster, while alarm, task state change and explicit `{cluster, service}`
+    events only evaluate the affected clusters and services (see
+    `ecsautoscale.events`).
+
+    Clusters in different regions or accounts are swept in parallel, within
+    the time left in the invocation according to `context`. With
+    `RECORD_TICKS` set, the tick is recorded (see `ecsautoscale.recording`).
+    With `"profile": true` in the event or `PROFILE_TICKS` set, it is
+    profiled (see `ecsautoscale.profiling`).
+    """
+    with profiling.profiling(enabled=is_profile_run(event)):
+        if not recording.RECORD_TICKS or recording.active is not None:
+            _handle(event, context)
+            return
+        recorder = recording.Recorder(recording.RECORD_TICKS)
+        try:
+            with recording.recording(recorder, event):
+                _handle(event, context)
+        finally:
+            recorder.save()
+
+
+def _handle(event, context) -> None:
+    logger.info(event)
+    deadline = Deadline.from_context(context)
+
+    is_test_run = events.is_test_run(event)
+    if is_test_run:
+        logger.warning(
+            "Going through test run, will not actually scale anything"
+        )
+
+    clients.pool.new_tick()
+    leases.manager.new_tick(getattr(context, "aws_request_id", None))
+    with phase(profiling.LOAD):
+        cluster_defs = load_cluster_defs()
+    recording.record_cluster_defs(cluster_defs)
+
+    targets = None
+    parsed = parse_event(event, cluster_defs)
+    if parsed is not None:
+        targets = {x.cluster_name: x for x in parsed}
+        logger.info("Targeted evaluation of %s", list(targets.values()))
+        cluster_defs = {k: v for k, v in cluster_defs.items() if k in targets}
+    if not is_test_run:
+        audit_log.start_tick(targeted=targets is not None)
+
+    groups = group_cluster_defs(cluster_defs)
+    if len(groups) <= 1:
+        for (region, role_arn), group in groups.items():
+            _sweep_scope(region, role_arn, group, is_test_run=is_test_run,
+                         targets=targets, deadline=deadline)
+    else:
+        max_workers = min(len(groups), SWEEP_CONCURRENCY)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(_sweep_scope, region, role_arn, group,
+                                is_test_run=is_test_run, targets=targets,
+                                deadline=deadline)
+                for (region, role_arn), group in groups.items()
+            ]
+            for future in futures:
+                future.result()
+
+    # Persist state carried over to the next tick.
+    with phase(profiling.SAVE):
+        state.store.save()
+        publisher.flush()
+        audit_log.flush()
+
+    for api, counts in sorted(clients.pool.stats().items()):
+        if counts.get("throttles") or counts.get("memo_hits"):
+            logger.info("AWS calls to %s: %s", api, counts)
 
 
 def run_test():
@@ -155,7 +420,13 @@ def run_test():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--test", action="store_true")
+    parser.add_argument("--replay", default=None, metavar="RECORDING",
+                        help="Replay a recorded tick offline.")
     opts = parser.parse_args()
+    if opts.replay:
+        result = recording.replay(opts.replay, lambda_handler)
+        print(json.dumps(result, indent=2, default=str))
+        return
     if opts.test:
         test_event = "TEST_RUN"
     else:
@@ -0,0 +1,407 @@
+"""
+What-if planning: what would the autoscaler do for a cluster definition and a
+snapshot of the cluster, without touching AWS?
+
+A snapshot is a JSON or YAML document with the state of one cluster:
+
+    cluster_name: my_cluster
+    # Optional, clusters running only on Fargate have no autoscaling group.
+    autoscaling_group: {DesiredCapacity: 2, MinSize: 1, MaxSize: 4}
+    container_instances: []  # As returned by `describe_container_instances`.
+    draining_instances: []
+    services: []             # As returned by `describe_services`.
+    task_definitions: {}     # By ARN, as in `describe_task_definition`.
+    tasks: {}                # Optional, by service:
+                             # [{taskArn, containerInstanceArn}]
+    metrics: {}              # By service: {alias: value}
+
+AWS calls are answered from the snapshot, and every call that would change
+something is recorded instead of made. Those calls make up the plan.
+
+Usage:
+
+    python plan.py clusters/my_cluster.yml snapshot.json
+    python plan.py --snapshot clusters/my_cluster.yml > snapshot.json
+    python plan.py --serve 8080
+"""
+
+import argparse
+from contextlib import contextmanager
+import copy
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+import sys
+import threading
+from typing import Callable, Dict, List, Tuple, Union
+
+import lambda_function
+from ecsautoscale import asg_client, ecs_client
+from ecsautoscale.clients import ClientPool, use_pool
+from ecsautoscale.config import load_yaml
+from ecsautoscale.schedules import apply_schedules, describe_schedules
+from ecsautoscale.instances import (
+    get_asg_group_data, get_cluster_arn, retrieve_cluster_data,
+)
+from ecsautoscale.leases import LeaseManager, use_leases
+from ecsautoscale.services import (
+    _task_definitions, build_services, collect_metrics,
+    describe_task_definition, get_task_instances,
+)
+from ecsautoscale.state import StateStore, use_store
+from ecsautoscale.throttling import READ_PREFIXES
+
+
+logger = logging.getLogger()
+
+CLUSTER_ARN_PREFIX = "arn:aws:ecs:us-east-1:000000000000:cluster/"
+
+# Parsed files by path, along with the (mtime, size) they were parsed at.
+_files: Dict[str, Tuple[Tuple[int, int], dict]] = {}
+_files_lock = threading.Lock()
+
+# Planning swaps the global client pool and state store, one plan at a time.
+_plan_lock = threading.Lock()
+
+
+def load_file(path: str) -> dict:
+    """Load a JSON or YAML file, only parsing it again once it changes."""
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _files_lock:
+        cached = _files.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as infile:
+            data = json.load(infile)
+    else:
+        data = load_yaml(path)
+    with _files_lock:
+        _files[path] = (version, data)
+    return data
+
+
+class SnapshotClient:
+    """
+    A stand-in for a boto3 client that answers from a snapshot, and records
+    every call it receives.
+
+    Parameters
+    ----------
+    responses : Dict[str, Union[dict, Callable]]
+        Responses by operation name, e.g. ``describe_services``. Callables are
+        called with the parameters of the call, as a dict. Writes without a
+        response just succeed.
+
+    """
+
+    def __init__(self, responses: Dict[str, Union[dict, Callable]]) -> None:
+        self.responses = responses
+        self.calls: List[Tuple[str, dict]] = []
+
+    def _call(self, operation: str, kwargs: dict):
+        self.calls.append((operation, kwargs))
+        if operation not in self.responses:
+            if operation.startswith(READ_PREFIXES):
+                raise NotImplementedError(operation)
+            return {}
+        response = self.responses[operation]
+        if callable(response):
+            return response(kwargs)
+        return copy.deepcopy(response)
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def method(**kwargs):
+            return self._call(name, kwargs)
+        return method
+
+
+class _SnapshotSession:
+    """A stand-in for `boto3.session.Session` handing out snapshot clients."""
+
+    def __init__(self, clients: Dict[str, SnapshotClient]) -> None:
+        self.clients = clients
+
+    def client(self, service: str) -> SnapshotClient:
+        if service not in self.clients:
+            self.clients[service] = SnapshotClient({})
+        return self.clients[service]
+
+
+@contextmanager
+def snapshot_pool(clients: Dict[str, SnapshotClient]):
+    """Route `ecs_client`, `asg_client`, etc. to `clients`, by service."""
+    client_pool = ClientPool(
+        session_factory=lambda **kwargs: _SnapshotSession(clients),
+        throttle=False,
+    )
+    with use_pool(client_pool):
+        yield clients
+
+
+def snapshot_clients(snapshot: dict,
+                     cluster_def: dict) -> Dict[str, SnapshotClient]:
+    """ECS and autoscaling clients answering from a snapshot."""
+    cluster_name = snapshot["cluster_name"]
+    active = snapshot.get("container_instances", [])
+    draining = snapshot.get("draining_instances", [])
+    by_name = {x["serviceName"]: x for x in snapshot.get("services", [])}
+    service_tasks = snapshot.get("tasks", {})
+    # Clusters running only on Fargate have no autoscaling group.
+    groups = []
+    if snapshot.get("autoscaling_group"):
+        groups.append(dict(
+            snapshot["autoscaling_group"],
+            AutoScalingGroupName=cluster_def["autoscale_group"]))
+
+    def copied(func: Callable[[dict], dict]) -> Callable[[dict], dict]:
+        # Scaling updates what it is given, the snapshot has to stay intact.
+        return lambda params: copy.deepcopy(func(params))
+
+    def describe_services(params: dict) -> dict:
+        return {"services": [by_name[x] for x in params["services"]
+                             if x in by_name]}
+
+    def list_container_instances(params: dict) -> dict:
+        instances = draining if params.get("status") == "DRAINING" \
+            else active
+        return {"containerInstanceArns":
+                [x["containerInstanceArn"] for x in instances]}
+
+    def describe_container_instances(params: dict) -> dict:
+        arns = set(params["containerInstances"])
+        return {"containerInstances": [x for x in active + draining
+                                       if x["containerInstanceArn"] in arns]}
+
+    def describe_task_def(params: dict) -> dict:
+        return {"taskDefinition":
+                snapshot["task_definitions"][params["taskDefinition"]]}
+
+    def list_tasks(params: dict) -> dict:
+        return {"taskArns": [
+            x["taskArn"] for x in service_tasks.get(params["serviceName"], [])
+        ]}
+
+    def describe_tasks(params: dict) -> dict:
+        arns = set(params["tasks"])
+        return {"tasks": [x for items in service_tasks.values()
+                          for x in items if x["taskArn"] in arns]}
+
+    ecs = SnapshotClient({
+        "list_clusters": {"clusterArns": [CLUSTER_ARN_PREFIX + cluster_name]},
+        "describe_services": copied(describe_services),
+        "list_container_instances": list_container_instances,
+        "describe_container_instances": copied(describe_container_instances),
+        "describe_task_definition": copied(describe_task_def),
+        "list_tasks": list_tasks,
+        "describe_tasks": copied(describe_tasks),
+    })
+    autoscaling = SnapshotClient({
+        "describe_auto_scaling_groups":
+            copied(lambda params: {"AutoScalingGroups": groups}),
+    })
+    return {"ecs": ecs, "autoscaling": autoscaling}
+
+
+def plan(cluster_def: dict, snapshot: dict, now: datetime = None) -> dict:
+    """
+    Compute everything the autoscaler would do for a cluster snapshot, with
+    the scheduled profiles in effect at `now`.
+    """
+    cluster_name = snapshot["cluster_name"]
+    schedule = describe_schedules(cluster_name, cluster_def, now)
+    cluster_def = apply_schedules(cluster_name, cluster_def, now)
+    clients = snapshot_clients(snapshot, cluster_def)
+    metrics = snapshot.get("metrics", {})
+    report: dict = {}
+
+    # Staged updates are kept with leases, keep them off the real ones too.
+    with _plan_lock, snapshot_pool(clients), use_store(StateStore()), \
+            use_leases(LeaseManager(None)):
+        # Task definitions in a snapshot may be edited between plans.
+        _task_definitions.clear()
+        services = build_services(cluster_name, cluster_def)
+        for service in services:
+            if service.service_name in metrics:
+                service.state.update(metrics[service.service_name])
+            elif service.metric_sources:
+                service.metrics_error = \
+                    KeyError("No metric values in snapshot")
+        lambda_function.scale_cluster(
+            cluster_name, cluster_def, services,
+            asg_client.describe_auto_scaling_groups(),
+            ecs_client.list_clusters()["clusterArns"],
+            report=report,
+            dry_run=True,
+        )
+
+    return {
+        "cluster": cluster_name,
+        "cluster_action": report.get("action"),
+        "schedule": schedule,
+        "services": [
+            {
+                "service": x.service_name,
+                "running_count": x.task_count,
+                "pending_count": x.pending_count,
+                "desired_count": x.desired_count,
+                "desired_tasks": x.desired_tasks if x.task_diff else
+                                 x.desired_count,
+                "task_diff": x.task_diff,
+                "staged_tasks": x.staged_tasks,
+                "metrics": x.state,
+                "error": str(x.metrics_error) if x.metrics_error else None,
+            }
+            for x in services
+        ],
+        "actions": [
+            {"service": service, "operation": operation, "params": params}
+            for service, client in sorted(clients.items())
+            for operation, params in client.calls
+            if not operation.startswith(("describe_", "list_", "get_"))
+        ],
+    }
+
+
+def take_snapshot(cluster_name: str, cluster_def: dict) -> dict:
+    """Capture the current state of a live cluster, including its metrics."""
+    asg: dict = {}
+    if cluster_def.get("autoscale_group"):
+        asg = get_asg_group_data(cluster_def["autoscale_group"],
+                                 asg_client.describe_auto_scaling_groups())
+    cluster_arn = get_cluster_arn(cluster_name,
+                                  ecs_client.list_clusters()["clusterArns"])
+    cluster_data = retrieve_cluster_data(cluster_arn, cluster_name)
+
+    services = build_services(cluster_name, cluster_def)
+    collect_metrics(services)
+    described = ecs_client.describe_services(
+        cluster=cluster_name, services=[x.service_name for x in services],
+    )["services"] if services else []
+
+    return {
+        "cluster_name": cluster_name,
+        "autoscaling_group": {
+            k: asg[k] for k in ("DesiredCapacity", "MinSize", "MaxSize",
+                                "Instances") if k in asg
+        },
+        "container_instances":
+            cluster_data["active_container_described"]["containerInstances"],
+        "draining_instances":
+            cluster_data["draining_container_described"]["containerInstances"],
+        "services": described,
+        "task_definitions": {
+            x["taskDefinition"]: describe_task_definition(x["taskDefinition"])
+            for x in described
+        },
+        # Only where tasks run matters, for `distinctInstance` services.
+        "tasks": {
+            x.service_name: [
+                {"taskArn": "task/{:s}/{:d}".format(x.service_name, i),
+                 "containerInstanceArn": arn}
+                for i, arn in enumerate(get_task_instances(cluster_name,
+                                                           x.service_name))
+            ]
+            for x in services if x.requirements.distinct_instance
+        },
+        "metrics": {x.service_name: x.state for x in services},
+    }
+
+
+class PlanHandler(BaseHTTPRequestHandler):
+    """
+    `POST /plan` with a JSON body holding a `cluster_def` and a `snapshot`,
+    each either inline or as a path to a file, e.g.
+    ``{"cluster_def": "clusters/my_cluster.yml", "snapshot": {...}}``.
+    """
+
+    def _send(self, status: int, body: dict) -> None:
+        data = json.dumps(body, indent=2, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        if self.path.rstrip("/") != "/plan":
+            self._send(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            cluster_def = body["cluster_def"]
+            snapshot = body["snapshot"]
+            if isinstance(cluster_def, str):
+                cluster_def = load_file(cluster_def)
+            if isinstance(snapshot, str):
+                snapshot = load_file(snapshot)
+            if not isinstance(cluster_def, dict) or \
+                    not isinstance(snapshot, dict):
+                raise ValueError("cluster_def and snapshot must be objects "
+                                 "or paths to files")
+            result = plan(cluster_def, snapshot)
+        except KeyError as ex:
+            self._send(400, {"error": "Missing field: {}".format(ex)})
+            return
+        except (AttributeError, TypeError, ValueError, OSError) as ex:
+            # Malformed cluster definitions and snapshots end up here too.
+            self._send(400, {"error": "{:s}: {}".format(
+                type(ex).__name__, ex)})
+            return
+        self._send(200, result)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug(format, *args)
+
+
+def serve(port: int, host: str = "127.0.0.1") -> None:
+    server = HTTPServer((host, port), PlanHandler)
+    logger.warning("Serving plans on http://%s:%d/plan", host, port)
+    server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Show what the autoscaler would do for a cluster "
+                    "snapshot.")
+    parser.add_argument("cluster_def", nargs="?",
+                        help="Path to the cluster definition.")
+    parser.add_argument("snapshot_path", nargs="?",
+                        help="Path to the cluster snapshot.")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="Print a snapshot of the live cluster instead.")
+    parser.add_argument("--serve", type=int, default=None, metavar="PORT",
+                        help="Serve plans over HTTP on this port.")
+    parser.add_argument("--verbose", action="store_true")
+    opts = parser.parse_args()
+
+    if not opts.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    if opts.serve is not None:
+        serve(opts.serve)
+        return
+    if not opts.cluster_def:
+        parser.error("a cluster definition is required")
+
+    cluster_def = load_file(opts.cluster_def)
+    if opts.snapshot:
+        cluster_name = os.path.splitext(os.path.basename(opts.cluster_def))[0]
+        result = take_snapshot(cluster_name, cluster_def)
+    else:
+        if not opts.snapshot_path:
+            parser.error("a snapshot is required")
+        result = plan(cluster_def, load_file(opts.snapshot_path))
+    json.dump(result, sys.stdout, indent=2, default=str)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Measure the cold start of a deployment package.
+
+For a package built with `scripts/build.py`, reports:
+
+- the size of the zip file(s) and their unzipped size,
+- the time it takes to import `lambda_function`,
+- the latency of the first `lambda_handler` invocation,
+- how the function was loaded: from sources or precompiled files, and the
+  modules of the package that had to be compiled at import anyway.
+
+Every run happens in a fresh Python process with bytecode caching disabled,
+like on the read-only Lambda filesystem, and with the files dated as in the
+zip archive, like Lambda unzips them. AWS calls go to fake clients with
+canned responses for a small cluster, so the numbers only reflect the
+function itself and can be compared between builds.
+
+Usage:
+
+    python scripts/bench_cold_start.py deployment.zip [--layer layer.zip]
+"""
+
+import argparse
+import calendar
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import zipfile
+from typing import Dict, List
+
+
+CLUSTER_NAME = "bench"
+
+CLUSTER_DEF = """
+autoscale_group: bench-asg
+enabled: true
+cpu_buffer: 256
+mem_buffer: 512
+services:
+  web:
+    enabled: true
+    min: 3
+    max: 6
+    metric_sources: {}
+    events: []
+"""
+
+
+def _instance(instance_id: str) -> dict:
+    return {
+        "ec2InstanceId": instance_id,
+        "containerInstanceArn":
+            "arn:aws:ecs:us-east-1:123456789012:container-instance/" +
+            instance_id,
+        "registeredResources": [
+            {"name": "CPU", "type": "INTEGER", "integerValue": 2048},
+            {"name": "MEMORY", "type": "INTEGER", "integerValue": 3936},
+            {"name": "PORTS", "type": "STRINGSET",
+             "stringSetValue": ["22", "2375", "2376", "51678"]},
+        ],
+        "remainingResources": [
+            {"name": "CPU", "type": "INTEGER", "integerValue": 1024},
+            {"name": "MEMORY", "type": "INTEGER", "integerValue": 1888},
+            {"name": "PORTS", "type": "STRINGSET",
+             "stringSetValue": ["22", "2375", "2376", "51678"]},
+        ],
+        "attributes": [
+            {"name": "ecs.availability-zone", "value": "us-east-1a"},
+        ],
+        "runningTasksCount": 2,
+        "pendingTasksCount": 0,
+    }
+
+
+def responses() -> Dict[str, dict]:
+    """Canned AWS responses for one cluster with one service."""
+    instances = [_instance("i-0001"), _instance("i-0002")]
+    return {
+        "ecs": {
+            "list_clusters": {"clusterArns": [
+                "arn:aws:ecs:us-east-1:123456789012:cluster/" + CLUSTER_NAME,
+            ]},
+            "describe_services": {"services": [{
+                "serviceName": "web",
+                "taskDefinition": "web:1",
+                "runningCount": 2,
+                "desiredCount": 2,
+                "pendingCount": 0,
+            }]},
+            "describe_task_definition": {"taskDefinition": {
+                "containerDefinitions": [{"name": "web", "cpu": 512,
+                                          "memory": 1024}],
+            }},
+            # By status, see `CHILD`.
+            "list_container_instances": {
+                "ACTIVE": {"containerInstanceArns": [
+                    x["containerInstanceArn"] for x in instances
+                ]},
+                "DRAINING": {"containerInstanceArns": []},
+            },
+            "describe_container_instances": {"containerInstances": instances},
+        },
+        "autoscaling": {
+            "describe_auto_scaling_groups": {"AutoScalingGroups": [{
+                "AutoScalingGroupName": "bench-asg",
+                "DesiredCapacity": 2,
+                "MinSize": 1,
+                "MaxSize": 4,
+            }]},
+        },
+    }
+
+
+CHILD = """
+import importlib.machinery, json, os, sys, time
+compiled = []
+loader = importlib.machinery.SourceFileLoader
+source_to_code = loader.source_to_code
+def compile_source(self, data, path, **kwargs):
+    if not path.startswith(sys.prefix):
+        compiled.append(os.path.relpath(path))
+    return source_to_code(self, data, path, **kwargs)
+loader.source_to_code = compile_source
+start = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+loaded_by = type(lambda_function.__loader__).__name__
+from plan import SnapshotClient, snapshot_pool
+clients = {k: SnapshotClient(v) for k, v in json.loads(sys.argv[1]).items()}
+by_status = clients["ecs"].responses["list_container_instances"]
+clients["ecs"].responses["list_container_instances"] = \
+    lambda params: by_status[params["status"]]
+with snapshot_pool(clients):
+    invoked = time.perf_counter()
+    lambda_function.lambda_handler("TEST_RUN", None)
+    done = time.perf_counter()
+print(json.dumps({"import": imported - start, "invocation": done - invoked,
+                  "loader": loaded_by, "compiled": compiled}))
+"""
+
+
+def zip_sizes(path: str) -> Dict[str, int]:
+    with zipfile.ZipFile(path) as archive:
+        unzipped = sum(x.file_size for x in archive.infolist())
+    return {"zipped": os.path.getsize(path), "unzipped": unzipped}
+
+
+def extract(path: str, directory: str) -> None:
+    """Unzip `path` and date the files as in the archive, in UTC."""
+    with zipfile.ZipFile(path) as archive:
+        archive.extractall(directory)
+        for info in archive.infolist():
+            mtime = calendar.timegm(info.date_time)
+            os.utime(os.path.join(directory, info.filename), (mtime, mtime))
+
+
+def run_once(function_dir: str, work_dir: str, layer_dir: str = None) -> dict:
+    env = {
+        "PATH": os.environ.get("PATH", ""),
+        "PYTHONDONTWRITEBYTECODE": "1",
+        "PYTHONPATH": layer_dir or "",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "CLUSTER_DEFS_SOURCE": os.path.join(work_dir, "clusters"),
+        "STATE_DIR": os.path.join(work_dir, "state"),
+        "LOG_LEVEL": "warning",
+    }
+    res = subprocess.run(
+        [sys.executable, "-s", "-c", CHILD, json.dumps(responses())],
+        cwd=function_dir, env=env, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    return json.loads(res.stdout.decode("utf-8").strip().splitlines()[-1])
+
+
+def bench(package: str, layer: str = None, runs: int = 5) -> dict:
+    """Unzip the package and measure `runs` cold starts."""
+    out: Dict[str, object] = {"package": zip_sizes(package)}
+    if layer:
+        out["layer"] = zip_sizes(layer)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        function_dir = os.path.join(work_dir, "function")
+        extract(package, function_dir)
+        layer_dir = None
+        if layer:
+            extract(layer, os.path.join(work_dir, "opt"))
+            layer_dir = os.path.join(work_dir, "opt", "python")
+        os.makedirs(os.path.join(work_dir, "clusters"))
+        with open(os.path.join(work_dir, "clusters",
+                               CLUSTER_NAME + ".yml"), "w") as outfile:
+            outfile.write(CLUSTER_DEF)
+
+        results: List[dict] = [run_once(function_dir, work_dir, layer_dir)
+                               for _ in range(runs)]
+
+    out["loader"] = results[0]["loader"]
+    out["compiled"] = results[0]["compiled"]
+    for key in ("import", "invocation"):
+        values = [x[key] * 1000 for x in results]
+        out[key + "_ms"] = {
+            "median": statistics.median(values),
+            "min": min(values),
+            "max": max(values),
+        }
+    return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("package", help="The deployment package.")
+    parser.add_argument("--layer", default=None, help="The dependency layer.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true",
+                        help="Print the results as JSON.")
+    opts = parser.parse_args()
+
+    res = bench(opts.package, layer=opts.layer, runs=opts.runs)
+    if opts.json:
+        print(json.dumps(res, indent=2))
+        return
+    for name in ("package", "layer"):
+        if name in res:
+            print("{:s}: {:.1f} kB zipped, {:.1f} kB unzipped".format(
+                name, res[name]["zipped"] / 1024,
+                res[name]["unzipped"] / 1024))
+    print("loader: {:s}, {:d} module(s) compiled at import".format(
+        res["loader"], len(res["compiled"])))
+    for key in ("import_ms", "invocation_ms"):
+        print("{:s}: median {median:.1f}, min {min:.1f}, max {max:.1f}"
+              .format(key, **res[key]))
+
+
+if __name__ == "__main__":
+    main()
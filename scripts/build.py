@@ -0,0 +1,248 @@
+"""
+Build a slim deployment package for the Lambda function.
+
+Steps:
+
+1. Install the runtime requirements (`requirements-runtime.txt`) into a
+   staging directory. boto3 and botocore are left out, Lambda provides them.
+2. Drop installed packages that the function never imports, found by
+   following imports from `lambda_function.py`, along with tests, docs,
+   type stubs and packaging leftovers.
+3. Precompile everything, since the Lambda filesystem is read-only and
+   nothing gets cached at cold start. With the sources kept, the `.pyc`
+   files go to `__pycache__/` where the import system looks for them. With
+   `--strip-sources`, they replace the sources. Precompiled files only help
+   if they match the Python version of the Lambda runtime, so build with the
+   same version.
+4. Zip the function, or with `--layer`, zip the dependencies separately as a
+   Lambda layer (under `python/`) so that the function package stays tiny.
+
+Usage:
+
+    python scripts/build.py [--layer] [--strip-sources] [--no-deps]
+"""
+
+import argparse
+import calendar
+import compileall
+import fnmatch
+import modulefinder
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import zipfile
+from typing import Any, Dict, Iterable, List, Set
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT, "lambda")
+
+# Provided by the Lambda runtime.
+RUNTIME_PROVIDED = {"boto3", "botocore", "s3transfer", "jmespath", "pip",
+                    "setuptools", "wheel", "pkg_resources", "_distutils_hack"}
+
+# Always kept, even when not found by following imports.
+ALWAYS_KEEP = {"yaml", "_yaml"}
+
+PRUNE_DIRS = {"__pycache__", "tests", "test", "testing", "docs", "examples",
+              "benchmarks"}
+PRUNE_FILES = ["*.pyi", "*.pyx", "*.pxd", "*.c", "*.h", "*.md", "*.rst",
+               "RECORD", "INSTALLER", "REQUESTED", "direct_url.json"]
+
+# Parts of the function itself that are not needed at runtime.
+FUNCTION_EXCLUDE = {"packages", "__pycache__"}
+
+# Fixed timestamp for reproducible archives.
+ZIP_DATE = (2000, 1, 1, 0, 0, 0)
+
+# Bytecode cache tag of the Lambda runtime, see `bootstrap.sh`.
+RUNTIME_CACHE_TAG = "cpython-36"
+
+
+def install_requirements(requirements: str, target: str) -> None:
+    subprocess.check_call([
+        sys.executable, "-m", "pip", "install", "--quiet", "--no-compile",
+        "--disable-pip-version-check", "--target", target, "-r", requirements,
+    ])
+
+
+def imported_top_level(function_dir: str, path: List[str]) -> Set[str]:
+    """
+    Top-level modules reachable from any module of the function, including
+    lazy imports. Every module is a starting point, since metric sources are
+    imported by name.
+    """
+    finder = modulefinder.ModuleFinder(path=path + sys.path)
+    for dirpath, dirnames, filenames in os.walk(function_dir):
+        dirnames[:] = [x for x in dirnames if x not in FUNCTION_EXCLUDE]
+        for filename in sorted(filenames):
+            if not filename.endswith(".py"):
+                continue
+            module_path = os.path.relpath(os.path.join(dirpath, filename),
+                                          function_dir)
+            name = os.path.splitext(module_path)[0].replace(os.sep, ".")
+            if name.endswith(".__init__"):
+                name = name[:-len(".__init__")]
+            finder.import_hook(name)
+    names = set(finder.modules) | set(finder.badmodules)
+    return {name.split(".")[0] for name in names}
+
+
+def _top_level_names(packages_dir: str, entry: str) -> Set[str]:
+    """The importable names an entry in `packages_dir` provides."""
+    if entry.endswith((".dist-info", ".egg-info")):
+        top_level = os.path.join(packages_dir, entry, "top_level.txt")
+        if os.path.exists(top_level):
+            with open(top_level) as infile:
+                return {x.strip() for x in infile if x.strip()}
+        return {entry.split("-")[0]}
+    return {entry.split(".")[0]}
+
+
+def tree_shake(packages_dir: str, keep: Set[str]) -> List[str]:
+    """Remove installed packages that are not in `keep`."""
+    removed = []
+    for entry in sorted(os.listdir(packages_dir)):
+        names = _top_level_names(packages_dir, entry)
+        if names & RUNTIME_PROVIDED or not names & keep:
+            path = os.path.join(packages_dir, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            removed.append(entry)
+    return removed
+
+
+def prune(directory: str) -> None:
+    """Remove files and directories that are never needed at runtime."""
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for dirname in list(dirnames):
+            if dirname in PRUNE_DIRS:
+                shutil.rmtree(os.path.join(dirpath, dirname))
+                dirnames.remove(dirname)
+        for filename in filenames:
+            if any(fnmatch.fnmatch(filename, x) for x in PRUNE_FILES):
+                os.remove(os.path.join(dirpath, filename))
+
+
+def precompile(directory: str, strip_sources: bool = False) -> None:
+    """
+    Compile all modules to `.pyc` files in `__pycache__/`, or with
+    `strip_sources`, to `.pyc` files that replace their sources. Python
+    ignores a `.pyc` next to its source, so both are never shipped.
+
+    Unchecked hash based files are never validated against their sources,
+    saving a `stat` per import. Older versions check the modification time
+    of the source instead, so it is set to the one the zip archive restores.
+    """
+    mtime = calendar.timegm(ZIP_DATE)
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(".py"):
+                os.utime(os.path.join(dirpath, filename), (mtime, mtime))
+    kwargs: Dict[str, Any] = {}
+    if hasattr(py_compile, "PycInvalidationMode"):
+        kwargs["invalidation_mode"] = \
+            py_compile.PycInvalidationMode.UNCHECKED_HASH
+    compileall.compile_dir(directory, quiet=1, legacy=strip_sources,
+                           **kwargs)
+    if not strip_sources:
+        return
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(".py") and \
+                    os.path.exists(os.path.join(dirpath, filename + "c")):
+                os.remove(os.path.join(dirpath, filename))
+
+
+def write_zip(path: str, directory: str, prefix: str = "") -> None:
+    """Write a reproducible zip archive of `directory`."""
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                full_path = os.path.join(dirpath, filename)
+                name = os.path.join(prefix,
+                                    os.path.relpath(full_path, directory))
+                info = zipfile.ZipInfo(name, date_time=ZIP_DATE)
+                info.external_attr = 0o644 << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(full_path, "rb") as infile:
+                    archive.writestr(info, infile.read())
+
+
+def copy_function(staging: str) -> None:
+    def ignore(_, names: Iterable[str]) -> List[str]:
+        return [x for x in names
+                if x in FUNCTION_EXCLUDE or x.endswith((".pyc", ".pyo"))]
+    shutil.copytree(LAMBDA_DIR, staging, ignore=ignore)
+
+
+def build(output_dir: str,
+          layer: bool = False,
+          strip_sources: bool = False,
+          install_deps: bool = True,
+          requirements: str = None) -> List[str]:
+    """Build the package(s) into `output_dir` and return their paths."""
+    requirements = requirements or \
+        os.path.join(ROOT, "requirements-runtime.txt")
+    staging = os.path.join(output_dir, "staging")
+    shutil.rmtree(staging, ignore_errors=True)
+    function_dir = os.path.join(staging, "function")
+    packages_dir = os.path.join(function_dir, "packages")
+
+    copy_function(function_dir)
+    os.makedirs(packages_dir)
+    if install_deps:
+        install_requirements(requirements, packages_dir)
+        keep = imported_top_level(function_dir,
+                                  [function_dir, packages_dir]) | ALWAYS_KEEP
+        for entry in tree_shake(packages_dir, keep):
+            print("Dropped unused package {:s}".format(entry))
+    prune(staging)
+    if sys.implementation.cache_tag != RUNTIME_CACHE_TAG:
+        print("Warning: building with {:s} but the runtime is {:s}, the "
+              "precompiled files won't be used".format(
+                  sys.implementation.cache_tag, RUNTIME_CACHE_TAG))
+    precompile(staging, strip_sources=strip_sources)
+
+    outputs = []
+    if layer:
+        layer_path = os.path.join(output_dir, "layer.zip")
+        write_zip(layer_path, packages_dir, prefix="python")
+        outputs.append(layer_path)
+        shutil.rmtree(packages_dir)
+
+    package_path = os.path.join(output_dir, "deployment.zip")
+    write_zip(package_path, function_dir)
+    outputs.insert(0, package_path)
+    shutil.rmtree(staging)
+    return outputs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default=ROOT,
+                        help="Directory to write the packages to.")
+    parser.add_argument("--layer", action="store_true",
+                        help="Package dependencies as a separate layer.")
+    parser.add_argument("--strip-sources", action="store_true",
+                        help="Only ship the compiled .pyc files.")
+    parser.add_argument("--no-deps", action="store_true",
+                        help="Don't install the runtime requirements.")
+    parser.add_argument("--requirements", default=None,
+                        help="Requirements file to install.")
+    opts = parser.parse_args()
+
+    for path in build(opts.output, layer=opts.layer,
+                      strip_sources=opts.strip_sources,
+                      install_deps=not opts.no_deps,
+                      requirements=opts.requirements):
+        print("{:s}: {:.1f} kB".format(path, os.path.getsize(path) / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+Test doubles and fixture data shared by the tests.
+
+`FakeClient` answers API calls from canned responses (or callables) and
+records every call it receives. It can also inject throttling errors to
+exercise `ecsautoscale.throttling`. `fake_clients` routes the package's
+client proxies to fake clients. `FakeLeaseTable` stands in for the DynamoDB
+table of `ecsautoscale.leases`, and `FakeTransport` for the HTTP endpoints of
+third-party metric sources.
+
+`make_instance`, `make_snapshot`, `CLUSTER_DEF` and `HTTP_CLUSTER_DEF` build a
+small cluster of two instances and a `worker` service scaling on its queue.
+"""
+
+from contextlib import contextmanager
+import copy
+import json
+import threading
+from typing import Callable, Dict, List, Tuple, Union
+
+from botocore.exceptions import ClientError
+import requests
+from requests.adapters import BaseAdapter
+
+from ecsautoscale.clients import ClientPool, use_pool
+
+
+def throttling_error(operation: str,
+                     code: str = "ThrottlingException") -> ClientError:
+    return ClientError(
+        {"Error": {"Code": code, "Message": "Rate exceeded"}},
+        operation,
+    )
+
+
+def conditional_check_failed(operation: str) -> ClientError:
+    return ClientError(
+        {"Error": {"Code": "ConditionalCheckFailedException",
+                   "Message": "The conditional request failed"}},
+        operation,
+    )
+
+
+class FakeClient:
+    """
+    A fake boto3 client.
+
+    Parameters
+    ----------
+    responses : Dict[str, Union[dict, Callable]]
+        Responses by operation name, e.g. ``describe_services``. Callables are
+        called with the keyword arguments of the call.
+
+    throttle : Dict[str, int]
+        Number of times to throttle each operation before it succeeds.
+
+    throttle_every : int
+        Throttle every n-th call to any operation, after `throttle` is used
+        up. `None` to disable.
+
+    """
+
+    def __init__(self,
+                 responses: Dict[str, Union[dict, Callable]] = None,
+                 throttle: Dict[str, int] = None,
+                 throttle_every: int = None) -> None:
+        self.responses = responses or {}
+        self.throttle = dict(throttle or {})
+        self.throttle_every = throttle_every
+        self.calls: List[Tuple[str, dict]] = []
+        self.throttled = 0
+
+    def _call(self, operation: str, kwargs: dict):
+        self.calls.append((operation, kwargs))
+        if self.throttle.get(operation, 0) > 0:
+            self.throttle[operation] -= 1
+            self.throttled += 1
+            raise throttling_error(operation)
+        if self.throttle_every and len(self.calls) % self.throttle_every == 0:
+            self.throttled += 1
+            raise throttling_error(operation)
+        if operation not in self.responses:
+            # Writes without a canned response just succeed.
+            if operation.startswith(("describe_", "list_", "get_")):
+                raise NotImplementedError(operation)
+            return {}
+        response = self.responses[operation]
+        if callable(response):
+            return response(**kwargs)
+        return copy.deepcopy(response)
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def method(**kwargs):
+            return self._call(name, kwargs)
+        return method
+
+    def calls_to(self, operation: str) -> List[dict]:
+        return [kwargs for name, kwargs in self.calls if name == operation]
+
+
+class FakeLeaseTable(FakeClient):
+    """
+    A local stand-in for the DynamoDB table of
+    `leases.DynamoDBLeaseBackend`, with the same conditional writes, also
+    holding the items of `state.DynamoDBStateStore`.
+    """
+
+    def __init__(self) -> None:
+        super().__init__({"get_item": self._get_item,
+                          "put_item": self._put_item,
+                          "delete_item": self._delete_item})
+        self.items: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def _get_item(self, Key: dict, **kwargs) -> dict:
+        with self._lock:
+            item = self.items.get(Key["lease"]["S"])
+        return {"Item": item} if item is not None else {}
+
+    def _put_item(self, Item: dict, ExpressionAttributeValues: dict = None,
+                  **kwargs) -> dict:
+        name = Item["lease"]["S"]
+        with self._lock:
+            current = self.items.get(name)
+            if ExpressionAttributeValues is not None and \
+                    current is not None and \
+                    current["owner"]["S"] != \
+                    ExpressionAttributeValues[":owner"]["S"] and \
+                    float(current["expires"]["N"]) >= \
+                    float(ExpressionAttributeValues[":now"]["N"]):
+                raise conditional_check_failed("PutItem")
+            self.items[name] = Item
+        return {}
+
+    def _delete_item(self, Key: dict, ExpressionAttributeValues: dict = None,
+                     **kwargs) -> dict:
+        name = Key["lease"]["S"]
+        with self._lock:
+            current = self.items.get(name)
+            if ExpressionAttributeValues is not None and (
+                    current is None or current["owner"]["S"] !=
+                    ExpressionAttributeValues[":owner"]["S"]):
+                raise conditional_check_failed("DeleteItem")
+            self.items.pop(name, None)
+        return {}
+
+
+class FakeSession:
+    """A stand-in for `boto3.session.Session` handing out fake clients."""
+
+    def __init__(self, clients: Dict[str, FakeClient], **kwargs) -> None:
+        self.clients = clients
+        self.kwargs = kwargs
+
+    def client(self, service: str, **kwargs):
+        if service not in self.clients:
+            self.clients[service] = FakeClient()
+        return self.clients[service]
+
+
+@contextmanager
+def fake_clients(throttle: bool = False, **clients: FakeClient):
+    """
+    Route `ecs_client`, `asg_client`, `cdw_client`, etc. to the given fake
+    clients, by service name, e.g. ``fake_clients(ecs=FakeClient(...))``.
+    """
+    client_pool = ClientPool(
+        session_factory=lambda **kwargs: FakeSession(clients, **kwargs),
+        throttle=throttle,
+    )
+    with use_pool(client_pool):
+        yield clients
+
+
+class FakeTransport(BaseAdapter):
+    """Answers every request with the same JSON document."""
+
+    def __init__(self, body: dict) -> None:
+        super().__init__()
+        self.body = body
+        self.sent = 0
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        self.sent += 1
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.headers["Content-Type"] = "application/json"
+        resp._content = json.dumps(self.body).encode("utf-8")
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+# Resources of a task of the `worker` service.
+TASK_CPU = 1024
+TASK_MEM = 2048
+
+
+def make_instance(instance_id: str, tasks: int) -> dict:
+    """A container instance with room for two tasks, running `tasks`."""
+    return {
+        "ec2InstanceId": instance_id,
+        "containerInstanceArn":
+            "arn:aws:ecs:::container-instance/" + instance_id,
+        "registeredResources": [
+            {"name": "CPU", "type": "INTEGER", "integerValue": 2048},
+            {"name": "MEMORY", "type": "INTEGER", "integerValue": 4096},
+        ],
+        "remainingResources": [
+            {"name": "CPU", "type": "INTEGER",
+             "integerValue": 2048 - tasks * TASK_CPU},
+            {"name": "MEMORY", "type": "INTEGER",
+             "integerValue": 4096 - tasks * TASK_MEM},
+        ],
+        "runningTasksCount": tasks,
+        "pendingTasksCount": 0,
+    }
+
+
+# A `worker` service scaling out on the length of an SQS queue.
+CLUSTER_DEF = {
+    "autoscale_group": "my-asg",
+    "enabled": True,
+    "cpu_buffer": 0,
+    "mem_buffer": 0,
+    "services": {
+        "worker": {
+            "enabled": True,
+            "min": 1,
+            "max": 6,
+            "metric_sources": {"sqs": [{"queue": "jobs", "statistics": [
+                {"alias": "queue_length"}]}]},
+            "events": [
+                {"metric": "queue_length", "action": 2, "min": 100,
+                 "max": None},
+                {"metric": "queue_length", "action": -1, "min": None,
+                 "max": 10},
+            ],
+        },
+    },
+}
+
+# The same service, with the queue length of a third-party HTTP source.
+HTTP_CLUSTER_DEF = {
+    "autoscale_group": "my-asg",
+    "enabled": True,
+    "cpu_buffer": 0,
+    "mem_buffer": 0,
+    "services": {
+        "worker": {
+            "enabled": True,
+            "min": 1,
+            "max": 6,
+            "metric_sources": {"third_party": [{
+                "url": "http://metrics.local/worker",
+                "statistics": [{"alias": "queue_length",
+                                "name": "queue.length"}],
+            }]},
+            "events": [
+                {"metric": "queue_length", "action": 2, "min": 100,
+                 "max": None},
+            ],
+        },
+    },
+}
+
+
+def make_snapshot(queue_length: int) -> dict:
+    """
+    A snapshot (see `plan`) of `my_cluster`, running three `worker` tasks on
+    two instances, with room for one more.
+    """
+    return {
+        "cluster_name": "my_cluster",
+        "autoscaling_group": {"DesiredCapacity": 2, "MinSize": 1,
+                              "MaxSize": 4},
+        "container_instances": [make_instance("i-0", 2),
+                                make_instance("i-1", 1)],
+        "services": [{
+            "serviceName": "worker",
+            "taskDefinition": "worker:3",
+            "runningCount": 3,
+            "desiredCount": 3,
+            "pendingCount": 0,
+        }],
+        "task_definitions": {"worker:3": {"containerDefinitions": [
+            {"name": "worker", "cpu": 1024, "memory": 2048},
+        ]}},
+        "metrics": {"worker": {"queue_length": queue_length}},
+    }
@@ -0,0 +1,141 @@
+"""Test the audit log of scaling decisions."""
+
+from datetime import datetime, timezone
+import io
+import math
+
+import yaml
+
+import lambda_function
+import plan
+from ecsautoscale import audit
+from ecsautoscale.audit import AuditLog, decode_segment, encode_segment, load
+from ecsautoscale.http import use_adapter
+
+from helpers import (
+    FakeClient, FakeTransport, HTTP_CLUSTER_DEF, fake_clients, make_snapshot,
+)
+
+
+DAY_1 = datetime(2024, 1, 1, 12, tzinfo=timezone.utc).timestamp()
+DAY_2 = datetime(2024, 1, 2, 12, tzinfo=timezone.utc).timestamp()
+
+
+class Clock:
+    def __init__(self, now: float) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_segment_round_trip():
+    data = encode_segment(DAY_1, {
+        "clusters": [
+            (DAY_1, "a", "scale_up", 2, 2, 0, 1, 1024, 0, 2048, 0, 1,
+             0.25, 0.5),
+            (DAY_1, "b", None, None, None, None, None, None, None, None,
+             None, 0, None, 0.1),
+        ],
+    })
+    header, tables = decode_segment(data[4:])
+    assert header["time"] == DAY_1
+    clusters = tables["clusters"]
+    assert [header["strings"][i] for i in clusters["cluster"]] == ["a", "b"]
+    assert [header["strings"][i] for i in clusters["action"]] == \
+        ["scale_up", ""]
+    assert list(clusters["desired_capacity"]) == [2, audit.MISSING]
+    assert clusters["metrics_seconds"][0] == 0.25
+    assert math.isnan(clusters["metrics_seconds"][1])
+    assert len(tables["services"]["service"]) == 0
+
+
+def test_handler_appends_to_log(tmp_path, monkeypatch):
+    defs_dir = tmp_path / "clusters"
+    defs_dir.mkdir()
+    (defs_dir / "my_cluster.yml").write_text(yaml.safe_dump(HTTP_CLUSTER_DEF))
+    monkeypatch.setenv("CLUSTER_DEFS_SOURCE", str(defs_dir))
+    log = AuditLog(str(tmp_path / "audit"))
+    monkeypatch.setattr(lambda_function, "audit_log", log)
+
+    transport = FakeTransport({"queue": {"length": 500}})
+    for _ in range(2):
+        clients = plan.snapshot_clients(make_snapshot(0), HTTP_CLUSTER_DEF)
+        with fake_clients(**clients), use_adapter(transport):
+            lambda_function.lambda_handler({}, None)
+    # Test runs are not logged.
+    clients = plan.snapshot_clients(make_snapshot(0), HTTP_CLUSTER_DEF)
+    with fake_clients(**clients), use_adapter(transport):
+        lambda_function.lambda_handler({"test_run": True}, None)
+
+    path, = (tmp_path / "audit").iterdir()
+    assert path.stat().st_size < 1024
+    columns = load(str(tmp_path / "audit"))
+    assert len(columns["ticks"]["time"]) == 2
+    assert list(columns["ticks"]["clusters"]) == [1, 1]
+    assert columns["clusters"]["cluster"] == ["my_cluster"] * 2
+    assert columns["clusters"]["action"] == ["scale_up"] * 2
+    services = columns["services"]
+    assert services["service"] == ["worker"] * 2
+    assert list(services["desired_tasks"]) == [5, 5]
+    assert services["decision"] == ["event:0"] * 2
+    metrics = columns["metrics"]
+    assert metrics["metric"] == ["queue_length"] * 2
+    assert list(metrics["value"]) == [500.0, 500.0]
+
+
+def test_load_time_range(tmp_path):
+    clock = Clock(DAY_1)
+    log = AuditLog(str(tmp_path), clock=clock)
+    for now in (DAY_1, DAY_1 + 60, DAY_2):
+        clock.now = now
+        log.start_tick()
+        log.flush()
+    assert len(list(tmp_path.iterdir())) == 2
+
+    assert len(load(str(tmp_path))["ticks"]["time"]) == 3
+    start = datetime(2024, 1, 1, 12, 0, 30)
+    assert list(load(str(tmp_path), start=start)["ticks"]["time"]) == \
+        [DAY_1 + 60, DAY_2]
+    end = datetime(2024, 1, 2, tzinfo=timezone.utc)
+    assert list(load(str(tmp_path), start=start, end=end)["ticks"]["time"]) \
+        == [DAY_1 + 60]
+
+
+def test_load_columns_added_later(tmp_path, monkeypatch):
+    log = AuditLog(str(tmp_path), clock=Clock(DAY_1))
+    with monkeypatch.context() as patch:
+        patch.setitem(audit.TABLES, "ticks", [("time", "d")])
+        log.start_tick()
+        log.flush()
+    ticks = load(str(tmp_path))["ticks"]
+    assert list(ticks["time"]) == [DAY_1]
+    assert math.isnan(ticks["seconds"][0])
+    assert list(ticks["clusters"]) == [audit.MISSING]
+
+
+def test_s3_sink():
+    objects = {}
+
+    def put_object(Bucket, Key, Body):
+        objects[Key] = Body
+        return {}
+
+    def list_objects_v2(Bucket, Prefix, **kwargs):
+        return {"Contents": [{"Key": x} for x in sorted(objects)
+                             if x.startswith(Prefix)]}
+
+    def get_object(Bucket, Key):
+        return {"Body": io.BytesIO(objects[Key])}
+
+    s3 = FakeClient({"put_object": put_object,
+                     "list_objects_v2": list_objects_v2,
+                     "get_object": get_object})
+    log = AuditLog("s3://my-bucket/audit/", clock=Clock(DAY_2))
+    with fake_clients(s3=s3):
+        log.start_tick(targeted=True)
+        path = log.flush()
+        assert path.startswith("s3://my-bucket/audit/2024/01/02/tick-")
+        columns = load("s3://my-bucket/audit/",
+                       start=datetime(2024, 1, 2, tzinfo=timezone.utc))
+    assert list(columns["ticks"]["targeted"]) == [1]
@@ -0,0 +1,46 @@
+"""Test the deployment package build and the cold start benchmark."""
+
+import os
+import sys
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+
+import bench_cold_start  # noqa: E402
+import build  # noqa: E402
+
+
+def test_build_and_bench(tmp_path):
+    package, = build.build(str(tmp_path), strip_sources=True,
+                           install_deps=False)
+    with zipfile.ZipFile(package) as archive:
+        names = archive.namelist()
+    assert "lambda_function.pyc" in names
+    assert "ecsautoscale/services.pyc" in names
+    assert not [x for x in names if x.endswith(".py")]
+    assert not [x for x in names if "__pycache__" in x]
+
+    res = bench_cold_start.bench(package, runs=1)
+    assert res["package"]["unzipped"] > res["package"]["zipped"]
+    assert res["import_ms"]["median"] > 0
+    assert res["invocation_ms"]["median"] > 0
+    assert res["loader"] == "SourcelessFileLoader"
+    assert res["compiled"] == []
+
+
+def test_build_keeps_sources_with_cache(tmp_path):
+    package, = build.build(str(tmp_path), install_deps=False)
+    cached = "ecsautoscale/__pycache__/services.{:s}.pyc".format(
+        sys.implementation.cache_tag)
+    with zipfile.ZipFile(package) as archive:
+        names = archive.namelist()
+    assert "ecsautoscale/services.py" in names
+    assert cached in names
+    assert not [x for x in names
+                if x.endswith(".pyc") and "__pycache__" not in x]
+
+    # The cached files are used, nothing is compiled at import.
+    res = bench_cold_start.bench(package, runs=1)
+    assert res["loader"] == "SourceFileLoader"
+    assert res["compiled"] == []
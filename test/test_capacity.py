@@ -0,0 +1,140 @@
+"""Test capacity accounting of launching instances and pending tasks."""
+
+from ecsautoscale import instances
+from ecsautoscale.instances import count_launching_instances, scale_up
+from ecsautoscale.services import Service, select_services
+
+from helpers import TASK_CPU, TASK_MEM, make_instance
+
+
+EVENTS = [{"metric": "load", "min": 80, "max": None, "action": 2}]
+
+
+class Cluster:
+    """
+    A tiny model of an ECS cluster: instances hold two tasks, take two ticks
+    to register, and placed tasks take a tick to start.
+    """
+
+    def __init__(self) -> None:
+        self.tasks = {"i-0": 2, "i-1": 2}
+        self.booting = []
+        self.desired_capacity = 2
+        self.desired = 4
+        self.running = 4
+        self.pending = 0
+
+    def cluster_data(self) -> dict:
+        return {
+            "cluster_name": "test_cluster",
+            "active_container_described": {"containerInstances": [
+                make_instance(x, n) for x, n in self.tasks.items()
+            ]},
+            "draining_container_described": {"containerInstances": []},
+        }
+
+    def advance(self) -> None:
+        self.running += self.pending
+        self.pending = 0
+        self.booting = [x - 1 for x in self.booting]
+        while self.booting and self.booting[0] <= 0:
+            self.booting.pop(0)
+            self.tasks["i-{:d}".format(len(self.tasks))] = 0
+        for instance_id in self.tasks:
+            while self.tasks[instance_id] < 2 and \
+                    self.running + self.pending < self.desired:
+                self.tasks[instance_id] += 1
+                self.pending += 1
+
+
+def run_burst(aware: bool, ticks: int = 12) -> int:
+    """Run a burst that needs 8 tasks and return the instances requested."""
+    cluster = Cluster()
+    for _ in range(ticks):
+        load = 90 if cluster.running < 8 else 50
+        service = Service(
+            "test_cluster", "web", None, cluster.running,
+            events=EVENTS,
+            max_tasks=20,
+            state={"load": load},
+            desired_count=cluster.desired if aware else None,
+            pending_count=cluster.pending if aware else 0,
+        )
+        service.task_cpu = TASK_CPU
+        service.task_mem = TASK_MEM
+        services = select_services([service])
+        asg_group_data = {
+            "DesiredCapacity": cluster.desired_capacity,
+            "MinSize": 0,
+            "MaxSize": 10,
+        }
+        if scale_up(cluster.cluster_data(), {"autoscale_group": "asg"},
+                    asg_group_data, services, is_test_run=True):
+            cluster.desired_capacity += 1
+            cluster.booting.append(2)
+        if service.task_diff:
+            cluster.desired = service.desired_tasks
+        cluster.advance()
+    assert cluster.running == 8
+    return cluster.desired_capacity
+
+
+def test_burst_over_provisioning(monkeypatch):
+    aware = run_burst(aware=True)
+    # What the old accounting would do, ignoring launching instances and
+    # tasks that are still starting.
+    monkeypatch.setattr(instances, "get_launching_instances",
+                        lambda *args: [])
+    naive = run_burst(aware=False)
+    assert aware == 4
+    assert naive > aware
+
+
+def test_count_launching_instances():
+    cluster_data = Cluster().cluster_data()
+    asg_group_data = {"DesiredCapacity": 4}
+    assert count_launching_instances(cluster_data, asg_group_data) == 2
+
+    asg_group_data["Instances"] = [
+        {"InstanceId": "i-0", "LifecycleState": "InService"},
+        {"InstanceId": "i-1", "LifecycleState": "InService"},
+        {"InstanceId": "i-2", "LifecycleState": "Pending"},
+        {"InstanceId": "i-3", "LifecycleState": "Terminating"},
+    ]
+    assert count_launching_instances(cluster_data, asg_group_data) == 2
+
+    # Instances that never registered are only launching while pending.
+    asg_group_data["Instances"] += [
+        {"InstanceId": "i-4", "LifecycleState": "InService"},
+        {"InstanceId": "i-5", "LifecycleState": "Standby"},
+        {"InstanceId": "i-6", "LifecycleState": "Pending:Wait"},
+    ]
+    asg_group_data["DesiredCapacity"] = 5
+    assert count_launching_instances(cluster_data, asg_group_data) == 2
+
+
+def test_unplaced_tasks_need_capacity():
+    service = Service("test_cluster", "web", None, 2,
+                      desired_count=5, pending_count=1)
+    assert service.unplaced_count == 2
+    assert not service.pretend_scale()
+    assert select_services([service]) == [service]
+    assert service.tasks_to_place == 2
+
+
+def test_scale_out_beyond_starting_tasks():
+    events = [{"metric": "load", "min": 80, "max": None, "action": 3}]
+    # One task is still starting, it covers one of the three tasks asked for.
+    service = Service("test_cluster", "web", None, 4, events=events,
+                      max_tasks=20, state={"load": 90},
+                      desired_count=5, pending_count=1)
+    assert service.pretend_scale(save=False)
+    assert service.desired_tasks == 7
+    assert service.task_diff == 2
+
+    # Three starting tasks already cover the demand.
+    service = Service("test_cluster", "web", None, 2, events=events,
+                      max_tasks=20, state={"load": 90},
+                      desired_count=5, pending_count=3)
+    assert not service.pretend_scale(save=False)
+    assert service.task_diff == 0
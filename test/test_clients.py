@@ -0,0 +1,89 @@
+"""Test the ecsautoscale.clients module."""
+
+from datetime import datetime, timedelta, timezone
+import threading
+
+from ecsautoscale.clients import ClientPool, ClientProxy, scope
+
+
+class FakeSTS:
+
+    def __init__(self, lifetime: timedelta) -> None:
+        self.lifetime = lifetime
+        self.calls = 0
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        self.calls += 1
+        return {"Credentials": {
+            "AccessKeyId": "AKID{}".format(self.calls),
+            "SecretAccessKey": "secret",
+            "SessionToken": "token",
+            "Expiration": datetime.now(timezone.utc) + self.lifetime,
+        }}
+
+
+class FakeSession:
+
+    def __init__(self, sts: FakeSTS, **kwargs) -> None:
+        self.sts = sts
+        self.kwargs = kwargs
+
+    def client(self, service):
+        if service == "sts":
+            return self.sts
+        return (service, self.kwargs.get("region_name"),
+                self.kwargs.get("aws_access_key_id"))
+
+
+def make_pool(lifetime: timedelta) -> ClientPool:
+    sts = FakeSTS(lifetime)
+    return ClientPool(
+        session_factory=lambda **kwargs: FakeSession(sts, **kwargs),
+        throttle=False)
+
+
+def test_clients_cached_per_account_region_service():
+    pool = make_pool(timedelta(hours=1))
+    ecs = pool.get("ecs", region="us-east-1")
+    assert pool.get("ecs", region="us-east-1") is ecs
+    assert pool.get("ecs", region="us-west-2") != ecs
+    role = "arn:aws:iam::123456789012:role/autoscale"
+    assert pool.get("ecs", region="us-east-1", role_arn=role) == \
+        ("ecs", "us-east-1", "AKID1")
+
+
+def test_roles_in_one_account_are_not_shared():
+    pool = make_pool(timedelta(hours=1))
+    reader = "arn:aws:iam::123456789012:role/reader"
+    writer = "arn:aws:iam::123456789012:role/writer"
+    assert pool.get("ecs", role_arn=reader)[2] == "AKID1"
+    assert pool.get("ecs", role_arn=writer)[2] == "AKID2"
+    assert pool.get("ecs", role_arn=reader)[2] == "AKID1"
+
+
+def test_assumed_role_credentials_refreshed():
+    # Credentials that are about to expire get refreshed on the next call.
+    pool = make_pool(timedelta(minutes=1))
+    role = "arn:aws:iam::123456789012:role/autoscale"
+    assert pool.get("ecs", role_arn=role)[2] == "AKID1"
+    assert pool.get("ecs", role_arn=role)[2] == "AKID2"
+
+
+def test_proxy_follows_thread_scope():
+    pool = make_pool(timedelta(hours=1))
+    proxy = ClientProxy("ecs", client_pool=pool)
+    assert proxy.client[1] is None
+    seen = {}
+
+    def worker(region):
+        with scope(region):
+            seen[region] = proxy.client[1]
+
+    threads = [threading.Thread(target=worker, args=(region,))
+               for region in ("us-east-1", "eu-west-1")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == {"us-east-1": "us-east-1", "eu-west-1": "eu-west-1"}
+    assert proxy.client[1] is None
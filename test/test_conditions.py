@@ -0,0 +1,127 @@
+"""Test windowed and composite conditions of scaling events."""
+
+from typing import List
+
+import pytest
+
+from ecsautoscale.conditions import (
+    NAMESPACE, ServiceConditions, aggregate, parse_events,
+)
+from ecsautoscale.services import Service
+from ecsautoscale.state import StateStore, use_store
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def run(events: List[dict], values: List[float], store: StateStore = None,
+        step: float = 60) -> List[List[bool]]:
+    """Evaluate the events over ticks with the given values of `foo`."""
+    store = store or StateStore()
+    clock = Clock()
+    out = []
+    for value in values:
+        conditions = ServiceConditions("c", "s", events, state_store=store,
+                                       clock=clock)
+        out.append([fires for _, fires in
+                    conditions.evaluate(lambda x: eval(x, {"foo": value}))])
+        clock.now += step
+    return out
+
+
+def test_aggregate():
+    samples = [[0, 1.0], [60, 4.0], [120, 7.0]]
+    assert aggregate("last", samples) == 7
+    assert aggregate("avg", samples) == 4
+    assert aggregate("min", samples) == 1
+    assert aggregate("max", samples) == 7
+    assert aggregate("sum", samples) == 12
+    assert aggregate("rate", samples) == 3
+    assert aggregate("rate", samples[:1]) is None
+    assert aggregate("avg", []) is None
+
+
+def test_window_of_samples():
+    events = [{"metric": "foo", "aggregate": "avg", "window": 3, "min": 10,
+               "max": None, "action": 1}]
+    # One spike does not move the average over three ticks enough.
+    assert run(events, [0, 0, 25, 0, 0, 20, 20]) == \
+        [[False], [False], [False], [False], [False], [False], [True]]
+
+
+def test_gaps_in_window():
+    assert aggregate("avg", [[0, 1.0], [60, None], [120, 7.0]]) == 4
+    assert aggregate("rate", [[0, 1.0], [60, 4.0], [120, None]]) == 3
+    assert aggregate("max", [[0, None]]) is None
+
+    events = [{"metric": "foo", "aggregate": "avg", "window": 3, "min": 10,
+               "max": None, "action": 1}]
+    # Ticks without data neither crash nor count as zero.
+    assert run(events, [None, 0, None, 30, 30]) == \
+        [[False], [False], [False], [True], [True]]
+
+
+def test_window_of_time_and_rate():
+    events = [{"metric": "foo", "aggregate": "rate", "window": "3m",
+               "min": 5, "action": 1}]
+    # Growth per minute over the last three minutes.
+    assert run(events, [0, 10, 20, 20, 20]) == \
+        [[False], [True], [True], [True], [False]]
+
+
+def test_for_consecutive_ticks():
+    events = [{"metric": "foo", "min": 10, "for": 3, "action": 1}]
+    assert run(events, [11, 12, 5, 11, 12, 13, 14]) == \
+        [[False], [False], [False], [False], [False], [True], [True]]
+
+
+def test_composite():
+    events = [
+        {"all": [{"metric": "foo", "min": 10},
+                 {"any": [{"metric": "foo * 2", "min": 30},
+                          {"metric": "foo", "aggregate": "max",
+                           "window": 2, "min": 50}]}],
+         "action": 1},
+    ]
+    assert run(events, [12, 16, 60, 12, 8]) == \
+        [[False], [True], [True], [True], [False]]
+
+
+def test_plain_events_keep_nothing():
+    store = StateStore()
+    windowed = [{"metric": "foo", "aggregate": "avg", "window": 2,
+                 "min": 1, "action": 1}]
+    run(windowed, [1, 2, 3, 4], store=store)
+    assert len(store.get(NAMESPACE, "c/s")["samples"]["foo"]) == 2
+
+    plain = [{"metric": "foo", "min": 1, "max": None, "action": 1}]
+    assert run(plain, [1, 0], store=store) == [[True], [False]]
+    assert store.get(NAMESPACE, "c/s") is None
+
+
+def test_invalid_events_are_ignored():
+    events = parse_events([
+        {"metric": "foo", "aggregate": "median", "window": 2, "action": 1},
+        {"metric": "foo", "window": "soon", "action": 1},
+        {"any": [], "action": 1},
+        {"metric": "foo", "min": 1, "action": -1},
+    ])
+    assert [x.action for x in events] == [-1]
+
+
+@pytest.mark.parametrize("save", [True, False])
+def test_service_events(service: Service, save: bool):
+    service.events = [
+        {"metric": "foo", "min": 1, "for": 2, "action": 1},
+    ]
+    with use_store(StateStore()) as store:
+        assert not service.pretend_scale(save=save)
+        assert service.pretend_scale(save=save) is save
+        assert (store.get(NAMESPACE, "test_cluster/") is not None) is save
+    if save:
+        assert service.desired_tasks == 2
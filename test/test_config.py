@@ -0,0 +1,141 @@
+"""Test the cluster definition sources."""
+
+import hashlib
+import io
+import os
+
+import pytest
+
+from ecsautoscale.config import (
+    LocalSource, S3Source, SSMSource, source_from_uri,
+)
+from ecsautoscale.exceptions import ConfigSourceError
+
+from helpers import FakeClient, fake_clients
+
+
+CLUSTER_DEF = """
+autoscale_group: %(ASG_NAME)
+enabled: true
+cpu_buffer: {:d}
+mem_buffer: 0
+services: {{}}
+"""
+
+
+class FakeBucket:
+    """A local stand-in for an S3 bucket."""
+
+    def __init__(self) -> None:
+        self.objects = {}
+
+    def put(self, key: str, body: str) -> None:
+        self.objects[key] = body.encode("utf-8")
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs):
+        return {"Contents": [
+            {"Key": key, "ETag": hashlib.md5(body).hexdigest()}
+            for key, body in sorted(self.objects.items())
+            if key.startswith(Prefix)
+        ], "IsTruncated": False}
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def client(self) -> FakeClient:
+        return FakeClient({
+            "list_objects_v2": self.list_objects_v2,
+            "get_object": self.get_object,
+        })
+
+
+@pytest.fixture(autouse=True)
+def asg_name(monkeypatch):
+    monkeypatch.setenv("ASG_NAME", "my-asg")
+
+
+def test_local_source(tmp_path):
+    path = tmp_path / "cluster-a.yml"
+    path.write_text(CLUSTER_DEF.format(10))
+    (tmp_path / "README.md").write_text("not a cluster")
+    source = LocalSource(str(tmp_path))
+
+    defs = source.load()
+    assert defs == {"cluster-a": {
+        "autoscale_group": "my-asg", "enabled": True, "cpu_buffer": 10,
+        "mem_buffer": 0, "services": {},
+    }}
+
+    path.write_text(CLUSTER_DEF.format(200))
+    os.utime(str(path), ns=(0, 10 ** 9))
+    assert source.load()["cluster-a"]["cpu_buffer"] == 200
+
+    path.unlink()
+    assert source.load() == {}
+
+
+def test_s3_source_conditional_fetch():
+    bucket = FakeBucket()
+    bucket.put("clusters/cluster-a.yml", CLUSTER_DEF.format(10))
+    bucket.put("clusters/cluster-b.yml", CLUSTER_DEF.format(20))
+    bucket.put("clusters/old/cluster-c.yml", CLUSTER_DEF.format(30))
+    s3 = bucket.client()
+    source = source_from_uri("s3://configs/clusters/")
+    assert isinstance(source, S3Source)
+
+    with fake_clients(s3=s3):
+        defs = source.load()
+        assert sorted(defs) == ["cluster-a", "cluster-b"]
+        assert len(s3.calls_to("get_object")) == 2
+
+        # Unchanged, only listed.
+        defs["cluster-a"]["cpu_buffer"] = 0
+        assert source.load()["cluster-a"]["cpu_buffer"] == 10
+        assert len(s3.calls_to("get_object")) == 2
+
+        bucket.put("clusters/cluster-b.yml", CLUSTER_DEF.format(25))
+        assert source.load()["cluster-b"]["cpu_buffer"] == 25
+        assert s3.calls_to("get_object")[-1]["Key"] == "clusters/cluster-b.yml"
+        assert len(s3.calls_to("get_object")) == 3
+
+
+def test_s3_source_unavailable():
+    bucket = FakeBucket()
+    bucket.put("cluster-a.yml", CLUSTER_DEF.format(10))
+    source = S3Source("configs")
+
+    with fake_clients(s3=bucket.client()):
+        assert "cluster-a" in source.load()
+    # Last definitions loaded are kept when S3 cannot be reached.
+    with fake_clients(s3=FakeClient()):
+        assert "cluster-a" in source.load()
+    with fake_clients(s3=FakeClient()):
+        with pytest.raises(ConfigSourceError):
+            S3Source("configs").load()
+
+
+def test_ssm_source():
+    params = {
+        "/ecs-autoscale/cluster-a": (1, CLUSTER_DEF.format(10)),
+        "/ecs-autoscale/cluster-b": (3, CLUSTER_DEF.format(20)),
+    }
+
+    def describe_parameters(**kwargs):
+        return {"Parameters": [{"Name": name, "Version": version}
+                               for name, (version, _) in params.items()]}
+
+    def get_parameters(Names, **kwargs):
+        return {"Parameters": [{"Name": name, "Value": params[name][1]}
+                               for name in Names]}
+
+    ssm = FakeClient({"describe_parameters": describe_parameters,
+                      "get_parameters": get_parameters})
+    source = source_from_uri("ssm:/ecs-autoscale")
+    assert isinstance(source, SSMSource)
+
+    with fake_clients(ssm=ssm):
+        assert source.load()["cluster-b"]["cpu_buffer"] == 20
+        params["/ecs-autoscale/cluster-a"] = (2, CLUSTER_DEF.format(15))
+        assert source.load()["cluster-a"]["cpu_buffer"] == 15
+    assert ssm.calls_to("get_parameters")[-1]["Names"] == \
+        ["/ecs-autoscale/cluster-a"]
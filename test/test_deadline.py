@@ -0,0 +1,80 @@
+"""Test the deadline budget and stale metric fallback."""
+
+import threading
+
+from ecsautoscale.deadline import Deadline
+from ecsautoscale.metric_cache import MetricCache
+from ecsautoscale.metric_sources import MetricSource, register
+from ecsautoscale.services import Service, collect_metrics
+from ecsautoscale.state import StateStore
+
+
+class Context:
+
+    def get_remaining_time_in_millis(self):
+        return 30000
+
+
+class HangingSource(MetricSource):
+
+    def __init__(self) -> None:
+        self.release = threading.Event()
+        self.hang = False
+
+    def fetch_many(self, requests):
+        if self.hang:
+            self.release.wait(5)
+        return [{"depth": 7} for _ in requests]
+
+
+class FailingSource(MetricSource):
+
+    def fetch_many(self, requests):
+        return [RuntimeError("down") for _ in requests]
+
+
+def make_service(source_name: str, max_staleness: float = None) -> Service:
+    return Service("test_cluster", "worker", None, 1,
+                   metric_sources={source_name: [{"queue": "jobs"}]},
+                   max_staleness=max_staleness)
+
+
+def test_from_context():
+    deadline = Deadline.from_context(Context())
+    assert 27 < deadline.remaining() <= 28
+    assert Deadline.from_context(None, budget=5).remaining() <= 5
+
+
+def test_slow_source_uses_last_known_value():
+    source = register("hanging", HangingSource())
+    cache = MetricCache(StateStore())
+
+    service = make_service("hanging")
+    collect_metrics([service], deadline=Deadline(10), cache=cache)
+    assert service.state == {"depth": 7}
+
+    source.hang = True
+    try:
+        service = make_service("hanging")
+        collect_metrics([service], deadline=Deadline(0.2), cache=cache)
+        assert service.state == {"depth": 7}
+        assert service.metrics_error is None
+    finally:
+        source.release.set()
+
+
+def test_stale_value_too_old():
+    register("failing", FailingSource())
+    now = [1000.0]
+    cache = MetricCache(StateStore(), clock=lambda: now[0])
+    cache.put("failing", {"queue": "jobs"}, {"depth": 3})
+
+    now[0] += 60
+    service = make_service("failing", max_staleness=120)
+    collect_metrics([service], cache=cache)
+    assert service.state == {"depth": 3}
+
+    now[0] += 120
+    service = make_service("failing", max_staleness=120)
+    collect_metrics([service], cache=cache)
+    assert isinstance(service.metrics_error, RuntimeError)
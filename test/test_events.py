@@ -0,0 +1,110 @@
+"""Test the ecsautoscale.events module."""
+
+import json
+
+import pytest
+
+from ecsautoscale.events import is_test_run, parse_event
+
+
+cluster_defs = {
+    "my_cluster": {
+        "services": {
+            "worker": {"alarms": ["queue-depth-high"]},
+            "backend": {},
+        },
+    },
+}
+
+
+@pytest.mark.parametrize("event", [
+    1,
+    "TEST_RUN",
+    {},
+    {"source": "aws.events", "detail-type": "Scheduled Event", "detail": {}},
+])
+def test_full_sweep(event):
+    assert parse_event(event, cluster_defs) is None
+
+
+def test_explicit_payload():
+    targets = parse_event({"cluster": "my_cluster", "service": "worker",
+                           "test_run": True}, cluster_defs)
+    assert len(targets) == 1
+    assert targets[0].cluster_name == "my_cluster"
+    assert targets[0].service_names == {"worker"}
+    assert is_test_run({"cluster": "my_cluster", "test_run": True})
+
+    targets = parse_event({"cluster": "my_cluster"}, cluster_defs)
+    assert targets[0].service_names is None
+
+
+def test_unknown_cluster_ignored():
+    assert parse_event({"cluster": "other", "service": "worker"},
+                       cluster_defs) == []
+
+
+def test_alarm_by_name():
+    event = {
+        "detail-type": "CloudWatch Alarm State Change",
+        "detail": {"alarmName": "queue-depth-high", "configuration": {
+            "metrics": [{"metricStat": {"metric": {
+                "namespace": "AWS/SQS",
+                "dimensions": {"QueueName": "jobs"},
+            }}}],
+        }},
+    }
+    targets = parse_event(event, cluster_defs)
+    assert [(x.cluster_name, x.service_names) for x in targets] == \
+        [("my_cluster", {"worker"})]
+
+
+def test_alarm_by_dimensions():
+    event = {
+        "detail-type": "CloudWatch Alarm State Change",
+        "detail": {"alarmName": "cpu-high", "configuration": {
+            "metrics": [{"metricStat": {"metric": {
+                "namespace": "AWS/ECS",
+                "dimensions": {"ClusterName": "my_cluster",
+                               "ServiceName": "backend"},
+            }}}],
+        }},
+    }
+    targets = parse_event(event, cluster_defs)
+    assert targets[0].service_names == {"backend"}
+
+
+def test_task_state_change():
+    event = {
+        "detail-type": "ECS Task State Change",
+        "detail": {
+            "clusterArn": "arn:aws:ecs:us-east-1:1:cluster/my_cluster",
+            "group": "service:backend",
+        },
+    }
+    targets = parse_event(event, cluster_defs)
+    assert targets[0].service_names == {"backend"}
+
+
+def test_sqs_records_merged():
+    event = {"Records": [
+        {"eventSource": "aws:sqs",
+         "body": json.dumps({"cluster": "my_cluster", "service": "worker"})},
+        {"eventSource": "aws:sqs",
+         "body": json.dumps({"cluster": "my_cluster", "service": "backend"})},
+    ]}
+    targets = parse_event(event, cluster_defs)
+    assert len(targets) == 1
+    assert targets[0].service_names == {"worker", "backend"}
+
+
+def test_sqs_bad_records_skipped():
+    event = {"Records": [
+        {"eventSource": "aws:sqs", "messageId": "1", "body": "not json"},
+        {"eventSource": "aws:sqs", "messageId": "2", "body": None},
+        {"eventSource": "aws:sqs", "messageId": "3"},
+        {"eventSource": "aws:sqs",
+         "body": json.dumps({"cluster": "my_cluster", "service": "worker"})},
+    ]}
+    target, = parse_event(event, cluster_defs)
+    assert target.service_names == {"worker"}
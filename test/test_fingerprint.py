@@ -0,0 +1,91 @@
+"""Test the ecsautoscale.fingerprint module."""
+
+from ecsautoscale.fingerprint import ClusterFingerprint
+from ecsautoscale.services import Service
+from ecsautoscale.state import StateStore
+
+
+cluster_def = {"enabled": True, "services": {}}
+
+cluster_data = {
+    "active_container_described": {"containerInstances": [{
+        "ec2InstanceId": "i-1",
+        "remainingResources": [
+            {"name": "CPU", "integerValue": 1024},
+            {"name": "MEMORY", "integerValue": 2048},
+        ],
+        "runningTasksCount": 2,
+        "pendingTasksCount": 0,
+    }]},
+    "draining_container_described": {"containerInstances": []},
+}
+
+asg_group_data = {"DesiredCapacity": 1, "MinSize": 1, "MaxSize": 3}
+
+
+def make_service(value: float) -> Service:
+    service = Service("test_cluster", "worker", None, 1, events=[{
+        "metric": "foo", "action": 1, "min": 10, "max": None,
+    }])
+    service.state = {"foo": value}
+    return service
+
+
+def fingerprint(store: StateStore, value: float) -> ClusterFingerprint:
+    fp = ClusterFingerprint("test_cluster", cluster_def, state_store=store,
+                            full_evaluation_every=2)
+    fp.add_service(make_service(value))
+    fp.add_cluster(cluster_data, asg_group_data)
+    return fp
+
+
+def test_metric_values_bucketed():
+    store = StateStore()
+    assert fingerprint(store, 1).digest() == fingerprint(store, 5).digest()
+    assert fingerprint(store, 1).digest() != fingerprint(store, 50).digest()
+
+
+def test_composite_events_bucketed():
+    def digest(foo: float, bar: float) -> str:
+        service = Service("test_cluster", "worker", None, 1, events=[{
+            "any": [{"metric": "foo", "min": 10},
+                    {"all": [{"metric": "bar", "max": 5}]}],
+            "action": 1,
+        }])
+        service.state = {"foo": foo, "bar": bar}
+        fp = ClusterFingerprint("test_cluster", cluster_def,
+                                state_store=StateStore())
+        fp.add_service(service)
+        return fp.digest()
+
+    assert digest(1, 1) == digest(5, 2)
+    assert digest(1, 1) != digest(50, 1)
+    assert digest(1, 1) != digest(1, 50)
+
+
+def test_skip_and_forced_full_evaluation():
+    store = StateStore()
+
+    # First tick, nothing to compare against.
+    fp = fingerprint(store, 1)
+    assert not fp.unchanged()
+    fp.record(acted=False)
+
+    # Same inputs, skipped twice.
+    for _ in range(2):
+        fp = fingerprint(store, 2)
+        assert fp.unchanged()
+        fp.record(acted=False, skipped=True)
+
+    # Full evaluation forced.
+    fp = fingerprint(store, 3)
+    assert not fp.unchanged()
+    fp.record(acted=False)
+    assert fingerprint(store, 3).unchanged()
+
+
+def test_no_skip_after_action():
+    store = StateStore()
+    fp = fingerprint(store, 1)
+    fp.record(acted=True)
+    assert not fingerprint(store, 1).unchanged()
@@ -0,0 +1,98 @@
+"""Test headroom: the buffer, warm spares and percentages of the cluster."""
+
+from ecsautoscale.headroom import Headroom
+from ecsautoscale.instances import place_instance, scale_up
+from ecsautoscale.services import Service
+
+from helpers import TASK_CPU, TASK_MEM, make_instance
+
+
+def cluster_data(*tasks: int) -> dict:
+    return {
+        "cluster_name": "test_cluster",
+        "active_container_described": {"containerInstances": [
+            make_instance("i-{:d}".format(i), n) for i, n in enumerate(tasks)
+        ]},
+        "draining_container_described": {"containerInstances": []},
+    }
+
+
+def needs_instance(headroom: Headroom, *tasks: int) -> bool:
+    asg_group_data = {"DesiredCapacity": len(tasks), "MinSize": 0,
+                      "MaxSize": 10}
+    return scale_up(cluster_data(*tasks), {"autoscale_group": "asg"},
+                    asg_group_data, [], is_test_run=True, headroom=headroom)
+
+
+def make_service(desired: int, **kwargs) -> Service:
+    service = Service("test_cluster", "web", None, desired, **kwargs)
+    service.task_cpu = TASK_CPU
+    service.task_mem = TASK_MEM
+    return service
+
+
+def cluster_def(**kwargs) -> dict:
+    cluster_def = {"cpu_buffer": 0, "mem_buffer": 0, "services": {}}
+    cluster_def.update(kwargs)
+    return cluster_def
+
+
+def test_buffer():
+    # Each instance has room for one more task.
+    small = Headroom.from_cluster_def(
+        cluster_def(cpu_buffer=TASK_CPU, mem_buffer=TASK_MEM), [])
+    assert not needs_instance(small, 1, 1)
+    large = Headroom.from_cluster_def(
+        cluster_def(cpu_buffer=2 * TASK_CPU), [])
+    assert needs_instance(large, 1, 1)
+    assert not needs_instance(large, 1, 0)
+    assert Headroom.from_cluster_def(cluster_def(), []).empty
+
+
+def test_percentages():
+    def headroom(percent: float) -> Headroom:
+        return Headroom.from_cluster_def(
+            cluster_def(headroom={"cpu_percent": percent}), [])
+
+    # Half of the CPU is unreserved.
+    assert not needs_instance(headroom(50), 1, 1)
+    assert needs_instance(headroom(60), 1, 1)
+
+    # Draining the empty instance would leave 25% of the CPU unreserved.
+    instances = cluster_data(1, 2, 0)["active_container_described"][
+        "containerInstances"]
+    assert place_instance(instances[2], instances, [],
+                          headroom=headroom(25))
+    assert not place_instance(instances[2], instances, [],
+                              headroom=headroom(30))
+
+
+def test_warm_spares():
+    spares = cluster_def(services={"web": {"warm_spares": 3}})
+    service = make_service(2, max_tasks=10)
+    headroom = Headroom.from_cluster_def(spares, [service])
+    assert headroom.services == [service]
+    assert needs_instance(headroom, 1, 1)
+    assert not needs_instance(headroom, 1, 0)
+
+    # Never more spares than the service can scale out to.
+    capped = Headroom.from_cluster_def(spares, [make_service(2, max_tasks=4)])
+    assert capped.blocks[0][2] == 2
+    assert not needs_instance(capped, 1, 1)
+    assert Headroom.from_cluster_def(
+        spares, [make_service(4, max_tasks=4)]).empty
+
+
+def test_warm_spares_honor_constraints():
+    service = make_service(
+        2, max_tasks=10,
+        placement_constraints=[{"type": "distinctInstance"}])
+    service.task_instance_arns = [
+        "arn:aws:ecs:::container-instance/i-0",
+        "arn:aws:ecs:::container-instance/i-1",
+    ]
+    headroom = Headroom.from_cluster_def(
+        cluster_def(services={"web": {"warm_spares": 1}}), [service])
+    # There is room, but only on instances already running the service.
+    assert needs_instance(headroom, 1, 1)
+    assert not needs_instance(headroom, 1, 1, 0)
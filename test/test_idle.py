@@ -0,0 +1,93 @@
+"""Test the scale-from-zero fast path of idle services."""
+
+import copy
+
+import plan
+from ecsautoscale.services import _task_definitions, build_services
+
+from helpers import CLUSTER_DEF, fake_clients, make_instance, make_snapshot
+
+
+IDLE_DEF = copy.deepcopy(CLUSTER_DEF)
+IDLE_DEF["services"]["worker"].update(
+    min=0,
+    idle={"metric": "queue_length", "wake": 3},
+    metric_sources={"sqs": [
+        {"queue": "jobs", "statistics": [{"alias": "queue_length"}]},
+        {"queue": "jobs-dead", "statistics": [{"alias": "dead_letters"}]},
+    ]},
+)
+
+
+def idle_snapshot(queue_length: int) -> dict:
+    snapshot = make_snapshot(queue_length)
+    snapshot["services"][0].update(runningCount=0, desiredCount=0)
+    return snapshot
+
+
+def test_idle_service_only_fetches_signal():
+    _task_definitions.clear()
+    clients = plan.snapshot_clients(idle_snapshot(0), IDLE_DEF)
+    with fake_clients(**clients):
+        worker, = build_services("my_cluster", IDLE_DEF)
+    assert worker.idle
+    assert worker.metric_sources == {"sqs": [
+        {"queue": "jobs", "statistics": [{"alias": "queue_length"}]},
+    ]}
+    assert "describe_task_definition" not in \
+        [op for op, _ in clients["ecs"].calls]
+
+    # Services running tasks go through every source as usual.
+    snapshot = idle_snapshot(0)
+    snapshot["services"][0].update(runningCount=1, desiredCount=1)
+    clients = plan.snapshot_clients(snapshot, IDLE_DEF)
+    with fake_clients(**clients):
+        worker, = build_services("my_cluster", IDLE_DEF)
+    assert not worker.idle
+    assert len(worker.metric_sources["sqs"]) == 2
+
+
+def test_wake_up():
+    result = plan.plan(IDLE_DEF, idle_snapshot(0))
+    assert result["actions"] == []
+
+    # Any work wakes the service straight up to its wake count, even though
+    # no event would fire yet.
+    result = plan.plan(IDLE_DEF, idle_snapshot(5))
+    worker, = result["services"]
+    assert worker["desired_tasks"] == 3
+    update, = [x for x in result["actions"]
+               if x["operation"] == "update_service"]
+    assert update["params"]["desiredCount"] == 3
+
+
+def test_warm_instance():
+    warm_def = copy.deepcopy(IDLE_DEF)
+    warm_def["services"]["worker"]["idle"]["warm"] = True
+    # Room for one worker task is left on i-1.
+    assert plan.plan(warm_def, idle_snapshot(0))["cluster_action"] is None
+
+    snapshot = idle_snapshot(0)
+    snapshot["container_instances"][1] = make_instance("i-1", 2)
+    assert plan.plan(warm_def, snapshot)["cluster_action"] == "scale_up"
+    assert plan.plan(IDLE_DEF, snapshot)["cluster_action"] is None
+
+
+def test_computed_signal():
+    computed_def = copy.deepcopy(IDLE_DEF)
+    computed_def["services"]["worker"]["idle"]["metric"] = \
+        "queue_length + dead_letters"
+    _task_definitions.clear()
+    clients = plan.snapshot_clients(idle_snapshot(0), computed_def)
+    with fake_clients(**clients):
+        worker, = build_services("my_cluster", computed_def)
+    # Every source the signal is computed from is fetched.
+    assert len(worker.metric_sources["sqs"]) == 2
+
+    snapshot = idle_snapshot(5)
+    snapshot["metrics"]["worker"]["dead_letters"] = 0
+    worker, = plan.plan(computed_def, snapshot)["services"]
+    assert worker["desired_tasks"] == 3
+
+    # A signal that cannot be evaluated shows no work.
+    assert plan.plan(computed_def, idle_snapshot(5))["actions"] == []
@@ -0,0 +1,171 @@
+"""Test per-cluster leases for overlapping invocations."""
+
+import io
+import json
+
+import boto3
+import pytest
+import yaml
+
+import lambda_function
+import plan
+from ecsautoscale.deadline import Deadline
+from ecsautoscale.http import use_adapter
+from ecsautoscale.leases import (
+    DynamoDBLeaseBackend, FileLeaseBackend, LeaseManager, cluster_lease_name,
+    get_backend, use_leases,
+)
+from ecsautoscale.publisher import MetricsPublisher
+from ecsautoscale.state import DynamoDBStateStore
+
+from helpers import (
+    FakeLeaseTable, FakeTransport, HTTP_CLUSTER_DEF, fake_clients,
+    make_snapshot,
+)
+
+
+def moto_table():
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        client = boto3.client("dynamodb", region_name="us-east-1")
+        client.create_table(
+            TableName="leases",
+            KeySchema=[{"AttributeName": "lease", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "lease",
+                                   "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield DynamoDBLeaseBackend("leases", client=client)
+
+
+@pytest.fixture(params=["file", "fake_table", "moto"])
+def backend(request, tmp_path):
+    if request.param == "file":
+        yield FileLeaseBackend(str(tmp_path))
+    elif request.param == "fake_table":
+        yield DynamoDBLeaseBackend("leases", client=FakeLeaseTable())
+    else:
+        yield from moto_table()
+
+
+def test_backend(backend):
+    assert backend.acquire("c", "a", expires=200, now=100)
+    # Held by someone else until it expires.
+    assert not backend.acquire("c", "b", expires=250, now=150)
+    assert backend.acquire("d", "b", expires=250, now=150)
+    # Taking it again extends it.
+    assert backend.acquire("c", "a", expires=300, now=150)
+    assert not backend.acquire("c", "b", expires=350, now=250)
+    assert backend.acquire("c", "b", expires=400, now=301)
+
+    # Only the holder can release it.
+    backend.release("c", "a")
+    assert not backend.acquire("c", "a", expires=400, now=302)
+    backend.release("c", "b")
+    assert backend.acquire("c", "a", expires=400, now=302)
+
+
+@pytest.fixture(params=["fake_table", "moto"])
+def table_backend(request):
+    if request.param == "fake_table":
+        yield DynamoDBLeaseBackend("leases", client=FakeLeaseTable())
+    else:
+        yield from moto_table()
+
+
+def test_state_store_in_lease_table(table_backend):
+    backend = table_backend
+    store = DynamoDBStateStore(backend.table, client=backend.client,
+                               clock=lambda: 100)
+    assert store.get("staged", "c") is None
+    store.set("staged", "c", {"worker": {"desired": 5}})
+    assert store.get("staged", "c") == {"worker": {"desired": 5}}
+    # Never mistaken for a lease.
+    assert backend.acquire("c", "a", expires=200, now=150)
+    store.delete("staged", "c")
+    assert store.get("staged", "c", {}) == {}
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+def test_wait_for_lease(tmp_path):
+    clock = Clock()
+    backend = FileLeaseBackend(str(tmp_path))
+    backend.acquire("c", "other", expires=clock.now + 2.5, now=clock.now)
+
+    skipping = LeaseManager(backend, wait=0, clock=clock, sleep=clock.sleep)
+    assert not skipping.acquire("c")
+
+    waiting = LeaseManager(backend, wait=5, poll=1, clock=clock,
+                           sleep=clock.sleep)
+    assert waiting.acquire("c")
+    assert clock.now == 1003
+    waiting.release("c")
+    assert skipping.acquire("c")
+
+    # Never waits past the deadline.
+    impatient = LeaseManager(backend, wait=60, clock=clock, sleep=clock.sleep)
+    assert not impatient.acquire("c", deadline=Deadline(3, clock=clock))
+    assert clock.now < 1010
+
+
+def test_file_backend_on_lambda(monkeypatch):
+    monkeypatch.delenv("AWS_LAMBDA_FUNCTION_NAME", raising=False)
+    assert isinstance(get_backend("file"), FileLeaseBackend)
+
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "ecs-autoscale")
+    with pytest.raises(ValueError, match="LEASE_BACKEND"):
+        get_backend("file")
+    assert isinstance(get_backend("dynamodb"), DynamoDBLeaseBackend)
+    assert get_backend("none") is None
+
+
+def test_unreachable_backend_does_not_block():
+    class Broken(FileLeaseBackend):
+        def acquire(self, *args, **kwargs):
+            raise OSError("No space left on device")
+
+    stream = io.StringIO()
+    metrics = MetricsPublisher(mode="emf", stream=stream)
+    manager = LeaseManager(Broken("/nonexistent"), metrics=metrics)
+    assert manager.acquire("a")
+    assert manager.acquire("b")
+    metrics.flush()
+    doc, = [json.loads(x) for x in stream.getvalue().splitlines()]
+    assert doc["LeaseErrors"] == 2
+    manager.new_tick()
+    assert manager.errors == 0
+
+
+def test_locked_cluster_is_skipped(tmp_path, monkeypatch):
+    defs_dir = tmp_path / "clusters"
+    defs_dir.mkdir()
+    (defs_dir / "my_cluster.yml").write_text(yaml.safe_dump(HTTP_CLUSTER_DEF))
+    monkeypatch.setenv("CLUSTER_DEFS_SOURCE", str(defs_dir))
+    backend = FileLeaseBackend(str(tmp_path / "leases"))
+    transport = FakeTransport({"queue": {"length": 500}})
+
+    def run() -> list:
+        clients = plan.snapshot_clients(make_snapshot(0), HTTP_CLUSTER_DEF)
+        with fake_clients(**clients), use_adapter(transport), \
+                use_leases(LeaseManager(backend)):
+            lambda_function.lambda_handler({}, None)
+        return [op for client in clients.values() for op, _ in client.calls
+                if op in ("update_service", "set_desired_capacity")]
+
+    other = LeaseManager(backend)
+    assert other.acquire(cluster_lease_name("my_cluster"))
+    assert run() == []
+    other.release(cluster_lease_name("my_cluster"))
+    assert sorted(run()) == ["set_desired_capacity", "update_service"]
+    # Leases are given back at the end of the tick.
+    assert other.acquire(cluster_lease_name("my_cluster"))
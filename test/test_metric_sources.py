@@ -0,0 +1,80 @@
+"""Test the metric source registry and batching."""
+
+from typing import List
+
+import pytest
+
+from ecsautoscale.exceptions import CloudWatchError
+from ecsautoscale.metric_sources import MetricSource, get_source, register
+from ecsautoscale.services import Service, collect_metrics
+
+from helpers import FakeClient, fake_clients
+
+
+class CountingSource(MetricSource):
+
+    def __init__(self) -> None:
+        self.batches: List[List[dict]] = []
+
+    def fetch_many(self, requests):
+        self.batches.append(requests)
+        return [{x["alias"]: x["value"]} if x["value"] is not None
+                else ValueError("no value") for x in requests]
+
+
+def make_service(cluster_name: str, metric_sources: dict) -> Service:
+    return Service(cluster_name, "worker", None, 1,
+                   metric_sources=metric_sources)
+
+
+def test_requests_batched_across_services_and_clusters():
+    source = register("counting", CountingSource())
+    services = [
+        make_service("a", {"counting": [{"alias": "x", "value": 1},
+                                        {"alias": "y", "value": 2}]}),
+        make_service("b", {"counting": [{"alias": "x", "value": 3}]}),
+        make_service("b", {"counting": [{"alias": "x", "value": None}]}),
+    ]
+    collect_metrics(services)
+    assert len(source.batches) == 1
+    assert len(source.batches[0]) == 4
+    assert services[0].state == {"x": 1, "y": 2}
+    assert services[1].state == {"x": 3}
+    assert isinstance(services[2].metrics_error, ValueError)
+
+
+def test_get_source_by_import_path():
+    source = get_source("test_metric_sources:CountingSource")
+    assert isinstance(source, CountingSource)
+    assert get_source("test_metric_sources:CountingSource") is source
+
+
+def test_unknown_source():
+    with pytest.raises(KeyError):
+        get_source("does_not_exist")
+
+
+def test_cloudwatch_single_call():
+    def get_metric_data(MetricDataQueries, **kwargs):
+        return {"MetricDataResults": [
+            {"Id": x["Id"], "Values": [] if "Missing" in
+             x["MetricStat"]["Metric"]["MetricName"] else [42.0]}
+            for x in MetricDataQueries
+        ]}
+
+    cloudwatch = FakeClient({"get_metric_data": get_metric_data})
+    items = [
+        {"metric_name": "CPUUtilization",
+         "statistics": [{"name": "Average", "alias": "cpu"},
+                        {"name": "Maximum", "alias": "cpu_max"}]},
+        {"metric_name": "MemoryUtilization",
+         "statistics": [{"name": "Average", "alias": "mem"}]},
+        {"metric_name": "Missing",
+         "statistics": [{"name": "Average", "alias": "missing"}]},
+    ]
+    with fake_clients(cloudwatch=cloudwatch):
+        results = get_source("cloudwatch").fetch_many(items)
+    assert len(cloudwatch.calls) == 1
+    assert results[0] == {"cpu": 42.0, "cpu_max": 42.0}
+    assert results[1] == {"mem": 42.0}
+    assert isinstance(results[2], CloudWatchError)
@@ -0,0 +1,142 @@
+"""Test the ecsautoscale.placement module."""
+
+from ecsautoscale.placement import (
+    InstanceState, PlacementSimulator, TaskRequirements, instance_block,
+    matches_expression,
+)
+
+
+def make_instance(instance_id: str,
+                  cpu: int = 1024,
+                  mem: int = 2048,
+                  ports=None,
+                  attributes=None) -> dict:
+    attributes = attributes or {}
+    return {
+        "ec2InstanceId": instance_id,
+        "containerInstanceArn":
+            "arn:aws:ecs:::container-instance/" + instance_id,
+        "registeredResources": [
+            {"name": "CPU", "type": "INTEGER", "integerValue": 2048},
+            {"name": "MEMORY", "type": "INTEGER", "integerValue": 4096},
+            {"name": "PORTS", "type": "STRINGSET", "stringSetValue": ["22"]},
+        ],
+        "remainingResources": [
+            {"name": "CPU", "type": "INTEGER", "integerValue": cpu},
+            {"name": "MEMORY", "type": "INTEGER", "integerValue": mem},
+            {"name": "PORTS", "type": "STRINGSET",
+             "stringSetValue": ["22"] + (ports or [])},
+        ],
+        "attributes": [{"name": k, "value": v} for k, v in attributes.items()],
+        "runningTasksCount": 1,
+        "pendingTasksCount": 0,
+    }
+
+
+def test_exact_fit():
+    simulator = PlacementSimulator.from_container_instances(
+        [make_instance("i-1", cpu=512, mem=1024)])
+    task = TaskRequirements(cpu=512, mem=1024)
+    assert simulator.place(task) is not None
+    assert simulator.place(task) is None
+
+
+def test_static_host_port_conflict():
+    task_def = {
+        "networkMode": "bridge",
+        "containerDefinitions": [{
+            "cpu": 128,
+            "memory": 128,
+            "portMappings": [{"containerPort": 80, "hostPort": 80}],
+        }],
+    }
+    task = TaskRequirements.from_task_definition(task_def)
+    simulator = PlacementSimulator.from_container_instances(
+        [make_instance("i-1", ports=["80"]), make_instance("i-2")])
+    assert simulator.place_many(task, 3) == 1
+    assert simulator.instances[1].used_ports == {"22", "80"}
+
+
+def test_distinct_instance():
+    task = TaskRequirements(cpu=1, mem=1,
+                            constraints=[{"type": "distinctInstance"}])
+    instances = [make_instance("i-1"), make_instance("i-2"),
+                 make_instance("i-3")]
+    simulator = PlacementSimulator.from_container_instances(instances)
+    simulator.register_tasks("web", [instances[0]["containerInstanceArn"]])
+    assert simulator.place_many(task, 5, "web") == 2
+
+
+def test_member_of_expression():
+    instance = InstanceState.from_container_instance(make_instance(
+        "i-1", attributes={"ecs.instance-type": "g4dn.xlarge",
+                           "ecs.availability-zone": "us-east-1a"}))
+    assert matches_expression("attribute:ecs.instance-type =~ g4dn.*",
+                              instance)
+    assert matches_expression(
+        "attribute:ecs.availability-zone in [us-east-1a, us-east-1b]",
+        instance)
+    assert not matches_expression(
+        "attribute:ecs.instance-type == t3.micro and "
+        "attribute:ecs.availability-zone == us-east-1a", instance)
+    assert matches_expression(
+        "attribute:ecs.instance-type == t3.micro or "
+        "attribute:ecs.availability-zone == us-east-1a", instance)
+
+    # Unsupported fields do not rule instances out.
+    assert matches_expression("task:group == service:web", instance)
+    assert matches_expression("ec2InstanceId in [i-1, i-2]", instance)
+    assert not matches_expression("ec2InstanceId != i-1", instance)
+
+
+def test_eni_limit():
+    # t3.micro has 2 interfaces, one is the primary one.
+    simulator = PlacementSimulator.from_container_instances(
+        [make_instance("i-1", attributes={"ecs.instance-type": "t3.micro"})])
+    task = TaskRequirements(cpu=1, mem=1, enis=1)
+    assert simulator.place_many(task, 3) == 1
+
+
+def test_az_spread():
+    instances = [
+        make_instance("i-1", attributes={"ecs.availability-zone": "a"}),
+        make_instance("i-2", attributes={"ecs.availability-zone": "a"}),
+        make_instance("i-3", attributes={"ecs.availability-zone": "b"}),
+    ]
+    task = TaskRequirements(cpu=1, mem=1, strategy=[{
+        "type": "spread", "field": "attribute:ecs.availability-zone",
+    }])
+    simulator = PlacementSimulator.from_container_instances(instances)
+    zones = [simulator.place(task, "web").az for _ in range(4)]
+    assert sorted(zones) == ["a", "a", "b", "b"]
+
+
+def test_instance_block():
+    block = instance_block(make_instance("i-1", cpu=1024, mem=1024,
+                                         ports=["8080"]))
+    assert block.cpu == 1024
+    assert block.mem == 3072
+    assert block.ports == {"8080"}
+
+
+def test_reservation_rules():
+    # Soft limits are reserved when set, containers without cpu reserve none.
+    task = TaskRequirements.from_task_definition({"containerDefinitions": [
+        {"name": "app", "cpu": 256, "memory": 1024, "memoryReservation": 512},
+        {"name": "sidecar", "memoryReservation": 128},
+        {"name": "log", "memory": 64},
+    ]})
+    assert (task.cpu, task.mem) == (256, 704)
+
+    # Task-level values are reserved as a whole.
+    task = TaskRequirements.from_task_definition({
+        "cpu": "1 vCPU",
+        "memory": "2 GB",
+        "containerDefinitions": [{"name": "app", "memoryReservation": 256}],
+    })
+    assert (task.cpu, task.mem) == (1024, 2048)
+    task = TaskRequirements.from_task_definition({
+        "cpu": "512",
+        "containerDefinitions": [{"name": "app", "memory": 300}],
+    })
+    assert (task.cpu, task.mem) == (512, 300)
@@ -0,0 +1,148 @@
+"""Test what-if planning against cluster snapshots."""
+
+from datetime import datetime, timezone
+import json
+import os
+import threading
+from http.server import HTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+import lambda_function
+import plan
+
+from helpers import CLUSTER_DEF, make_instance, make_snapshot
+
+
+def test_plan_scale_out():
+    result = plan.plan(CLUSTER_DEF, make_snapshot(500))
+    assert result["cluster_action"] == "scale_up"
+    worker, = result["services"]
+    assert worker["desired_tasks"] == 5
+    assert worker["task_diff"] == 2
+    assert {(x["service"], x["operation"]) for x in result["actions"]} == {
+        ("autoscaling", "set_desired_capacity"),
+        ("ecs", "update_service"),
+    }
+
+
+def test_plan_quiet():
+    result = plan.plan(CLUSTER_DEF, make_snapshot(50))
+    assert result["cluster_action"] is None
+    assert result["actions"] == []
+
+
+def test_plan_has_no_side_effects(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(lambda_function, "record_cluster",
+                        lambda *args: recorded.append(args))
+    assert plan.plan(CLUSTER_DEF, make_snapshot(500))["actions"]
+    assert recorded == []
+
+
+def test_plan_missing_metrics():
+    snapshot = make_snapshot(500)
+    del snapshot["metrics"]
+    result = plan.plan(CLUSTER_DEF, snapshot)
+    assert result["services"][0]["error"]
+    assert not [x for x in result["actions"]
+                if x["operation"] == "update_service"]
+
+
+def fargate_snapshot(queue_length: int) -> dict:
+    snapshot = make_snapshot(queue_length)
+    snapshot["services"][0]["launchType"] = "FARGATE"
+    snapshot["task_definitions"]["worker:3"].update({
+        "requiresCompatibilities": ["FARGATE"],
+        "cpu": "1024",
+        "memory": "2048",
+    })
+    return snapshot
+
+
+def test_plan_fargate_service():
+    # Full instances, but Fargate tasks don't need room on them.
+    snapshot = fargate_snapshot(500)
+    snapshot["container_instances"] = [make_instance("i-0", 2),
+                                       make_instance("i-1", 2)]
+    result = plan.plan(CLUSTER_DEF, snapshot)
+    assert result["cluster_action"] is None
+    assert [(x["service"], x["operation"]) for x in result["actions"]] == \
+        [("ecs", "update_service")]
+
+
+def test_plan_fargate_only_cluster():
+    cluster_def = {k: v for k, v in CLUSTER_DEF.items()
+                   if k not in ("autoscale_group", "cpu_buffer", "mem_buffer")}
+    snapshot = fargate_snapshot(500)
+    del snapshot["autoscaling_group"]
+    snapshot["container_instances"] = []
+    result = plan.plan(cluster_def, snapshot)
+    assert result["services"][0]["desired_tasks"] == 5
+    assert [(x["service"], x["operation"]) for x in result["actions"]] == \
+        [("ecs", "update_service")]
+
+
+def test_plan_schedule():
+    cluster_def = dict(CLUSTER_DEF, schedules=[{
+        "name": "peak", "cron": "0 8 * * *", "duration": "4h",
+        "services": {"worker": {"min": 5}},
+    }])
+    result = plan.plan(cluster_def, make_snapshot(50),
+                       now=datetime(2024, 6, 7, 9, tzinfo=timezone.utc))
+    assert result["schedule"]["active"][0]["name"] == "peak"
+    assert result["services"][0]["desired_tasks"] == 5
+
+    result = plan.plan(cluster_def, make_snapshot(50),
+                       now=datetime(2024, 6, 7, 7, tzinfo=timezone.utc))
+    assert result["schedule"]["upcoming"][0]["start"] == \
+        "2024-06-07T08:00:00+00:00"
+    assert result["actions"] == []
+
+
+def test_snapshot_cached(tmp_path):
+    path = tmp_path / "snapshot.json"
+    path.write_text(json.dumps(make_snapshot(500)))
+    first = plan.load_file(str(path))
+    assert plan.load_file(str(path)) is first
+
+    path.write_text(json.dumps(make_snapshot(5000)))
+    os.utime(str(path), ns=(0, 10 ** 9))
+    assert plan.load_file(str(path))["metrics"]["worker"]["queue_length"] \
+        == 5000
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(("127.0.0.1", 0), plan.PlanHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{:d}".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_http(server, tmp_path):
+    path = tmp_path / "snapshot.json"
+    path.write_text(json.dumps(make_snapshot(500)))
+    body = json.dumps({"cluster_def": CLUSTER_DEF, "snapshot": str(path)})
+    res = urlopen(Request(server + "/plan", data=body.encode("utf-8"),
+                          headers={"Content-Type": "application/json"}))
+    assert json.loads(res.read())["cluster_action"] == "scale_up"
+
+
+@pytest.mark.parametrize("body, error", [
+    ({"snapshot": {}}, "Missing field: 'cluster_def'"),
+    ({"cluster_def": [], "snapshot": {}}, "ValueError: cluster_def"),
+    ({"cluster_def": dict(CLUSTER_DEF, services=[1]),
+      "snapshot": make_snapshot(500)}, "AttributeError: "),
+])
+def test_http_errors(server, body, error):
+    request = Request(server + "/plan", data=json.dumps(body).encode("utf-8"),
+                      headers={"Content-Type": "application/json"})
+    with pytest.raises(HTTPError) as info:
+        urlopen(request)
+    assert info.value.code == 400
+    assert json.loads(info.value.read())["error"].startswith(error)
@@ -0,0 +1,63 @@
+"""Test profiling a single invocation."""
+
+import pstats
+
+import yaml
+
+import lambda_function
+import plan
+from ecsautoscale import profiling
+from ecsautoscale.http import use_adapter
+
+from helpers import (
+    FakeTransport, HTTP_CLUSTER_DEF, fake_clients, make_snapshot,
+)
+
+
+def test_phase_is_free_when_off():
+    assert profiling.profiler is None
+    assert profiling.phase(profiling.LOAD) is profiling.phase(profiling.SAVE)
+    with profiling.profiling() as profiler:
+        assert profiler is None
+        assert profiling.profiler is None
+
+
+def test_nested_phases(tmp_path):
+    with profiling.profiling(enabled=True, directory="") as profiler:
+        with profiling.phase(profiling.INSTANCES):
+            sum(range(1000))
+            with profiling.phase(profiling.HEADROOM):
+                items = [str(x) for x in range(10000)]
+            with profiling.phase(profiling.HEADROOM):
+                pass
+    assert profiling.profiler is None
+    assert profiler.phases[profiling.HEADROOM].count == 2
+    assert profiler.phases[profiling.INSTANCES].count == 1
+    # Allocations are counted in the innermost phase.
+    assert any(__file__ in site for site in
+               profiler.phases[profiling.HEADROOM].allocations)
+    report = profiler.report()
+    assert report.index(profiling.HEADROOM) < report.index(profiling.INSTANCES)
+    assert len(items) == 10000
+
+
+def test_profiled_tick(tmp_path, monkeypatch):
+    defs_dir = tmp_path / "clusters"
+    defs_dir.mkdir()
+    (defs_dir / "my_cluster.yml").write_text(yaml.safe_dump(HTTP_CLUSTER_DEF))
+    monkeypatch.setenv("CLUSTER_DEFS_SOURCE", str(defs_dir))
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path / "profiles"))
+
+    clients = plan.snapshot_clients(make_snapshot(0), HTTP_CLUSTER_DEF)
+    transport = FakeTransport({"queue": {"length": 500}})
+    with fake_clients(**clients), use_adapter(transport):
+        lambda_function.lambda_handler({"profile": True}, None)
+
+    report, = (tmp_path / "profiles").glob("*.txt")
+    text = report.read_text()
+    for name in profiling.PHASES:
+        assert "== " + name in text
+    assert "Top allocations:" in text
+    raw, = (tmp_path / "profiles").glob("*.pstats")
+    assert pstats.Stats(str(raw)).total_calls > 0
+
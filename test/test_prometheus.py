@@ -0,0 +1,102 @@
+"""Test the Prometheus metric source against a local stub server."""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import threading
+from urllib.parse import parse_qs
+
+import pytest
+
+from ecsautoscale.exceptions import PrometheusError
+from ecsautoscale.metric_sources.prometheus import PrometheusSource
+
+
+RESULTS = {
+    "in_flight": ("vector", [
+        {"metric": {"instance": "a"}, "value": [0, "3"]},
+        {"metric": {"instance": "b"}, "value": [0, "5"]},
+    ]),
+    "latency_p99": ("scalar", [0, "0.25"]),
+    "empty": ("vector", []),
+}
+
+
+class StubPrometheus(BaseHTTPRequestHandler):
+
+    queries: list = []
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        length = int(self.headers["Content-Length"])
+        form = parse_qs(self.rfile.read(length).decode())
+        query = form["query"][0]
+        self.queries.append((query, form["time"][0]))
+        if query not in RESULTS:
+            status = 400
+            body = {"status": "error", "error": "parse error"}
+        else:
+            status = 200
+            result_type, result = RESULTS[query]
+            body = {"status": "success",
+                    "data": {"resultType": result_type, "result": result}}
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture(scope="module")
+def prometheus_url():
+    server = HTTPServer(("127.0.0.1", 0), StubPrometheus)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+
+
+def test_batch(prometheus_url):
+    StubPrometheus.queries = []
+    source = PrometheusSource(clock=lambda: 1000.0)
+    results = source.fetch_many([
+        {"url": prometheus_url, "queries": [
+            {"query": "in_flight", "alias": "in_flight", "aggregate": "max"},
+            {"query": "latency_p99", "alias": "p99"},
+        ]},
+        {"url": prometheus_url, "queries": [
+            {"query": "in_flight", "alias": "total_in_flight"},
+            {"query": "empty", "alias": "empty", "default": 0},
+        ]},
+        {"url": prometheus_url, "queries": [
+            {"query": "bad(", "alias": "bad"},
+        ]},
+    ])
+    assert results[0] == {"in_flight": 5.0, "p99": 0.25}
+    assert results[1] == {"total_in_flight": 8.0, "empty": 0}
+    assert isinstance(results[2], PrometheusError)
+
+    # One request per distinct query, all at the same evaluation time.
+    assert sorted(x[0] for x in StubPrometheus.queries) == \
+        ["bad(", "empty", "in_flight", "latency_p99"]
+    assert {x[1] for x in StubPrometheus.queries} == {"1000.000"}
+
+
+def test_no_samples(prometheus_url):
+    source = PrometheusSource()
+    results = source.fetch_many([
+        {"url": prometheus_url, "queries": [{"query": "empty", "alias": "x"}]},
+    ])
+    assert isinstance(results[0], PrometheusError)
+
+
+def test_get_data(prometheus_url):
+    source = PrometheusSource()
+    assert source.get_data(url=prometheus_url, queries=[
+        {"query": "in_flight", "alias": "x", "aggregate": "max"},
+    ]) == {"x": 5}
+    with pytest.raises(PrometheusError):
+        source.get_data(url=prometheus_url,
+                        queries=[{"query": "empty", "alias": "x"}])
@@ -0,0 +1,81 @@
+"""Test publishing headroom and utilization metrics."""
+
+import io
+import json
+
+from ecsautoscale.publisher import (
+    MetricsPublisher, record_cluster, service_headroom,
+)
+from ecsautoscale.services import Service
+
+from helpers import FakeClient, fake_clients, make_instance
+
+
+def make_service(name: str, cpu: int, mem: int) -> Service:
+    service = Service("test_cluster", name, None, 2, desired_count=3,
+                      pending_count=1)
+    service.task_cpu = cpu
+    service.task_mem = mem
+    return service
+
+
+def test_put_metric_data_batches():
+    cloudwatch = FakeClient()
+    metrics = MetricsPublisher(mode="cloudwatch", clock=lambda: 0)
+    for i in range(2500):
+        metrics.add("Headroom", i, Cluster="c", Service="s{:d}".format(i))
+    with fake_clients(cloudwatch=cloudwatch):
+        assert metrics.flush() == 2500
+        assert metrics.flush() == 0
+    calls = cloudwatch.calls_to("put_metric_data")
+    assert [len(x["MetricData"]) for x in calls] == [1000, 1000, 500]
+    assert calls[0]["Namespace"] == "ECSAutoscale"
+
+
+def test_disabled():
+    metrics = MetricsPublisher(mode="")
+    metrics.add("Headroom", 1, Cluster="c")
+    assert metrics.flush() == 0
+
+
+def test_headroom():
+    instances = [make_instance("i-0", 1), make_instance("i-1", 0)]
+    assert service_headroom(instances, make_service("web", 1024, 2048)) == 3
+    assert service_headroom(instances, make_service("big", 2048, 4096)) == 1
+    assert service_headroom(instances, make_service("tiny", 1, 1),
+                            limit=10) == 10
+
+
+def test_record_cluster_emf():
+    stream = io.StringIO()
+    metrics = MetricsPublisher(mode="emf", clock=lambda: 1.5, stream=stream)
+    cluster_data = {
+        "cluster_name": "test_cluster",
+        "active_container_described": {"containerInstances": [
+            make_instance("i-0", 1), make_instance("i-1", 2),
+        ]},
+        "draining_container_described": {"containerInstances": []},
+    }
+    report = {
+        "cluster_data": cluster_data,
+        "asg_group_data": {"DesiredCapacity": 3, "MinSize": 1, "MaxSize": 4},
+        "action": "scale_up",
+    }
+    record_cluster("test_cluster", report,
+                   [make_service("web", 1024, 2048)], metrics=metrics)
+    metrics.flush()
+
+    docs = [json.loads(x) for x in stream.getvalue().splitlines()]
+    cluster, = [x for x in docs if "Service" not in x]
+    service, = [x for x in docs if "Service" in x]
+    assert cluster["_aws"]["Timestamp"] == 1500
+    assert cluster["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == \
+        [["Cluster"]]
+    assert cluster["LaunchingInstances"] == 1
+    assert cluster["CPUReservation"] == 75.0
+    assert cluster["ScaledOut"] == 1 and cluster["ScaledIn"] == 0
+    assert service["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == \
+        [["Cluster", "Service"]]
+    assert service["Service"] == "web"
+    assert service["Headroom"] == 1
+    assert service["PendingCount"] == 1
@@ -0,0 +1,101 @@
+"""Test the SQS and Redis queue depth metric sources."""
+
+import pytest
+
+from ecsautoscale.exceptions import QueueDepthError
+from ecsautoscale.metric_sources.redis_queue import RedisQueueSource
+from ecsautoscale.metric_sources.sqs import SQSSource
+
+from helpers import fake_clients
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        yield boto3.client("sqs", region_name="us-east-1")
+
+
+def test_sqs(sqs):
+    jobs = sqs.create_queue(QueueName="jobs")["QueueUrl"]
+    sqs.create_queue(QueueName="emails")
+    for _ in range(3):
+        sqs.send_message(QueueUrl=jobs, MessageBody="x")
+
+    with fake_clients(sqs=sqs):
+        results = SQSSource().fetch_many([
+            {"queue": "jobs", "statistics": [{"alias": "jobs"}]},
+            {"queue": jobs, "statistics": [
+                {"name": "ApproximateNumberOfMessagesNotVisible",
+                 "alias": "in_flight"},
+            ]},
+            {"queue": "emails", "statistics": [{"alias": "emails"}]},
+            {"queue": "missing", "statistics": [{"alias": "missing"}]},
+        ])
+    assert results[0] == {"jobs": 3}
+    assert results[1] == {"in_flight": 0}
+    assert results[2] == {"emails": 0}
+    assert isinstance(results[3], QueueDepthError)
+
+
+class CountingPipelines:
+
+    def __init__(self, client) -> None:
+        self.client = client
+        self.pipelines = 0
+
+    def pipeline(self, **kwargs):
+        self.pipelines += 1
+        return self.client.pipeline(**kwargs)
+
+
+def test_redis_single_pipeline():
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    redis_client = CountingPipelines(fakeredis.FakeRedis(server=server))
+    redis_client.client.rpush("celery", 1, 2, 3)
+    redis_client.client.rpush("priority", 1)
+
+    source = RedisQueueSource(client_factory=lambda url: redis_client)
+    results = source.fetch_many([
+        {"url": "redis://localhost:6379/0", "statistics": [
+            {"name": "celery", "alias": "queue_length"},
+            {"name": "priority", "alias": "priority_length"},
+        ]},
+        {"url": "redis://localhost:6379/0", "statistics": [
+            {"name": "celery", "alias": "other_queue_length"},
+            {"name": "empty", "alias": "empty"},
+        ]},
+    ])
+    assert results == [
+        {"queue_length": 3, "priority_length": 1},
+        {"other_queue_length": 3, "empty": 0},
+    ]
+    assert redis_client.pipelines == 1
+
+
+def test_redis_connection_error():
+    def broken(url):
+        raise ConnectionError("refused")
+
+    results = RedisQueueSource(client_factory=broken).fetch_many([
+        {"url": "redis://nowhere",
+         "statistics": [{"name": "q", "alias": "q"}]},
+    ])
+    assert isinstance(results[0], QueueDepthError)
+
+
+def test_redis_password_is_redacted():
+    def broken(url):
+        raise ConnectionError("auth failed for " + url)
+
+    source = RedisQueueSource(client_factory=broken)
+    for url in ("redis://:hunter2@cache:6379/0",
+                "redis://cache:6379/0?password=hunter2&db=1"):
+        with pytest.raises(QueueDepthError) as info:
+            source.get_data(url=url, statistics=[{"name": "q", "alias": "q"}])
+        assert "hunter2" not in str(info.value)
+        assert "cache:6379" in info.value.queue
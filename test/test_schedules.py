@@ -0,0 +1,127 @@
+"""Test scheduled capacity profiles."""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from ecsautoscale.schedules import (
+    Cron, Schedule, apply_schedules, describe_schedules, parse_duration,
+)
+
+
+CLUSTER_DEF = {
+    "min": 1,
+    "max": 4,
+    "services": {
+        "web": {"min": 2, "max": 10},
+        "worker": {"min": 1, "max": 5},
+    },
+    "schedules": [
+        {
+            "name": "business-hours",
+            "cron": "30 7 * * MON-FRI",
+            "duration": "10h",
+            "timezone": "Europe/Berlin",
+            "min": 3,
+            "max": 8,
+            "services": {"web": {"min": 6, "max": 30}},
+        },
+        {
+            "name": "batch",
+            "cron": "0 6 * * *",
+            "duration": "2h",
+            "timezone": "Europe/Berlin",
+            "min": 2,
+            "services": {"web": {"min": 4}, "worker": {"min": 5}},
+        },
+    ],
+}
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def test_cron_fields():
+    cron = Cron("*/15 9-17 1,15 * MON-FRI")
+    assert cron.minutes == [0, 15, 30, 45]
+    assert cron.hours == list(range(9, 18))
+    # Day of month and day of week match either, like cron.
+    assert cron.matches_day(datetime(2024, 6, 1).date())  # 1st, a Saturday
+    assert cron.matches_day(datetime(2024, 6, 3).date())  # A Monday
+    assert not cron.matches_day(datetime(2024, 6, 2).date())
+    assert Cron("0 0 * * 7").weekdays == {0}
+    with pytest.raises(ValueError):
+        Cron("0 25 * * *")
+
+
+def test_cron_previous_and_next():
+    cron = Cron("30 7 * * MON-FRI")
+    friday = datetime(2024, 6, 7, 7, 30)
+    assert cron.previous(friday, 7) == friday
+    # Over the weekend, the last window opened on Friday.
+    assert cron.previous(datetime(2024, 6, 9, 12, 0), 7) == friday
+    assert cron.next(friday, 7) == datetime(2024, 6, 10, 7, 30)
+
+
+def test_parse_duration():
+    assert parse_duration("1h30m") == timedelta(minutes=90)
+    assert parse_duration("2d") == timedelta(days=2)
+    assert parse_duration(45) == timedelta(minutes=45)
+    with pytest.raises(ValueError):
+        parse_duration("soon")
+
+
+def test_time_zone():
+    schedule = Schedule(CLUSTER_DEF["schedules"][0])
+    # 07:30 in Berlin is 05:30 UTC in summer.
+    start, end = schedule.window_at(utc(2024, 6, 7, 5, 30))
+    assert start == utc(2024, 6, 7, 5, 30)
+    assert end == utc(2024, 6, 7, 15, 30)
+    assert schedule.window_at(utc(2024, 6, 7, 5, 29)) is None
+    assert schedule.window_at(utc(2024, 6, 7, 15, 30)) is None
+    # And 06:30 UTC in winter.
+    assert schedule.window_at(utc(2024, 1, 5, 6, 0)) is None
+    assert schedule.window_at(utc(2024, 1, 5, 6, 30)) is not None
+
+
+def test_apply_schedules():
+    # Outside of any window the definition is used as is.
+    assert apply_schedules("c", CLUSTER_DEF, utc(2024, 6, 8, 12)) is \
+        CLUSTER_DEF
+
+    # Only business hours.
+    res = apply_schedules("c", CLUSTER_DEF, utc(2024, 6, 7, 12))
+    assert (res["min"], res["max"]) == (3, 8)
+    assert res["services"]["web"] == {"min": 6, "max": 30}
+    assert res["services"]["worker"] == {"min": 1, "max": 5}
+
+    # Both, the highest limits win. The worker max follows its new min.
+    res = apply_schedules("c", CLUSTER_DEF, utc(2024, 6, 7, 5, 45))
+    assert (res["min"], res["max"]) == (3, 8)
+    assert res["services"]["web"] == {"min": 6, "max": 30}
+    assert res["services"]["worker"] == {"min": 5, "max": 5}
+    assert CLUSTER_DEF["services"]["web"] == {"min": 2, "max": 10}
+
+
+def test_invalid_schedules_are_ignored():
+    cluster_def = {
+        "services": {"web": {"min": 1, "max": 2}},
+        "schedules": [
+            {"name": "bad", "cron": "0 8 * *", "duration": "1h"},
+            {"name": "no-limits", "cron": "* * * * *", "duration": "1h",
+             "min": 5, "services": {"web": {"min": 2}}},
+        ],
+    }
+    res = apply_schedules("c", cluster_def, utc(2024, 6, 7, 12))
+    # The cluster has no limits to restore after the window.
+    assert "min" not in res
+    assert res["services"]["web"]["min"] == 2
+
+
+def test_describe_schedules():
+    res = describe_schedules("c", CLUSTER_DEF, utc(2024, 6, 7, 12))
+    assert [x["name"] for x in res["active"]] == ["business-hours"]
+    assert [(x["name"], x["start"]) for x in res["upcoming"]] == [
+        ("batch", "2024-06-08T04:00:00+00:00"),
+    ]
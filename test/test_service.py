@@ -24,6 +24,7 @@ def test_metric_arithmetic1(service):
     assert service._get_metric("foo ** 2") == 4
     assert service._get_metric("min([foo, bar])") == 2
     assert service._get_metric("max([foo, bar])") == 3
+    assert service.get_metric("foo * 100") == 200
 
 
 cases = [
@@ -0,0 +1,182 @@
+"""
+Test coordinated scale-out: staging service updates until capacity registers.
+"""
+
+import time
+
+import lambda_function
+import plan
+from ecsautoscale.events import parse_event
+from ecsautoscale.leases import DynamoDBLeaseBackend, LeaseManager, use_leases
+from ecsautoscale.state import StateStore, use_store
+from ecsautoscale.staging import ScaleOutStage, wait_for_capacity
+
+from helpers import (
+    CLUSTER_DEF, FakeLeaseTable, fake_clients, make_instance, make_snapshot,
+)
+
+
+STAGED_DEF = dict(CLUSTER_DEF, stage_scale_out=True)
+
+
+class Clock:
+    def __init__(self) -> None:
+        # Updates are staged at the real time.
+        self.now = time.time()
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+def updates(clients: dict) -> list:
+    return [params["desiredCount"] for op, params in clients["ecs"].calls
+            if op == "update_service"]
+
+
+def scale(snapshot: dict, cluster_def: dict = STAGED_DEF) -> dict:
+    """Run a tick of the snapshot's cluster, returning its fake clients."""
+    clients = plan.snapshot_clients(snapshot, cluster_def)
+    with fake_clients(**clients):
+        services = lambda_function.build_services("my_cluster", cluster_def)
+        for service in services:
+            service.state.update(snapshot["metrics"][service.service_name])
+        lambda_function.scale_cluster(
+            "my_cluster", cluster_def, services,
+            clients["autoscaling"].describe_auto_scaling_groups(),
+            clients["ecs"].list_clusters()["clusterArns"],
+        )
+    return clients
+
+
+def test_plan_stages_what_does_not_fit():
+    # One of the two new tasks fits on the registered instances.
+    result = plan.plan(STAGED_DEF, make_snapshot(500))
+    assert result["cluster_action"] == "scale_up"
+    worker, = result["services"]
+    assert worker["desired_tasks"] == 5
+    assert worker["staged_tasks"] == 1
+    update, = [x for x in result["actions"]
+               if x["operation"] == "update_service"]
+    assert update["params"]["desiredCount"] == 4
+
+    # Without staging, everything goes ahead at once.
+    worker, = plan.plan(CLUSTER_DEF, make_snapshot(500))["services"]
+    assert worker["staged_tasks"] == 0
+
+
+def test_release_on_registration():
+    clock = Clock()
+    store = StateStore()
+    with use_store(store):
+        assert updates(scale(make_snapshot(500))) == [4]
+        stage = ScaleOutStage("my_cluster", STAGED_DEF, clock=clock)
+        assert stage.staged()["worker"]["desired"] == 5
+
+        # Nothing registered yet.
+        snapshot = make_snapshot(500)
+        clients = plan.snapshot_clients(snapshot, STAGED_DEF)
+        with fake_clients(**clients):
+            assert stage.release() == []
+        assert updates(clients) == []
+
+        # A new instance shows up.
+        snapshot["container_instances"].append(make_instance("i-2", 0))
+        clients = plan.snapshot_clients(snapshot, STAGED_DEF)
+        with fake_clients(**clients):
+            assert stage.release() == ["worker"]
+        assert updates(clients) == [5]
+        assert stage.staged() == {}
+
+
+def test_release_after_timeout():
+    clock = Clock()
+    store = StateStore()
+    with use_store(store):
+        scale(make_snapshot(500))
+        stage = ScaleOutStage("my_cluster", dict(STAGED_DEF, stage_timeout=60),
+                              clock=clock)
+        clients = plan.snapshot_clients(make_snapshot(500), STAGED_DEF)
+        with fake_clients(**clients):
+            wait_for_capacity([stage], wait=30, poll=10, sleep=clock.sleep)
+            assert stage.staged()
+            clock.now += 3600
+            wait_for_capacity([stage], wait=30, poll=10, sleep=clock.sleep)
+        assert stage.staged() == {}
+        assert updates(clients) == [5]
+
+
+def test_poll_through_throttled_clients():
+    clock = Clock()
+    store = StateStore()
+    with use_store(store):
+        scale(make_snapshot(500))
+        stage = ScaleOutStage("my_cluster", STAGED_DEF, clock=clock)
+        snapshot = make_snapshot(500)
+        clients = plan.snapshot_clients(snapshot, STAGED_DEF)
+
+        def sleep(seconds: float) -> None:
+            clock.sleep(seconds)
+            if clock.now - stage.staged()["worker"]["since"] > 20:
+                snapshot["container_instances"].append(make_instance("i-2", 0))
+
+        with fake_clients(throttle=True, **clients):
+            wait_for_capacity([stage], wait=60, poll=10, sleep=sleep)
+        # Registered on the third poll, and seen despite the memo.
+        assert stage.staged() == {}
+        assert updates(clients) == [5]
+        assert [op for op, _ in clients["ecs"].calls].count(
+            "list_container_instances") == 3
+
+
+def test_release_from_another_container():
+    snapshot = make_snapshot(500)
+    snapshot["container_instances"].append(make_instance("i-2", 0))
+
+    # Without a shared table, only the container that staged the update
+    # knows about it.
+    with use_leases(LeaseManager(None)):
+        with use_store(StateStore()):
+            scale(make_snapshot(500))
+        clients = plan.snapshot_clients(snapshot, STAGED_DEF)
+        with use_store(StateStore()), fake_clients(**clients):
+            assert ScaleOutStage("my_cluster", STAGED_DEF).release() == []
+
+    # With DynamoDB leases, staged updates are kept in the lease table.
+    table = FakeLeaseTable()
+    with use_leases(LeaseManager(DynamoDBLeaseBackend("leases", table))):
+        with use_store(StateStore()):
+            scale(make_snapshot(500))
+        assert list(table.items) == ["state/staged/my_cluster"]
+        clients = plan.snapshot_clients(snapshot, STAGED_DEF)
+        with use_store(StateStore()), fake_clients(**clients):
+            stage = ScaleOutStage("my_cluster", STAGED_DEF)
+            assert stage.release() == ["worker"]
+            assert stage.staged() == {}
+        assert updates(clients) == [5]
+        assert table.items == {}
+
+
+def test_dropped_when_no_longer_needed():
+    store = StateStore()
+    with use_store(store):
+        scale(make_snapshot(500))
+        # The load went away once the first new task was running.
+        snapshot = make_snapshot(50)
+        snapshot["services"][0].update(runningCount=4, desiredCount=4)
+        assert updates(scale(snapshot)) == []
+        assert ScaleOutStage("my_cluster", STAGED_DEF).staged() == {}
+
+
+def test_container_instance_event():
+    event = {
+        "detail-type": "ECS Container Instance State Change",
+        "detail": {
+            "clusterArn": "arn:aws:ecs:us-east-1:1:cluster/my_cluster",
+            "status": "ACTIVE",
+        },
+    }
+    target, = parse_event(event, {"my_cluster": STAGED_DEF})
+    assert target.service_names == set()
@@ -0,0 +1,77 @@
+"""Test the ecsautoscale.throttling module."""
+
+from botocore.exceptions import ClientError
+import pytest
+
+from ecsautoscale.throttling import ThrottledClient, TokenBucket
+
+from helpers import FakeClient
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.slept: list = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def wrap(fake: FakeClient, **kwargs) -> ThrottledClient:
+    clock = FakeClock()
+    return ThrottledClient(fake, "ecs", sleep=clock.sleep, clock=clock,
+                           **kwargs)
+
+
+def test_retries_throttled_calls():
+    fake = FakeClient({"update_service": {"service": {}}},
+                      throttle={"update_service": 3})
+    client = wrap(fake)
+    assert client.update_service(cluster="c", service="s",
+                                 desiredCount=2) == {"service": {}}
+    assert len(fake.calls) == 4
+    assert client.stats["update_service"]["throttles"] == 3
+    assert client.stats["update_service"]["retries"] == 3
+
+
+def test_gives_up_after_max_attempts():
+    fake = FakeClient({"list_clusters": {}}, throttle={"list_clusters": 10})
+    client = wrap(fake, max_attempts=3)
+    with pytest.raises(ClientError):
+        client.list_clusters()
+    assert len(fake.calls) == 3
+
+
+def test_reads_memoized_until_write():
+    fake = FakeClient({"describe_services": {"services": []}})
+    client = wrap(fake)
+    res = client.describe_services(cluster="c", services=["a"])
+    res["services"].append("mutated")
+    assert client.describe_services(cluster="c", services=["a"]) == \
+        {"services": []}
+    client.describe_services(cluster="c", services=["b"])
+    assert len(fake.calls) == 2
+    assert client.stats["describe_services"]["memo_hits"] == 1
+
+    client.update_service(cluster="c", service="a", desiredCount=1)
+    client.describe_services(cluster="c", services=["a"])
+    assert len(fake.calls_to("describe_services")) == 3
+
+
+def test_token_bucket_rate_limits_and_adapts():
+    clock = FakeClock()
+    bucket = TokenBucket(10.0, 2, clock=clock, sleep=clock.sleep)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(0.1)
+
+    bucket.throttled()
+    assert bucket.rate == 5.0
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.rate == 10.0